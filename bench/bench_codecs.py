@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from comicprocessor import check_codec, color_gamma_correction_bw, color_quantize_bw, color_quantize_bw_palette, \
+    encode_image
+
+USAGE = """
+Encode time and size per page of each output codec, on generated greyscale pages quantized
+to 16 levels like pass 2 does. JPEG is the quantized RGB page, PNG the 4-bit paletted page,
+the other codecs the single-channel page. Codecs that Pillow cannot save are skipped.
+
+Usage:
+ bench_codecs.py [--pages=N] [--quality=N] [--width=N] [--height=N]
+
+--pages=N   Number of generated pages, half line art and half blurred noise, default 8
+--quality=N Quality of the lossy codecs, default 60
+--width=N   Page width, default 1072
+--height=N  Page height, default 1448
+"""
+
+# (name, codec, lossless)
+CODECS = [
+    ('jpeg', 'jpeg', False),
+    ('png 4-bit', 'png', False),
+    ('webp', 'webp', False),
+    ('webp lossless', 'webp', True),
+    ('avif', 'avif', False),
+    ('jxl', 'jxl', False),
+    ('jxl lossless', 'jxl', True),
+]
+
+
+def generate_page(rnd, idx, width, height):
+    if idx % 2 == 0:
+        # Line art on white
+        im = Image.new('L', (width, height), 255)
+        draw = ImageDraw.Draw(im)
+        for _ in range(300):
+            draw.line([(rnd.randrange(width), rnd.randrange(height)) for _ in range(2)],
+                      fill=rnd.randrange(128), width=rnd.randint(1, 4))
+        return im
+    # Blurred noise, like photos and screentone, which dithers into noise
+    im = Image.frombytes('L', (width // 8, height // 8), rnd.randbytes(width // 8 * (height // 8)))
+    return im.resize((width, height), Image.Resampling.BICUBIC).filter(ImageFilter.GaussianBlur(4))
+
+
+# Page in the mode each codec is given in pass 2
+def quantize_page(im, codec):
+    im = color_gamma_correction_bw(im.convert('F'), 1.8)
+    if codec == 'png':
+        return color_quantize_bw_palette(im)
+    im = color_quantize_bw(im)
+    return im if codec == 'jpeg' else im.convert('L')
+
+
+def main(args):
+    pages = 8
+    quality = 60
+    width, height = 1072, 1448
+    for arg in args[1:]:
+        if arg.startswith('--pages='):
+            pages = int(arg[8:])
+        elif arg.startswith('--quality='):
+            quality = int(arg[10:])
+        elif arg.startswith('--width='):
+            width = int(arg[8:])
+        elif arg.startswith('--height='):
+            height = int(arg[9:])
+        else:
+            print(USAGE)
+            return
+
+    rnd = random.Random(1)
+    originals = [generate_page(rnd, idx, width, height) for idx in range(pages)]
+    quantized = {}
+
+    print('{} pages {}x{}, quality {}'.format(pages, width, height, quality))
+    for name, codec, lossless in CODECS:
+        try:
+            check_codec(codec)
+        except Exception as e:
+            print('{:14} skipped: {}'.format(name, e))
+            continue
+
+        mode = codec if codec in ['jpeg', 'png'] else 'other'
+        if mode not in quantized:
+            quantized[mode] = [quantize_page(im, codec) for im in originals]
+
+        sizes = []
+        start = time.perf_counter()
+        for im in quantized[mode]:
+            sizes.append(len(encode_image(im, codec, quality, lossless)))
+        elapsed = time.perf_counter() - start
+        # Even pages are line art, odd pages noise
+        line_art, noise = sizes[0::2], sizes[1::2]
+        print('{:14} {:6.3f}s/page {:8.1f} KB/page, line art {:6.1f} KB, noise {:6.1f} KB'.format(
+            name, elapsed / pages, sum(sizes) / pages / 1024,
+            sum(line_art) / max(len(line_art), 1) / 1024, sum(noise) / max(len(noise), 1) / 1024))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindleunpack.mobi_uncompress import HuffcdicReader
+from tests.test_huffcdic import ReferenceHuffcdicReader, load_reader, random_book
+
+USAGE = """
+Throughput of HUFF/CDIC decoding of a generated book, compared to the recursive reference decoder.
+
+Usage:
+ bench_huffcdic.py [--records=N] [--phrases=N] [--seed=N]
+
+--records=N Number of text records, default 2000
+--phrases=N Number of dictionary phrases, default 20000
+--seed=N    Random seed of the generated book, default 1
+"""
+
+
+def main(args):
+    records = 2000
+    phrases = 20000
+    seed = 1
+    for arg in args[1:]:
+        if arg.startswith('--records='):
+            records = int(arg[10:])
+        elif arg.startswith('--phrases='):
+            phrases = int(arg[10:])
+        elif arg.startswith('--seed='):
+            seed = int(arg[7:])
+        else:
+            print(USAGE)
+            return
+
+    huff, cdics, data, expected = random_book(random.Random(seed), phrases, records, 200)
+    size = sum(len(x) for x in expected)
+    print('{} records, {} phrases, {} bytes of text'.format(records, phrases, size))
+
+    for name, cls in [('reference', ReferenceHuffcdicReader), ('HuffcdicReader', HuffcdicReader)]:
+        # Phrases are expanded on first use, so each run starts from a new reader
+        best = None
+        for _ in range(3):
+            reader = load_reader(cls, huff, cdics)
+            start = time.perf_counter()
+            output = [reader.unpack(x) for x in data]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        assert output == expected
+        print('{:14} {:.3f}s {:.1f} MB/s'.format(name, best, size / best / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindleunpack.mobi_k8proc import K8Processor
+
+USAGE = """
+Time to look up the fragment and the part at random positions of a generated KF8 layout,
+with the bisect indexes of K8Processor compared to scanning the tables as before.
+
+Usage:
+ bench_k8proc_lookup.py [--parts=N] [--fragments=N] [--lookups=N] [--seed=N]
+
+--parts=N     Number of parts, default 2000
+--fragments=N Number of fragments per part, default 3
+--lookups=N   Number of positions looked up, default 20000
+--seed=N      Random seed, default 1
+"""
+
+
+# Fragment and part lookups before the bisect indexes, scanning the tables
+class ReferenceK8Processor(K8Processor):
+
+    def getFragTblInfo(self, pos):
+        for j in range(len(self.fragtbl)):
+            [insertpos, idtext, filenum, seqnum, startpos, length] = self.fragtbl[j]
+            if pos >= insertpos and pos < (insertpos + length):
+                return seqnum, b'in: ' + idtext
+            if pos < insertpos:
+                return seqnum, b'before: ' + idtext
+        return None, None
+
+    def getFileInfo(self, pos):
+        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
+            if pos >= start and pos < end:
+                return filename, partnum, start, end
+        return None, None, None, None
+
+
+# Processor with the fragment and part tables only, as buildParts leaves them
+def make_processor(cls, fragtbl, partinfo):
+    proc = cls.__new__(cls)
+    proc.fragtbl = fragtbl
+    proc.partinfo = partinfo
+    proc.fragends = None
+    proc.partstarts = None
+    return proc
+
+
+def generate_layout(rnd, parts, fragments):
+    fragtbl = []
+    partinfo = []
+    pos = 0
+    for partnum in range(parts):
+        start = pos
+        # skeleton head, then fragments with a little skeleton text between them
+        pos += rnd.randint(200, 600)
+        for _ in range(fragments):
+            length = rnd.randint(500, 5000)
+            fragtbl.append([pos, b'P-//*[@aid=\'%d\']' % len(fragtbl), partnum, len(fragtbl), 0, length])
+            pos += length + rnd.randint(0, 50)
+        pos += rnd.randint(20, 100)
+        partinfo.append([partnum, 'Text', 'part%04d.xhtml' % partnum, start, pos, None])
+    return fragtbl, partinfo, pos
+
+
+def lookup_all(proc, positions):
+    return [(proc.getFragTblInfo(pos), proc.getFileInfo(pos)) for pos in positions]
+
+
+def main(args):
+    parts = 2000
+    fragments = 3
+    lookups = 20000
+    seed = 1
+    for arg in args[1:]:
+        if arg.startswith('--parts='):
+            parts = int(arg[8:])
+        elif arg.startswith('--fragments='):
+            fragments = int(arg[12:])
+        elif arg.startswith('--lookups='):
+            lookups = int(arg[10:])
+        elif arg.startswith('--seed='):
+            seed = int(arg[7:])
+        else:
+            print(USAGE)
+            return
+
+    rnd = random.Random(seed)
+    fragtbl, partinfo, size = generate_layout(rnd, parts, fragments)
+    # a few positions past the end of the text
+    positions = [rnd.randrange(size + size // 100) for _ in range(lookups)]
+    print('{} parts, {} fragments, {} lookups'.format(len(partinfo), len(fragtbl), lookups))
+
+    results = []
+    for name, cls in [('reference', ReferenceK8Processor), ('bisect', K8Processor)]:
+        proc = make_processor(cls, fragtbl, partinfo)
+        start = time.perf_counter()
+        results.append(lookup_all(proc, positions))
+        print('{:10} {:.2f}s'.format(name, time.perf_counter() - start))
+    assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    main(sys.argv)
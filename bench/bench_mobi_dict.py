@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindleunpack.mobi_html import HTMLProcessor
+from tests.test_mobi_dict import Dictionary
+
+USAGE = """
+Unpack time and peak memory of a generated dictionary: building the position map from the
+orth and inflection indexes and inserting it with the link anchors into the text. The output
+is checked against the markup decoded from the orth index in the simplest way.
+
+Usage:
+ bench_mobi_dict.py [--entries=N] [--groups=N] [--rules=N]
+
+--entries=N Number of headwords, default 200000
+--groups=N  Number of inflection groups, default 3000
+--rules=N   Number of inflection rules, default 400
+"""
+
+
+# Text covering all entry positions, with a filepos link every few thousand bytes
+def raw_text(length):
+    rnd = random.Random(1)
+    text = bytearray()
+    while len(text) < length:
+        text += b'<p>' + b'x' * rnd.randint(1000, 5000) + b'</p>'
+        text += b'<a filepos=%d>' % rnd.randrange(length) + b'link</a>'
+    return bytes(text)
+
+
+# Text merged with the expected position map and the link anchors
+def reference_merge(dictionary, rawtext):
+    positionMap = dictionary.expected_position_map()
+    for m in re.finditer(br'<a filepos=(\d+)>', rawtext):
+        position = int(m.group(1))
+        positionMap.setdefault(position, []).append(b'<a id="filepos%d" />' % position)
+    pieces = []
+    pos = 0
+    for end in sorted(positionMap):
+        if 0 < end <= len(rawtext):
+            pieces.append(rawtext[pos:end])
+            pieces.extend(positionMap[end])
+            pos = end
+    pieces.append(rawtext[pos:])
+    return b''.join(pieces)
+
+
+def unpack(dictionary, rawtext):
+    positionMap = dictionary.position_map()
+    return HTMLProcessor([], {}, []).findAnchors(rawtext, None, positionMap)
+
+
+def measure(func, runs=3):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            output = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    output = None
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        output = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, output
+
+
+def main(args):
+    entries = 200000
+    groups = 3000
+    rules = 400
+    for arg in args[1:]:
+        if arg.startswith('--entries='):
+            entries = int(arg[10:])
+        elif arg.startswith('--groups='):
+            groups = int(arg[9:])
+        elif arg.startswith('--rules='):
+            rules = int(arg[8:])
+        else:
+            print(USAGE)
+            return
+
+    dictionary = Dictionary(entries, groups, rules)
+    # Entries end at most 3000 bytes after the last start position
+    rawtext = raw_text(max(dictionary.expected_position_map()) + 3000)
+    print('{} entries, {} groups, {} rules, text {} bytes'.format(entries, groups, rules, len(rawtext)))
+
+    unpack_time, unpack_peak, output = measure(lambda: unpack(dictionary, rawtext))
+    assert output == reference_merge(dictionary, rawtext)
+    print('output {} bytes'.format(len(output)))
+    print('unpack {:.2f}s, peak traced memory {:.1f} MB'.format(unpack_time, unpack_peak / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
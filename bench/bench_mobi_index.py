@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindleunpack.mobi_index import MobiIndex
+from tests.test_mobi_index import Sections, build_orth_index, reference_index_data
+
+USAGE = """
+Decoding time of a generated dictionary orth index, compared to decoding one entry at a time
+with the getTagMap from before the tag plans.
+
+Usage:
+ bench_mobi_index.py [--entries=N] [--seed=N]
+
+--entries=N Number of headwords, default 200000
+--seed=N    Random seed of the generated index, default 1
+"""
+
+
+def best_time(func, runs=3):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def main(args):
+    entries = 200000
+    seed = 1
+    for arg in args[1:]:
+        if arg.startswith('--entries='):
+            entries = int(arg[10:])
+        elif arg.startswith('--seed='):
+            seed = int(arg[7:])
+        else:
+            print(USAGE)
+            return
+
+    sections = build_orth_index(entries, seed)
+    print('{} entries in {} sections, {} bytes'.format(entries, len(sections) - 1, sum(len(x) for x in sections)))
+
+    reference_time, expected = best_time(lambda: reference_index_data(sections))
+    index_time, (output, _) = best_time(lambda: MobiIndex(Sections(sections)).getIndexData(0, 'bench'))
+    assert output == expected
+    print('{:14} {:.2f}s'.format('reference', reference_time))
+    print('{:14} {:.2f}s'.format('getIndexData', index_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
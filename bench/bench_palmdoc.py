@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindleunpack.mobi_uncompress import PalmdocReader
+from tests.test_palmdoc import palmdoc_compress, palmdoc_reference_unpack
+
+USAGE = """
+Throughput of PalmDOC decoding of 4K records, compared to the byte by byte reference decoder.
+
+Usage:
+ bench_palmdoc.py [--repeat=N] [file]
+
+file       Source text to compress, default is kindleunpack/kindleunpack.py
+--repeat=N Number of copies of the text, default 4
+"""
+
+
+def best_time(func, records, runs=3):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = b''.join(func(record) for record in records)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def main(args):
+    repeat = 4
+    source = os.path.join(ROOT, 'kindleunpack', 'kindleunpack.py')
+    for arg in args[1:]:
+        if arg.startswith('--repeat='):
+            repeat = int(arg[9:])
+        elif arg.startswith('--'):
+            print(USAGE)
+            return
+        else:
+            source = arg
+
+    with open(source, 'rb') as f:
+        text = f.read() * repeat
+    records = [palmdoc_compress(text[x:x + 4096]) for x in range(0, len(text), 4096)]
+    print('{} records, {} bytes, compression ratio {:.2f}'.format(
+        len(records), len(text), sum(len(x) for x in records) / len(text)))
+
+    for name, func in [('reference', palmdoc_reference_unpack), ('PalmdocReader', PalmdocReader().unpack)]:
+        elapsed, output = best_time(func, records)
+        assert output == text
+        print('{:14} {:.3f}s {:.1f} MB/s'.format(name, elapsed, len(text) / elapsed / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from comicbook import MemoryPage
+from pdfwriter import PDFWriter, linearize_pdf, check_linearization
+
+USAGE = """
+Time to first page of a PDF served over a throttled HTTP connection, linearized versus not.
+
+The PDF is served from a local server with byte-range support, adding latency to each
+request and limiting bandwidth. Two readers are simulated:
+
+sequential  Download from the start of the file, like a viewer without range requests.
+            Linearized PDF can show the first page once its first page section has arrived,
+            other PDF only when the cross-reference table at the end has arrived.
+range       Fetch only what is needed with range requests, one object after the other:
+            linearized PDF needs the head of the file up to the end of the first page section,
+            other PDF needs the trailer, the cross-reference table, catalog, page tree,
+            page, contents and image.
+
+Usage:
+ bench_pdf_first_page.py [--pages=N] [--latency=MS] [--bandwidth=KB] [file.pdf]
+
+file.pdf       PDF to test, default is generated from random JPEG pages
+--pages=N      Number of generated pages, default 20
+--latency=MS   Latency added to each request in milliseconds, default 100
+--bandwidth=KB Bandwidth in kilobytes per second, default 1000
+"""
+
+CHUNK = 16384
+
+
+class ThrottledHandler(BaseHTTPRequestHandler):
+    # Set on the server: data, latency (seconds), bandwidth (bytes per second)
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = 0, len(data)
+        status = 200
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            first, last = re.match(r'bytes=(\d*)-(\d*)$', byte_range).groups()
+            if first:
+                start = int(first)
+                end = min(int(last) + 1, len(data)) if last else len(data)
+            else:
+                start = max(0, len(data) - int(last))
+            status = 206
+
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(data)))
+        self.end_headers()
+        for pos in range(start, end, CHUNK):
+            chunk = data[pos:min(pos + CHUNK, end)]
+            time.sleep(len(chunk) / self.server.bandwidth)
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(data, latency, bandwidth):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ThrottledHandler)
+    server.data = data
+    server.latency = latency
+    server.bandwidth = bandwidth
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fetch(url, start=None, end=None):
+    request = urllib.request.Request(url)
+    if start is not None:
+        request.add_header('Range', 'bytes={}-{}'.format(start, '' if end is None else end - 1))
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+# Last bytes of the file, and the file size
+def fetch_tail(url, length):
+    request = urllib.request.Request(url)
+    request.add_header('Range', 'bytes=-{}'.format(length))
+    with urllib.request.urlopen(request) as response:
+        return response.read(), int(response.headers['Content-Range'].rsplit('/', 1)[1])
+
+
+def linearized_first_page_end(head):
+    match = re.search(rb'/Linearized\b.*?/E (\d+)', head, re.S)
+    return int(match.group(1)) if match else None
+
+
+def read_sequential(url):
+    """Bytes to download from the start before the first page can be shown"""
+    request = urllib.request.Request(url)
+    received = bytearray()
+    with urllib.request.urlopen(request) as response:
+        size = int(response.headers['Content-Length'])
+        needed = size
+        while len(received) < needed:
+            chunk = response.read(min(CHUNK, needed - len(received)))
+            if not chunk:
+                break
+            received += chunk
+            if needed == size and len(received) >= 1024:
+                needed = linearized_first_page_end(bytes(received[:1024])) or size
+    return min(needed, size)
+
+
+def read_range(url):
+    """Bytes fetched with range requests before the first page can be shown"""
+    head = fetch(url, 0, 1024)
+    first_page_end = linearized_first_page_end(head)
+    if first_page_end is not None:
+        return len(head) + len(fetch(url, len(head), first_page_end))
+
+    tail, file_size = fetch_tail(url, 1024)
+    total = len(head) + len(tail)
+    xref = int(re.search(rb'startxref\s+(\d+)', tail).group(1))
+    tail_start = file_size - len(tail)
+    if xref < tail_start:
+        table = fetch(url, xref, tail_start)
+        total += len(table)
+        table += tail
+    else:
+        table = tail[xref - tail_start:]
+
+    offsets = {}
+    section = re.search(rb'xref\s+(\d+) (\d+)\s+', table)
+    first = int(section.group(1))
+    for idx, entry in enumerate(re.findall(rb'(\d{10}) \d{5} ([nf])', table[section.end():])):
+        if entry[1] == b'n':
+            offsets[first + idx] = int(entry[0])
+    ends = sorted(offsets.values()) + [xref]
+
+    def read_object(num):
+        nonlocal total
+        start = offsets[num]
+        end = ends[ends.index(start) + 1]
+        data = fetch(url, start, end)
+        total += len(data)
+        return data
+
+    root = int(re.search(rb'/Root (\d+) 0 R', table).group(1))
+    pages = int(re.search(rb'/Pages (\d+) 0 R', read_object(root)).group(1))
+    page = int(re.search(rb'/Kids \[\s*(\d+) 0 R', read_object(pages)).group(1))
+    page_object = read_object(page)
+    for ref in re.findall(rb'/(?:Contents|Im0) (\d+) 0 R', page_object):
+        read_object(int(ref))
+    return total
+
+
+def generate_pdf(file, pages):
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(1)
+    with PDFWriter(file) as pdf:
+        for idx in range(pages):
+            im = Image.new('L', (1200, 1800), 255)
+            draw = ImageDraw.Draw(im)
+            for _ in range(400):
+                draw.line([(rnd.randrange(1200), rnd.randrange(1800)) for _ in range(2)],
+                          fill=rnd.randrange(256), width=rnd.randint(1, 4))
+            buffer = io.BytesIO()
+            im.save(buffer, 'JPEG', quality=85)
+            pdf.add_page(MemoryPage('{:03d}.jpg'.format(idx), buffer.getvalue()))
+
+
+def main(args):
+    pages = 20
+    latency = 0.1
+    bandwidth = 1000 * 1000
+    source = None
+    for arg in args[1:]:
+        if arg.startswith('--pages='):
+            pages = int(arg[8:])
+        elif arg.startswith('--latency='):
+            latency = int(arg[10:]) / 1000
+        elif arg.startswith('--bandwidth='):
+            bandwidth = int(arg[12:]) * 1000
+        elif arg.startswith('--'):
+            print(USAGE)
+            return
+        else:
+            source = arg
+
+    tmp = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(tmp, 'plain.pdf')
+        linearized = os.path.join(tmp, 'linearized.pdf')
+        if source is None:
+            generate_pdf(plain, pages)
+        else:
+            shutil.copyfile(source, plain)
+        shutil.copyfile(plain, linearized)
+        linearize_pdf(linearized)
+        assert check_linearization(linearized)
+
+        print('latency {:.0f}ms, bandwidth {:.0f} KB/s'.format(latency * 1000, bandwidth / 1000))
+        for name, file in [('not linearized', plain), ('linearized', linearized)]:
+            with open(file, 'rb') as f:
+                data = f.read()
+            server = serve(data, latency, bandwidth)
+            url = 'http://127.0.0.1:{}/book.pdf'.format(server.server_address[1])
+            try:
+                for mode, reader in [('sequential', read_sequential), ('range', read_range)]:
+                    start = time.perf_counter()
+                    received = reader(url)
+                    elapsed = time.perf_counter() - start
+                    print('{:15} {:10} {:6.2f}s {:9} of {} bytes'.format(name, mode, elapsed, received, len(data)))
+            finally:
+                server.shutdown()
+                server.server_close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from kindleunpack.mobi_header import trimTrailingDataEntries
+from kindleunpack.mobi_uncompress import PalmdocReader, HuffcdicReader
+from tests.test_huffcdic import load_reader, random_book
+from tests.test_palmdoc import palmdoc_compress, random_text
+
+USAGE = """
+Decoding time of MOBI text records in the current process and in a worker pool,
+for a range of record counts, to find the book size where the pool starts to pay off.
+Pool start up is included, as the unpacker would pay it once per book.
+
+Usage:
+ bench_text_records.py [--workers=N] [--counts=N,N,...] [--start=METHOD]
+
+--workers=N   Pool size, default is the number of CPUs
+--counts=...  Record counts, default 64,256,1024,4096
+--start=...   Process start method, fork (default on Linux) or spawn (Windows and macOS)
+"""
+
+# A single trailing entry of one byte, as most books have
+TRAILERS = 1
+
+_worker_unpack = None
+
+
+def _init_worker(unpack):
+    global _worker_unpack
+    _worker_unpack = unpack
+
+
+def _unpack_batch(records):
+    return [_worker_unpack(trimTrailingDataEntries(x, TRAILERS, False)) for x in records]
+
+
+def unpack_serial(unpack, records, workers, context):
+    return [unpack(trimTrailingDataEntries(x, TRAILERS, False)) for x in records]
+
+
+def unpack_pool(unpack, records, workers, context):
+    size = -(-len(records) // (workers * 4))
+    batches = [records[i:i + size] for i in range(0, len(records), size)]
+    with context.Pool(workers, _init_worker, (unpack,)) as pool:
+        results = pool.map(_unpack_batch, batches)
+    return [x for batch in results for x in batch]
+
+
+def palmdoc_records(rnd, count):
+    # Compressing is slow, so the records repeat
+    records = [palmdoc_compress(random_text(rnd, 4096)) + b'\x81' for _ in range(min(count, 64))]
+    return PalmdocReader().unpack, [records[i % len(records)] for i in range(count)]
+
+
+def huffcdic_records(rnd, count):
+    huff, cdics, records, _ = random_book(rnd, 20000, count, 200)
+    return load_reader(HuffcdicReader, huff, cdics).unpack, [x + b'\x81' for x in records]
+
+
+def main(args):
+    workers = os.cpu_count()
+    counts = [64, 256, 1024, 4096]
+    context = multiprocessing.get_context()
+    for arg in args[1:]:
+        if arg.startswith('--workers='):
+            workers = int(arg[10:])
+        elif arg.startswith('--counts='):
+            counts = [int(x) for x in arg[9:].split(',')]
+        elif arg.startswith('--start='):
+            context = multiprocessing.get_context(arg[8:])
+        else:
+            print(USAGE)
+            return
+
+    print('{} CPUs, pool of {} workers, {} start'.format(os.cpu_count(), workers, context.get_start_method()))
+    print('{:10} {:>7} {:>9} {:>9}'.format('codec', 'records', 'serial', 'pool'))
+    for name, make_records in [('palmdoc', palmdoc_records), ('huffcdic', huffcdic_records)]:
+        for count in counts:
+            unpack, records = make_records(random.Random(count), count)
+            times = []
+            outputs = []
+            for func in [unpack_serial, unpack_pool]:
+                best = None
+                for _ in range(3):
+                    start = time.perf_counter()
+                    output = func(unpack, records, workers, context)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                times.append(best)
+                outputs.append(output)
+            assert outputs[0] == outputs[1]
+            print('{:10} {:7} {:8.3f}s {:8.3f}s'.format(name, count, *times))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
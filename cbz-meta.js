@@ -57,7 +57,7 @@ function MetaItem ({ title, meta, value, setValue }) {
   `
 }
 
-function BookmarkItem ({ title, page, setPage, focusRef, edit, remove }) {
+function BookmarkItem ({ title, page, thumb, setPage, focusRef, edit, remove }) {
   const defocus = (e) => {
     if (e.key === 'Enter') {
       e.target.blur()
@@ -65,7 +65,7 @@ function BookmarkItem ({ title, page, setPage, focusRef, edit, remove }) {
     }
   }
   return html`
-      <li key="${page}"><label>#${page}: <input value="${title}"
+      <li key="${page}"><label>${thumb && html`<img class="thumb" src="${thumb}" loading="lazy"/>`}#${page}: <input value="${title}"
                                                 oninput="${(e) => {edit(page, e.target.value)}}" ref="${focusRef}"
                                                 onkeydown="${defocus}"/>
           <button onclick="${() => {setPage(page)}}">→</button>
@@ -84,6 +84,8 @@ function App () {
   const fileSel = useRef(null)
   const toFocus = useRef(null)
   const [lastBook, setLastBook] = useState(-1)
+  // Served by script-cbz-meta.py, pages are loaded from the server on demand
+  const [server, setServer] = useState(false)
 
   const sorted_keys = Object.keys(bookmarks).map(x => +x)
   sorted_keys.sort((a, b) => a - b)
@@ -206,6 +208,30 @@ function App () {
     }
   }, [setPage, setMeta, setBookmarks, setFname, setImages])
 
+  const loadServer = useCallback(async () => {
+    try {
+      const response = await fetch('api/book')
+      if (!response.ok) {
+        return
+      }
+      const book = await response.json()
+
+      setServer(true)
+      setFname(book.name)
+      setImages(book.pages.map((p, i) => [p.name, `api/page/${i}`, null, `api/thumb/${i}`]))
+      setPage(0)
+      if (book.comicinfo) {
+        readXML(book.comicinfo)
+      }
+    } catch (e) {
+      // Not served by script-cbz-meta.py, use file picker instead
+    }
+  }, [setServer, setFname, setImages, setPage])
+
+  useEffect(() => {
+    loadServer()
+  }, [])
+
   const filePicked = useCallback(() => {
     const selectedFile = fileSel.current.files[0]
     setFname(selectedFile.name)
@@ -214,10 +240,24 @@ function App () {
   }, [fileSel])
 
   const saveFile = async () => {
+    if (server) {
+      // Only the metadata is sent, the server update the file in place
+      const response = await fetch('api/comicinfo', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/xml' },
+        body: generateXML()
+      })
+      if (!response.ok) {
+        alert('Cannot save metadata')
+      }
+      return
+    }
+
     const blobWriter = new zip.BlobWriter('application/zip')
     const writer = new zip.ZipWriter(blobWriter, { extendedTimestamp: false })
+    // Images are already compressed, store them as-is instead of deflating again
     for (const img of images) {
-      await writer.add(img[0], new zip.BlobReader(img[2]))
+      await writer.add(img[0], new zip.BlobReader(img[2]), { level: 0 })
     }
     await writer.add('ComicInfo.xml', new zip.TextReader(generateXML()))
     await writer.close()
@@ -287,7 +327,7 @@ function App () {
           <section>
               <h2>File</h2>
               <div>Current file: ${fname || 'None'}</div>
-              <div><input type="file" ref="${fileSel}" oninput="${filePicked}" accept=".zip,.cbz"/></div>
+              ${!server && html`<div><input type="file" ref="${fileSel}" oninput="${filePicked}" accept=".zip,.cbz"/></div>`}
               <div>
                   <button onclick="${saveFile}">Save</button>
               </div>
@@ -304,11 +344,13 @@ function App () {
                           key === lastBook ?
                                   html`
                                       <${BookmarkItem} title="${bookmarks[key]}" page="${key}"
+                                                       thumb="${images[key] && images[key][3]}"
                                                        setPage="${doSetPage}"
                                                        edit="${editBookmark}" focusRef="${toFocus}"
                                                        remove="${removeBookmark}"/>` :
                                   html`
                                       <${BookmarkItem} title="${bookmarks[key]}" page="${key}"
+                                                       thumb="${images[key] && images[key][3]}"
                                                        setPage="${doSetPage}"
                                                        edit="${editBookmark}" remove="${removeBookmark}"/>`
                   )}
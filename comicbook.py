@@ -2,7 +2,15 @@
 
 import tempfile
 import os
-import sys
+import io
+import re
+import struct
+import hashlib
+import functools
+import posixpath
+import bisect
+import collections
+import contextlib
 from lxml import etree
 import zipfile
 import json
@@ -10,6 +18,13 @@ from datetime import datetime
 import glob
 
 import kindleunpack.kindleunpack
+from kindleunpack.mobi_sectioner import Sectionizer
+from kindleunpack.mobi_header import MobiHeader
+from kindleunpack.mobi_k8proc import K8Processor
+from kindleunpack.mobi_k8resc import K8RESCProcessor
+from kindleunpack.mobi_ncx import ncxExtract
+from kindleunpack.mobi_cover import get_image_type
+from kindleunpack.mobi_utils import fromBase32
 
 
 def parse_xml(file):
@@ -81,11 +96,11 @@ class ComicMetadata:
                 'role': 'artist'
             })
 
-        for tag in root.findall('.//meta'):
+        for tag in root.findall('.//opf:meta', xmlns) + root.findall('.//meta'):
             if tag.get('name') == 'calibre:series':
                 self.series = tag.get('content')
             if tag.get('name') == 'calibre:series_index':
-                self.volume = int(float(tag.get['content']))
+                self.volume = int(float(tag.get('content')))
 
         date = read_from_xml('dc:date')
         if date:
@@ -94,6 +109,108 @@ class ComicMetadata:
             self.year = dt.year
             self.month = dt.month
 
+    # Update metadata of EPUB OPF file in LXML ETree, keeping everything else as is
+    def update_opf_tree(self, tree, direction=None):
+        root = tree.getroot()
+
+        xmlns = {
+            'opf': 'http://www.idpf.org/2007/opf',
+            'dc': 'http://purl.org/dc/elements/1.1/',
+        }
+
+        metadata = root.find('.//opf:metadata', xmlns)
+        if metadata is None:
+            metadata = etree.SubElement(root, '{{{}}}metadata'.format(xmlns['opf']))
+
+        def set_to_xml(tag_name, values, attrib=None):
+            for elem in metadata.findall('./{}'.format(tag_name), xmlns):
+                metadata.remove(elem)
+            prefix, name = tag_name.split(':')
+            for value in values:
+                elem = etree.SubElement(metadata, '{{{}}}{}'.format(xmlns[prefix], name), attrib=attrib)
+                elem.text = str(value)
+
+        set_to_xml('dc:title', [self.title] if self.title else [])
+        set_to_xml('dc:creator', [x['person'] for x in self.credits],
+                   attrib={'{{{}}}role'.format(xmlns['opf']): 'aut'})
+        set_to_xml('dc:publisher', [self.publisher] if self.publisher else [])
+        set_to_xml('dc:language', [self.language] if self.language else [])
+        set_to_xml('dc:description', [self.summary] if self.summary else [])
+        if self.year:
+            set_to_xml('dc:date', [datetime(self.year, self.month or 1, 1).isoformat()])
+
+        def set_meta(name, content):
+            for tag in metadata.findall('./opf:meta', xmlns) + metadata.findall('./meta'):
+                if tag.get('name') == name:
+                    metadata.remove(tag)
+            etree.SubElement(metadata, '{{{}}}meta'.format(xmlns['opf']), name=name, content=content)
+
+        if self.series:
+            set_meta('calibre:series', self.series)
+        if self.volume is not None:
+            set_meta('calibre:series_index', str(self.volume))
+
+        if direction is not None:
+            spine = root.find('.//opf:spine', xmlns)
+            if spine is not None:
+                spine.set('page-progression-direction', 'rtl' if direction == -1 else 'ltr')
+            for tag in metadata.findall('./opf:meta', xmlns) + metadata.findall('./meta'):
+                if tag.get('name') == 'primary-writing-mode':
+                    tag.set('content', 'vertical-rl' if direction == -1 else 'horizontal-lr')
+
+        return tree
+
+    # Replace the navigation map of EPUB NCX file in LXML ETree.
+    # page_files is the page (href relative to NCX) of each image.
+    def update_ncx_tree(self, tree, page_files):
+        root = tree.getroot()
+        ns = 'http://www.daisy.org/z3986/2005/ncx/'
+
+        nav_map = root.find('./{{{}}}navMap'.format(ns))
+        if nav_map is None:
+            nav_map = etree.SubElement(root, '{{{}}}navMap'.format(ns))
+        for elem in list(nav_map):
+            nav_map.remove(elem)
+
+        for idx, [page, title] in enumerate(self.toc):
+            if page >= len(page_files):
+                continue
+            nav_point = etree.SubElement(nav_map, '{{{}}}navPoint'.format(ns), id='np_{}'.format(idx + 1),
+                                         playOrder=str(idx + 1))
+            nav_label = etree.SubElement(nav_point, '{{{}}}navLabel'.format(ns))
+            etree.SubElement(nav_label, '{{{}}}text'.format(ns)).text = title
+            etree.SubElement(nav_point, '{{{}}}content'.format(ns), src=page_files[page])
+
+        return tree
+
+    # Read from metadata dictionary of kindleunpack's MobiHeader
+    def read_mobi_metadata(self, metadata):
+        def read_from_metadata(name):
+            if name in metadata and len(metadata[name]) > 0:
+                return metadata[name][0]
+            return None
+
+        self.title = read_from_metadata('Updated_Title') or read_from_metadata('Title')
+        self.publisher = read_from_metadata('Publisher')
+        self.language = read_from_metadata('Language')
+        self.summary = read_from_metadata('Description')
+
+        for person in metadata.get('Creator', []):
+            self.credits.append({
+                'person': person,
+                'role': 'artist'
+            })
+
+        date = read_from_metadata('Published')
+        if date:
+            try:
+                dt = datetime.fromisoformat(date)
+            except ValueError:
+                return
+
+            self.year = dt.year
+            self.month = dt.month
+
     def read_ncx(self, tree, images_list):
         # Table of content
         toc = []
@@ -114,6 +231,10 @@ class ComicMetadata:
 
         toc.sort(key=lambda x: int(x[2]))
 
+        self.read_toc(toc, images_list)
+
+    # Map list of (title, page file) to the index of first image of that page
+    def read_toc(self, toc, images_list):
         if len(toc) == 0:
             return []
 
@@ -147,13 +268,19 @@ class ComicMetadata:
 
         def read_from_xml(tag):
             el = root.find('.//{}'.format(tag))
-            if el is not None and len(el) > 0:
+            if el is not None and el.text:
                 return el.text
             return None
 
+        def read_int_from_xml(tag):
+            value = read_from_xml(tag)
+            if value is not None and value.strip().isdigit():
+                return int(value)
+            return None
+
         def read_credit(tag, role):
             el = root.find('.//{}'.format(tag))
-            if el is not None and len(el) > 0:
+            if el is not None and el.text:
                 self.credits.append({
                     'person': el.text,
                     'role': role
@@ -161,10 +288,10 @@ class ComicMetadata:
 
         self.title = read_from_xml('Title')
         self.series = read_from_xml('Series')
-        self.volume = read_from_xml('Volume')
-        self.count = read_from_xml('Count')
-        self.year = read_from_xml('Year')
-        self.month = read_from_xml('Month')
+        self.volume = read_int_from_xml('Volume')
+        self.count = read_int_from_xml('Count')
+        self.year = read_int_from_xml('Year')
+        self.month = read_int_from_xml('Month')
         self.publisher = read_from_xml('Publisher')
         self.language = read_from_xml('LanguageISO')
         self.summary = read_from_xml('Summary')
@@ -179,11 +306,14 @@ class ComicMetadata:
         read_credit('Editor', 'Editor')
 
         self.toc = []
-        for elem in root.findall('.//Page'):
+        # Older version of this tool wrote <Pages> instead of <Page> for each page
+        for elem in root.findall('./Pages/Page') + root.findall('./Pages/Pages'):
             if elem.get('Bookmark'):
                 self.toc.append([int(elem.get('Image')), elem.get('Bookmark')])
 
     def generate_comicinfoxml(self):
+        from xml.sax.saxutils import escape
+
         xml = '<?xml version="1.0" encoding="utf-8"?>\n'
         xml += '<ComicInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
         if self.title:
@@ -224,7 +354,7 @@ class ComicMetadata:
         if len(self.toc) > 0:
             xml += '\t<Pages>\n'
             for item in self.toc:
-                xml += '\t\t<Pages Image="{}" Bookmark="{}"/>\n'.format(item[0], item[1])
+                xml += '\t\t<Page Image="{}" Bookmark="{}"/>\n'.format(item[0], escape(str(item[1]), {'"': '&quot;'}))
             xml += '\t</Pages>\n'
 
         xml += '</ComicInfo>\n'
@@ -309,17 +439,351 @@ class ComicMetadata:
         return json.dumps(container)
 
 
+# Per-page information index, filled by the processor or by reading image header
+PageInfo = collections.namedtuple('PageInfo', ['format', 'width', 'height', 'mode', 'size', 'hash'])
+
+# Image format: (file extension, media type)
+IMAGE_TYPES = {
+    'jpeg': ('jpg', 'image/jpeg'),
+    'png': ('png', 'image/png'),
+    'gif': ('gif', 'image/gif'),
+    'bmp': ('bmp', 'image/bmp'),
+    'webp': ('webp', 'image/webp'),
+    'avif': ('avif', 'image/avif'),
+    'jxl': ('jxl', 'image/jxl'),
+}
+
+
+def probe_image(fp):
+    """Read image format, size and mode from the header of image file object.
+    Return (format, width, height, mode) or None if the format is not known."""
+    head = fp.read(32)
+
+    if head[0:8] == b'\x89PNG\r\n\x1a\n':
+        width, height, depth, color = struct.unpack('>LLBB', head[16:26])
+        mode = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}.get(color)
+        return 'png', width, height, '1' if color == 0 and depth == 1 else mode
+    if head[0:6] in [b'GIF87a', b'GIF89a']:
+        width, height = struct.unpack('<HH', head[6:10])
+        return 'gif', width, height, 'P'
+    if head[0:2] == b'BM':
+        width, height, _, bits = struct.unpack('<iiHH', head[18:30])
+        return 'bmp', width, abs(height), 'P' if bits <= 8 else 'RGBA' if bits == 32 else 'RGB'
+    if head[0:4] == b'RIFF' and head[8:12] == b'WEBP':
+        if head[12:16] == b'VP8 ':
+            width, height = struct.unpack('<HH', head[26:30])
+            return 'webp', width & 0x3fff, height & 0x3fff, 'RGB'
+        if head[12:16] == b'VP8L':
+            bits = int.from_bytes(head[21:25], 'little')
+            return 'webp', (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1, 'RGBA' if bits & (1 << 28) else 'RGB'
+        if head[12:16] == b'VP8X':
+            width = int.from_bytes(head[24:27], 'little') + 1
+            height = int.from_bytes(head[27:30], 'little') + 1
+            return 'webp', width, height, 'RGBA' if head[20] & 0x10 else 'RGB'
+        return None
+    if head[0:2] != b'\xff\xd8':
+        return None
+
+    # Walk JPEG markers until the start of frame
+    fp.seek(2)
+    while True:
+        byte = fp.read(1)
+        while byte and byte != b'\xff':
+            byte = fp.read(1)
+        while byte == b'\xff':
+            byte = fp.read(1)
+        if not byte:
+            return None
+
+        marker = ord(byte)
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            continue
+        if 0xc0 <= marker <= 0xcf and marker not in [0xc4, 0xc8, 0xcc]:
+            _, _, height, width, components = struct.unpack('>HBHHB', fp.read(8))
+            return 'jpeg', width, height, {1: 'L', 3: 'RGB', 4: 'CMYK'}.get(components)
+
+        length, = struct.unpack('>H', fp.read(2))
+        fp.seek(length - 2, 1)
+
+
+class Page:
+    """
+    Handle to a single page image. Image data is only read when needed.
+    """
+
+    # Set to the original page if this page is the same image as an earlier page
+    duplicate_of = None
+
+    def __init__(self, name):
+        self.name = name
+        self._info = None
+        self._hash = None
+
+    def open(self):
+        raise NotImplementedError()
+
+    def read(self):
+        with self.open() as fp:
+            return fp.read()
+
+    def size(self):
+        return len(self.read())
+
+    # Return (format, width, height, mode) from the image header
+    def probe(self):
+        with self.open() as fp:
+            result = probe_image(fp)
+            if result is None:
+                from PIL import Image
+
+                fp.seek(0)
+                with Image.open(fp) as im:
+                    result = (im.format.lower(), im.width, im.height, im.mode)
+        return result
+
+    def hash(self):
+        if self._hash is None and self._info is not None:
+            self._hash = self._info.hash
+        if self._hash is None:
+            h = hashlib.sha1()
+            with self.open() as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    h.update(chunk)
+            self._hash = h.hexdigest()
+        return self._hash
+
+    # Page information, only read from the image header if not known already.
+    # Hash is not calculated by the probe and is left as None.
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = PageInfo(*self.probe(), self.size(), self._hash)
+        return self._info
+
+    @info.setter
+    def info(self, value):
+        self._info = value
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.name)
+
+
+class FilePage(Page):
+    def __init__(self, file):
+        super().__init__(os.path.basename(file))
+        self.file = file
+
+    def open(self):
+        return open(self.file, 'rb')
+
+    def size(self):
+        return os.path.getsize(self.file)
+
+
+class MemoryPage(Page):
+    def __init__(self, name, data):
+        super().__init__(name)
+        self.data = data
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+    def read(self):
+        return self.data
+
+    def size(self):
+        return len(self.data)
+
+
+class FileRangePage(Page):
+    """
+    Image stored as-is at some offset of a bigger file, e.g. a section of AZW3.
+    """
+
+    def __init__(self, name, file, offset, length):
+        super().__init__(name)
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def open(self):
+        return io.BytesIO(self.read())
+
+    def read(self):
+        with open(self.file, 'rb') as fp:
+            fp.seek(self.offset)
+            return fp.read(self.length)
+
+    def size(self):
+        return self.length
+
+
+class DuplicatePage(Page):
+    """
+    Page with the same image as an earlier page. Writers can store the image only once.
+    """
+
+    def __init__(self, name, original):
+        super().__init__(name)
+        self.duplicate_of = original
+
+    def open(self):
+        return self.duplicate_of.open()
+
+    def read(self):
+        return self.duplicate_of.read()
+
+    def size(self):
+        return self.duplicate_of.size()
+
+    @property
+    def info(self):
+        return self.duplicate_of.info
+
+    @info.setter
+    def info(self, value):
+        pass
+
+
+# Zip files are kept open for reading the pages, one handle per file. It is opened again when the file
+# is rewritten, and in forked worker process, as inherited handle shares its file offset with the parent.
+_zip_files = {}
+
+
+def _open_zip(file):
+    stat = os.stat(file)
+    key = (stat.st_mtime_ns, stat.st_size, os.getpid())
+    cached = _zip_files.get(file)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    _close_zip(file)
+    zfp = zipfile.ZipFile(file, 'r')
+    _zip_files[file] = (key, zfp)
+    return zfp
+
+
+# Close the kept handle of the file, if it was opened by this process
+def _close_zip(file):
+    cached = _zip_files.pop(file, None)
+    if cached is not None and cached[0][2] == os.getpid():
+        cached[1].close()
+
+
+class ZipPage(Page):
+    def __init__(self, file, member):
+        super().__init__(posixpath.basename(member))
+        self.file = file
+        self.member = member
+
+    def open(self):
+        return _open_zip(self.file).open(self.member)
+
+    def size(self):
+        return _open_zip(self.file).getinfo(self.member).file_size
+
+
+class PageSource(list):
+    """
+    Sequence of pages of the book.
+    """
+
+    @classmethod
+    def from_files(cls, files):
+        return cls(FilePage(x) for x in files)
+
+    # List of PageInfo of every pages
+    def index(self):
+        return [x.info for x in self]
+
+
+# Default memory limit of in-memory staging
+MEMORY_STAGING_LIMIT = 1024 ** 3
+
+
+class Staging:
+    """
+    Storage for intermediate files of a book, e.g. processed pages or unpacked book.
+
+    Pages are kept in memory up to memory_limit bytes, and spill to the temporary directory after that.
+    AZW3 that cannot be read directly is unpacked in memory too, if it fits.
+    The temporary directory is created in dir (e.g. /dev/shm) or the default temporary path,
+    only when some file has to be written there.
+    """
+
+    def __init__(self, dir=None, memory_limit=0):
+        self.dir = dir
+        self.memory_limit = memory_limit
+
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+
+        self._dir = None
+
+    @property
+    def dir_name(self):
+        if self._dir is None:
+            self._dir = tempfile.TemporaryDirectory(dir=self.dir)
+        return self._dir.name
+
+    def put(self, name, data):
+        """Store page image and return it as Page"""
+        if self.memory_bytes + len(data) <= self.memory_limit:
+            self.memory_bytes += len(data)
+            return MemoryPage(name, data)
+
+        file = os.path.join(self.dir_name, name)
+        with open(file, 'wb') as fp:
+            fp.write(data)
+        self.disk_bytes += len(data)
+        return FilePage(file)
+
+    # Summary of bytes staged, files written by external tools into the directory are counted as well
+    def report(self):
+        disk_bytes = 0
+        if self._dir is not None:
+            for root, _, files in os.walk(self._dir.name):
+                disk_bytes += sum(os.path.getsize(os.path.join(root, x)) for x in files)
+        text = 'Staging: {} bytes in memory'.format(self.memory_bytes)
+        if self.memory_limit and self.disk_bytes:
+            text += ', {} bytes over memory limit'.format(self.disk_bytes)
+        text += ', {} bytes in {}'.format(
+            disk_bytes, self._dir.name if self._dir is not None else self.dir or 'temporary folder')
+        return text
+
+    def cleanup(self):
+        if self._dir is not None:
+            self._dir.cleanup()
+            self._dir = None
+
+
 class ComicBook:
-    def __init__(self):
+    def __init__(self, staging=None):
         self.metadata = ComicMetadata()
-        self.images = []
+        self.images = PageSource()
         self.direction = 1
 
-        self._dir = tempfile.TemporaryDirectory()
-        self.dir_name = self._dir.name
+        # Temporary directory is only created if some reader or processor need it
+        self.staging = staging if staging is not None else Staging()
+        self._dir_name = None
+
+        # Zip file the pages are read from, its kept handle is closed with the book
+        self._zip_file = None
+
+    @property
+    def dir_name(self):
+        if self._dir_name is None:
+            self._dir_name = self.staging.dir_name
+        return self._dir_name
+
+    @dir_name.setter
+    def dir_name(self, value):
+        self._dir_name = value
 
     def close(self):
-        self._dir.cleanup()
+        if self._zip_file is not None:
+            _close_zip(self._zip_file)
+        self.staging.cleanup()
 
     def __enter__(self):
         return self
@@ -329,10 +793,10 @@ class ComicBook:
 
 
 class EPUBComicReader(ComicBook):
-    def __init__(self, book_file):
-        super().__init__()
+    def __init__(self, book_file, staging=None):
+        super().__init__(staging)
 
-        self._extract_book(book_file)
+        self._open_book(book_file)
 
         # Find OPF file
         opf_file = self._find_opf()
@@ -341,8 +805,7 @@ class EPUBComicReader(ComicBook):
         self.images = self._read_opf(opf_file)
 
     def _find_opf(self):
-        container_xml = os.path.join(self.dir_name, 'META-INF', 'container.xml')
-        tree = parse_xml(container_xml)
+        tree = self._read_xml('META-INF/container.xml')
         root = tree.getroot()
 
         for rootfile in root.findall('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile'):
@@ -352,8 +815,7 @@ class EPUBComicReader(ComicBook):
         raise Exception('Cannot find OPF file in META-INF/container.xml')
 
     def _read_opf(self, opf_file):
-        opf_xml = os.path.join(self.dir_name, opf_file)
-        tree = parse_xml(opf_xml)
+        tree = self._read_xml(opf_file)
         root = tree.getroot()
 
         # Read metadata
@@ -382,67 +844,228 @@ class EPUBComicReader(ComicBook):
                 self.direction = -1
 
         # Read image from each page in spine
-        base_path = os.path.join(self.dir_name, os.path.dirname(opf_xml))
+        base_path = posixpath.dirname(opf_file)
+
+        def image_path(page_path, src):
+            return posixpath.normpath(posixpath.join(posixpath.dirname(page_path), src))
 
         images_list = []
         for page in spine_list:
-            page_path = os.path.join(base_path, page)
-            tree = parse_xml(page_path)
+            page_path = posixpath.join(base_path, page)
+            tree = self._read_xml(posixpath.normpath(page_path))
             page_root = tree.getroot()
             found_image = False
 
             # Read SVG image first
             for img in page_root.findall('.//svg:image', xmlns):
                 src = img.get('{{{}}}href'.format(xmlns['xlink']))
-                src = os.path.join(os.path.dirname(page_path), src)
-                images_list.append((page, src))
+                images_list.append((page, image_path(page_path, src)))
                 found_image = True
 
             if not found_image:
                 # Find using XHTML img tag instead
                 for img in page_root.findall('.//xhtml:img', xmlns):
                     src = img.get('src')
-                    src = os.path.join(os.path.dirname(page_path), src)
-                    images_list.append((page, src))
+                    images_list.append((page, image_path(page_path, src)))
                     found_image = True
 
             if not found_image:
                 # Find using html img tag instead
                 for img in page_root.findall('.//img', xmlns):
                     src = img.get('src')
-                    src = os.path.join(os.path.dirname(page_path), src)
-                    images_list.append((page, src))
+                    images_list.append((page, image_path(page_path, src)))
                     found_image = True
 
+        self._opf_file = opf_file
+        self._images_list = images_list
+        self._ncx_file = None
         try:
             ncx_id = root.find('.//opf:spine', xmlns).get('toc')
             ncx_item = root.find('.//opf:item[@id="{}"]'.format(ncx_id), xmlns).get('href')
-            ncx_xml = os.path.join(base_path, ncx_item)
+            ncx_xml = posixpath.normpath(posixpath.join(base_path, ncx_item))
+            self._ncx_file = ncx_xml
 
-            self.metadata.read_ncx(parse_xml(ncx_xml), images_list)
+            self.metadata.read_ncx(self._read_xml(ncx_xml), images_list)
         except:
             pass
 
-        return [x[1] for x in images_list]
+        return PageSource(self._make_page(x[1]) for x in images_list)
+
+    # The EPUB is read directly from the zip file without extracting
+    def _open_book(self, book_file):
+        self._book_file = book_file
+        self._zip_file = book_file
+        self._zip = _open_zip(book_file)
 
-    def _extract_book(self, book_file):
-        with zipfile.ZipFile(book_file, 'r') as epub_zip:
-            epub_zip.extractall(path=self.dir_name)
+    def _read_xml(self, name):
+        with self._zip.open(name) as fp:
+            return parse_xml(fp)
+
+    def _make_page(self, name):
+        return ZipPage(self._book_file, name)
 
 
 class AZW3ComicReader(EPUBComicReader):
-    def _extract_book(self, book_file):
+    embed_pattern = re.compile(br'''kindle:(embed|flow):([0-9A-V]+)\?mime=image/(svg\+xml)?''', re.IGNORECASE)
+
+    def __init__(self, book_file, staging=None):
+        ComicBook.__init__(self, staging)
+
+        # Try reading the pages directly from the image sections first,
+        # and only unpack the whole book to EPUB if that does not work
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                self.images = self._read_book(book_file)
+        except Exception:
+            self.images = []
+
+        if len(self.images) == 0:
+            self.metadata = ComicMetadata()
+            self.direction = 1
+
+            self._open_book(book_file)
+            opf_file = self._find_opf()
+            self.images = self._read_opf(opf_file)
+
+    def _read_book(self, book_file):
+        # Sections are only read while looking for the pages, pages read their range of the file
+        with Sectionizer(book_file) as sect:
+            if sect.ident != b'BOOKMOBI':
+                return []
+
+            # Find KF8 header, which might be after mobi7 part in combination file
+            mh = MobiHeader(sect, 0)
+            if not mh.isK8():
+                for i in range(sect.num_sections):
+                    before, after = sect.sectionoffsets[i:i + 2]
+                    if after - before == 8 and sect.loadSection(i) == kindleunpack.kindleunpack.K8_BOUNDARY:
+                        mh = MobiHeader(sect, i + 1)
+                        break
+                else:
+                    return []
+
+            if mh.isEncrypted():
+                return []
+
+            metadata = mh.getMetaData()
+            self.metadata.read_mobi_metadata(metadata)
+
+            # Find the RESC section for spine information
+            k8resc = None
+            for i in range(mh.firstresource, sect.num_sections):
+                before, after = sect.sectionoffsets[i:i + 2]
+                if sect.data[before:before + 4] == b'RESC':
+                    k8resc = K8RESCProcessor(sect.loadSection(i)[16:])
+                    break
+
+            # Only the text is decompressed, to find the image of each part
+            k8proc = K8Processor(mh, sect, None)
+            k8proc.buildParts(mh.getRawML())
+
+            image_types = {}
+
+            def section_image(number):
+                section = mh.firstresource + number - 1
+                if section not in image_types:
+                    image_types[section] = None
+                    if mh.firstresource <= section < sect.num_sections:
+                        image_types[section] = get_image_type(None, sect.loadSectionView(section))
+                return section if image_types[section] in IMAGE_TYPES else None
+
+            def part_images(text, allow_flow=True):
+                sections = []
+                for m in self.embed_pattern.finditer(text):
+                    number = fromBase32(m.group(2))
+                    if m.group(1).lower() == b'embed':
+                        section = section_image(number)
+                        if section is not None:
+                            sections.append(section)
+                    elif allow_flow and m.group(3) is not None and k8proc.getFlow(number) is not None:
+                        # Inlined SVG image
+                        sections += part_images(k8proc.getFlow(number), False)
+                return sections
+
+            # Spine
+            part_index = {str(k8proc.getPartInfo(i)[0]): i for i in range(k8proc.getNumberOfParts())}
+            if k8resc is not None and k8resc.hasSpine():
+                spine = [part_index[x] for x in k8resc.spine_order if x in part_index]
+            else:
+                spine = list(range(k8proc.getNumberOfParts()))
+
+            pages = []
+            for i in spine:
+                filename = k8proc.getPartInfo(i)[2]
+                for section in part_images(k8proc.getPart(i)):
+                    pages.append((filename, section))
+
+            # Cover page is added if the cover image is not the first page
+            if 'CoverOffset' in metadata:
+                cover = section_image(int(metadata['CoverOffset'][0]) + 1)
+                if cover is not None and (len(pages) == 0 or pages[0][1] != cover):
+                    pages.insert(0, (None, cover))
+
+            if len(pages) == 0:
+                return []
+
+            # Read direction
+            writing_mode = metadata.get('primary-writing-mode', [''])[0]
+            progression = metadata.get('page-progression-direction', [None])[0]
+            if progression == 'rtl' or 'rl' in writing_mode or (k8resc is not None and k8resc.spine_ppd == 'rtl'):
+                self.direction = -1
+
+            # Pages are read directly from section data
+            images_list = []
+            for idx, (filename, section) in enumerate(pages):
+                before, after = sect.sectionoffsets[section:section + 2]
+                name = '{:05d}.{}'.format(idx, image_types[section])
+                images_list.append((filename, FileRangePage(name, book_file, before, after - before)))
+
+            # Table of content, only top level entries
+            toc = []
+            ncx = ncxExtract(mh, None)
+            for entry in ncx.parseNCX():
+                if entry['hlvl'] == 0 and entry['pos_fid'] is not None:
+                    _, _, _, fid, _, off = entry['pos_fid'].split(':')
+                    filename, _ = k8proc.getIDTagByPosFid(fid, off)
+                    toc.append((entry['text'], filename))
+            self.metadata.read_toc(toc, images_list)
+
+            return PageSource(x[1] for x in images_list)
+
+    def _open_book(self, book_file):
+        # Unpack in memory if it fits in the staging memory limit,
+        # unpacked book is about three times the file size (mobi7 and mobi8 images and the EPUB)
+        staging = self.staging
+        self._sink = None
+        if staging.memory_bytes + 3 * os.path.getsize(book_file) <= staging.memory_limit:
+            self._sink = kindleunpack.kindleunpack.MemorySink()
+
         # Block print
-        sys.stdout = open(os.devnull, 'w')
-        kindleunpack.kindleunpack.unpackBook(book_file, self.dir_name)
-        sys.stdout = sys.__stdout__
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if self._sink is not None:
+                kindleunpack.kindleunpack.unpackBook(book_file, '', sink=self._sink)
+            else:
+                kindleunpack.kindleunpack.unpackBook(book_file, self.dir_name)
+
+        if self._sink is not None:
+            staging.memory_bytes += sum(len(x) for x in self._sink.files.values())
+        else:
+            self.dir_name = os.path.join(self.dir_name, 'mobi8')
+
+    def _read_xml(self, name):
+        if self._sink is not None:
+            return parse_xml(io.BytesIO(self._sink.read(posixpath.join('mobi8', name))))
+        return parse_xml(os.path.join(self.dir_name, name))
 
-        self.dir_name = os.path.join(self.dir_name, 'mobi8')
+    def _make_page(self, name):
+        if self._sink is not None:
+            return MemoryPage(posixpath.basename(name), self._sink.read(posixpath.join('mobi8', name)))
+        return FilePage(os.path.join(self.dir_name, name))
 
 
 class DirComicReader(ComicBook):
-    def __init__(self, book_file):
-        super().__init__()
+    def __init__(self, book_file, staging=None):
+        super().__init__(staging)
         self._prepare_book_folder(book_file)
 
         # Try finding ComicInfo.xml
@@ -454,17 +1077,35 @@ class DirComicReader(ComicBook):
                  glob.glob(os.path.join(self.dir_name, '**', '*.{}'.format(e)), recursive=True)]
         files.sort()
 
-        self.images = files
+        self.images = PageSource.from_files(files)
 
     def _prepare_book_folder(self, book_file):
         self.dir_name = book_file
 
 
-class ZipComicReader(DirComicReader):
-    def _prepare_book_folder(self, book_file):
-        with zipfile.ZipFile(book_file, 'r') as zfp:
-            zfp.extractall(path=self.dir_name)
-            self.metadata.read_comicbookinfo(zfp.comment.decode('utf-8'))
+class ZipComicReader(ComicBook):
+    image_extensions = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'jxl']
+
+    def __init__(self, book_file, staging=None):
+        super().__init__(staging)
+
+        # Pages are read from the zip file directly without extracting
+        self._zip_file = book_file
+        zfp = _open_zip(book_file)
+        self.metadata.read_comicbookinfo(zfp.comment.decode('utf-8'))
+
+        names = [x for x in zfp.namelist() if not x.endswith('/')]
+        for name in names:
+            if posixpath.basename(name) == 'ComicInfo.xml':
+                with zfp.open(name) as fp:
+                    self.metadata.read_comicinfoxml(parse_xml(fp))
+
+        # Skip hidden files and folders, e.g. __MACOSX/._0001.jpg
+        files = [x for x in names if not any(p.startswith('.') for p in x.split('/')) and
+                 posixpath.splitext(x)[1][1:] in self.image_extensions]
+        files.sort()
+
+        self.images = PageSource(ZipPage(book_file, x) for x in files)
 
 
 class PDFComicReader(DirComicReader):
@@ -484,35 +1125,61 @@ class PDFComicReader(DirComicReader):
         # TODO read bookmarks as table of content
 
 
-def write_as_zip(book, output):
+def _write_images(zfp, prefix, book, pages, share_duplicates=False):
+    """
+    Write page images into archive. If pages is given (e.g. streamed from the processor),
+    it is written instead of book.images, and book.images is set to the pages in the archive.
+    If share_duplicates is set, image of duplicate page is not written again.
+    """
+    if pages is None:
+        for image in book.images:
+            if share_duplicates and image.duplicate_of is not None:
+                continue
+            zfp.writestr(prefix + image.name, image.read())
+        return
+
+    images = PageSource()
+    written = {}
+    for page in pages:
+        if share_duplicates and page.duplicate_of is not None:
+            images.append(DuplicatePage(page.name, written[page.duplicate_of.name]))
+            continue
+
+        zfp.writestr(prefix + page.name, page.read())
+        image = ZipPage(zfp.filename, prefix + page.name)
+        image.info = page.info
+        images.append(image)
+        written[page.name] = image
+    book.images = images
+
+
+def write_as_zip(book, output, pages=None):
     with zipfile.ZipFile(output, 'w') as zfp:
         # Write metadata
         zfp.comment = bytes(book.metadata.generate_comicbookinfo(), 'utf-8')
         zfp.writestr('ComicInfo.xml', book.metadata.generate_comicinfoxml())
 
         # Write image
-        for image in book.images:
-            zfp.write(image, os.path.basename(image))
+        _write_images(zfp, '', book, pages)
 
 
-def write_as_epub(book, output):
-    from PIL import Image
+def write_as_epub(book, output, pages=None):
     import uuid
     from xml.sax.saxutils import escape
 
     book_id = uuid.uuid4()
 
     def html_name(image):
-        return os.path.splitext(os.path.basename(image))[0] + '.xhtml'
+        return os.path.splitext(image.name)[0] + '.xhtml'
 
     def image_id(image):
-        i = os.path.splitext(os.path.basename(image))[0]
+        i = os.path.splitext(image.name)[0]
         if i == '00000':
             return 'i-cover'
         return 'i-' + i
 
     def html_id(image):
-        i = os.path.splitext(os.path.basename(image))[0]
+        i = os.path.splitext(image.name)[0]
         if i == '00000':
             return 'p-cover'
         return 'p-' + i
@@ -551,8 +1218,7 @@ def write_as_epub(book, output):
         return style
 
     def write_opf():
-        with Image.open(book.images[0]) as im:
-            w, h = im.size
+        w, h = book.images[0].info.width, book.images[0].info.height
 
         opf = ''
         opf += '<?xml version="1.0" encoding="utf-8"?>\n'
@@ -589,7 +1255,7 @@ def write_as_epub(book, output):
         if book.metadata.series:
             opf += '\t\t<meta name="calibre:series" content="{}"/>\n'.format(escape(book.metadata.series))
         if book.metadata.volume:
-            opf += '\t\t<meta name="calibre:series_index" content="{}"/>\n'.format(escape(book.metadata.volume))
+            opf += '\t\t<meta name="calibre:series_index" content="{}"/>\n'.format(escape(str(book.metadata.volume)))
         opf += '\t</metadata>\n'
 
         opf += '\t<manifest>\n'
@@ -599,8 +1265,10 @@ def write_as_epub(book, output):
         opf += '\t\t<item id="ncx" media-type="application/x-dtbncx+xml" href="toc.ncx"/>\n'
         opf += '\t\t<item id="book-css" media-type="text/css" href="Styles/style.css"/>\n'
         for img in book.images:
-            opf += '\t\t<item id="{}" media-type="image/jpeg" href="Images/{}"/>\n'.format(image_id(img),
-                                                                                           os.path.basename(img))
+            if img.duplicate_of is not None:
+                continue
+            media_type = IMAGE_TYPES.get(img.info.format, (None, 'image/jpeg'))[1]
+            opf += '\t\t<item id="{}" media-type="{}" href="Images/{}"/>\n'.format(image_id(img), media_type, img.name)
         opf += '\t</manifest>\n'
 
         page_side = -1
@@ -658,8 +1326,7 @@ def write_as_epub(book, output):
         return ncx
 
     def write_html(image, is_cover=False):
-        with Image.open(image) as im:
-            w, h = im.size
+        w, h = image.info.width, image.info.height
 
         html = ''
         html += '<?xml version="1.0" encoding="UTF-8"?>\n'
@@ -667,7 +1334,7 @@ def write_as_epub(book, output):
         html += '<html xmlns=\'http://www.w3.org/1999/xhtml\' xmlns:epub=\'http://www.idpf.org/2007/ops\'>\n'
         html += '<head>\n'
         html += '\t<meta charset="UTF-8"/>\n'
-        html += '\t<title>{}</title>\n'.format(image)
+        html += '\t<title>{}</title>\n'.format(image.name)
         html += '\t<link href="../Styles/style.css" type="text/css" rel="stylesheet"/>\n'
         html += '\t<meta name="viewport" content="width={}, height={}"/>\n'.format(w, h)
         html += '</head>\n'
@@ -675,8 +1342,9 @@ def write_as_epub(book, output):
         html += '\t<div class="main">\n'
         html += '\t\t<svg xmlns="http://www.w3.org/2000/svg" version="1.1" xmlns:xlink="http://www.w3.org/1999/xlink" width="100%" height="100%" viewBox="0 0 {} {}">\n'.format(
             w, h)
-        html += '\t\t\t<image width="{}" height="{}" xlink:href="../Images/{}"/>\n'.format(w, h,
-                                                                                           os.path.basename(image))
+        # Duplicate page shows the image of the original page
+        html += '\t\t\t<image width="{}" height="{}" xlink:href="../Images/{}"/>\n'.format(
+            w, h, (image.duplicate_of or image).name)
         html += '\t\t</svg>\n'
         html += '\t</div>\n'
         html += '</body>\n'
@@ -687,66 +1355,158 @@ def write_as_epub(book, output):
     with zipfile.ZipFile(output, 'w') as zfp:
         zfp.writestr('mimetype', 'application/epub+zip', compresslevel=zipfile.ZIP_STORED)
         zfp.writestr('META-INF/container.xml', write_container())
-        zfp.writestr('OEBPS/content.opf', write_opf())
-        zfp.writestr('OEBPS/toc.ncx', write_ncx())
 
         # Stylesheet
         zfp.writestr('OEBPS/Styles/style.css', write_style())
 
+        # Write image first, OPF and pages need the size of every images
+        _write_images(zfp, 'OEBPS/Images/', book, pages, share_duplicates=True)
+
+        zfp.writestr('OEBPS/content.opf', write_opf())
+        zfp.writestr('OEBPS/toc.ncx', write_ncx())
+
         # Write pages
         for idx, image in enumerate(book.images):
             zfp.writestr('OEBPS/Text/' + html_name(image), write_html(image, idx == 0))
 
-        # Write image
+
+def write_as_pdf(book, output, linearize=False):
+    from pdfwriter import PDFWriter, linearize_pdf, check_linearization
+
+    author = book.metadata.credits[0]['person'] if book.metadata.credits else None
+
+    with PDFWriter(output, direction=book.direction, title=book.metadata.title, author=author) as pdf:
         for image in book.images:
-            zfp.write(image, 'OEBPS/Images/' + os.path.basename(image))
+            pdf.add_page(image)
 
+        # Create TOC if present
+        for page, title in book.metadata.toc:
+            pdf.add_outline(title, page)
+
+    # Linearization need the whole file, so it's done as a second pass
+    if linearize:
+        linearize_pdf(output)
+        if not check_linearization(output):
+            raise Exception('PDF linearization check failed')
+
+
+def _replace_zip_members(book_file, members, comment=None):
+    """
+    Replace members of zip file in place, other members are not touched at all.
+    members is a dict of name to new content, or None to just remove the member.
+    Removed members at the end of the archive are overwritten, otherwise they are
+    left as unused space and the new ones are appended before the new central directory.
+    """
+    with zipfile.ZipFile(book_file, 'a') as zfp:
+        removed = [x for x in zfp.filelist if x.filename in members]
+        for info in removed:
+            zfp.filelist.remove(info)
+            del zfp.NameToInfo[info.filename]
+
+        if removed and all(x.header_offset > y.header_offset for x in removed for y in zfp.filelist):
+            zfp.start_dir = min(x.header_offset for x in removed)
+
+        if comment is not None:
+            zfp.comment = comment
+
+        for name, content in members.items():
+            if content is not None:
+                zfp.writestr(name, content, compress_type=zipfile.ZIP_DEFLATED)
+
+
+def update_metadata(book_file, metadata, direction=None):
+    """
+    Update metadata and table of contents of CBZ/ZIP or EPUB file in place.
+    Only the metadata members (ComicInfo.xml, ComicBookInfo comment, OPF and NCX)
+    are rewritten, images are not read at all.
+    Direction is only stored in EPUB.
+    """
+    _, ext = os.path.splitext(book_file)
+    ext = ext.lower()
+
+    if ext in ['.cbz', '.zip']:
+        with zipfile.ZipFile(book_file) as zfp:
+            names = [x for x in zfp.namelist() if posixpath.basename(x) == 'ComicInfo.xml']
+
+        members = {x: None for x in names}
+        members['ComicInfo.xml'] = metadata.generate_comicinfoxml()
+        _replace_zip_members(book_file, members, bytes(metadata.generate_comicbookinfo(), 'utf-8'))
+
+    elif ext in ['.epub', '.epub2', '.epub3']:
+        members = {}
+        with EPUBComicReader(book_file) as book:
+            tree = metadata.update_opf_tree(book._read_xml(book._opf_file), direction)
+            members[book._opf_file] = etree.tostring(tree, xml_declaration=True, encoding='utf-8')
+
+            if book._ncx_file is not None:
+                base_path = posixpath.dirname(book._opf_file)
+                ncx_path = posixpath.dirname(book._ncx_file)
+                page_files = [posixpath.relpath(posixpath.join(base_path, page), ncx_path or '.')
+                              for page, _ in book._images_list]
+                tree = metadata.update_ncx_tree(book._read_xml(book._ncx_file), page_files)
+                members[book._ncx_file] = etree.tostring(tree, xml_declaration=True, encoding='utf-8')
+
+        _replace_zip_members(book_file, members)
+
+    else:
+        raise Exception('Updating metadata in place is only supported for CBZ/ZIP and EPUB')
+
+
+def update_comicinfo(book_file, xml):
+    """
+    Replace ComicInfo.xml of CBZ/ZIP file in place with the given XML (e.g. from cbz-meta editor).
+    ComicBookInfo comment is updated to match.
+    """
+    metadata = ComicMetadata()
+    metadata.read_comicinfoxml(parse_xml(io.BytesIO(xml)))
+
+    with zipfile.ZipFile(book_file) as zfp:
+        names = [x for x in zfp.namelist() if posixpath.basename(x) == 'ComicInfo.xml']
+
+    members = {x: None for x in names}
+    members['ComicInfo.xml'] = xml
+    _replace_zip_members(book_file, members, bytes(metadata.generate_comicbookinfo(), 'utf-8'))
+
+
+def process_comic(comic_book, processor, quality=60, drop_duplicates=False, staging=None):
+    """
+    Process comic, with the processed pages kept in staging (temporary folder by default).
+    Pages the processor found to be duplicate are DuplicatePage of the original page,
+    or are removed from the book if drop_duplicates is set.
+    """
+    output = ComicBook(staging)
+    output.direction = comic_book.direction
 
-def write_as_pdf(book, output):
-    import pikepdf
-    from PIL import Image
-    from fpdf import FPDF, ViewerPreferences
+    stream = processor.process_stream(comic_book.images, quality)
 
-    DEFAULT_DPI = 300
-    DEFAULT_DPM = DEFAULT_DPI / 25.4
+    _map_processed_metadata(output, comic_book.metadata, processor, drop_duplicates)
 
-    pdf = FPDF()
-    pdf.set_display_mode('fullpage', 'two')
-    pdf.set_margin(0)
-    pdf.viewer_preferences = ViewerPreferences(hide_toolbar=True, hide_menubar=False, fit_window=True)
+    pages = _processed_pages(stream, output.staging)
+    output.images = PageSource(_add_duplicates(pages, processor.duplicate_map, drop_duplicates))
 
-    toc_map = {x[0]: x[1] for x in book.metadata.toc}
+    return output
 
-    for i, image in enumerate(book.images):
-        img = Image.open(image)
-        width, height = img.size
 
-        # Convert directly to mm
-        width /= DEFAULT_DPM
-        height /= DEFAULT_DPM
+def process_comic_to(comic_book, processor, writer, output_file, quality=60, drop_duplicates=False):
+    """
+    Process comic and write it with writer (write_as_zip or write_as_epub) at the same time.
+    Each page is written into the archive as soon as it is processed, without temporary files.
+    """
+    output = ComicBook()
+    output.direction = comic_book.direction
 
-        pdf.add_page(format=(width, height))
-        pdf.image(img, 0, 0, width, height)
+    stream = processor.process_stream(comic_book.images, quality)
 
-        # Create TOC if present
-        if i in toc_map:
-            pdf.start_section(toc_map[i])
+    _map_processed_metadata(output, comic_book.metadata, processor, drop_duplicates)
 
-    pdf.output(output)
+    writer(output, output_file, pages=_add_duplicates(_processed_pages(stream), processor.duplicate_map,
+                                                      drop_duplicates))
 
-    # Set RTL and two-column reading
-    with pikepdf.Pdf.open(output, allow_overwriting_input=True) as pdf:
-        pdf.Root.PageLayout = pikepdf.Name.TwoPageRight
-        if book.direction == -1:
-            pdf.Root.ViewerPreferences.Direction = pikepdf.Name.R2L
-        pdf.save()
+    return output
 
 
-def process_comic(comic_book, processor, quality=60):
-    output = ComicBook()
-    output.direction = comic_book.direction
-    output.images = processor.process(comic_book.images, output.dir_name, quality)
-    output.metadata = comic_book.metadata
+def _map_processed_metadata(output, metadata, processor, drop_duplicates):
+    output.metadata = metadata
 
     if processor.page_map:
         output.metadata.map_toc(processor.page_map)
@@ -754,22 +1514,66 @@ def process_comic(comic_book, processor, quality=60):
     if processor.spread_map:
         output.metadata.spread_map = processor.spread_map
 
-    return output
+    # Bookmark to a dropped page goes to the page before it, the first page is never dropped
+    if drop_duplicates and processor.duplicate_map:
+        dropped = sorted(processor.duplicate_map)
+
+        def new_number(page):
+            return page - bisect.bisect_right(dropped, page)
+
+        output.metadata.toc = [[new_number(page), title] for page, title in output.metadata.toc]
+        output.metadata.spread_map = {new_number(page): spread for page, spread in processor.spread_map.items()
+                                      if page not in processor.duplicate_map}
+
+
+def _processed_pages(stream, staging=None):
+    for page_number, data, info in stream:
+        name = '{:05d}.{}'.format(page_number, IMAGE_TYPES[info['format']][0])
+        page = MemoryPage(name, data) if staging is None else staging.put(name, data)
+        page.info = PageInfo(*[info[x] for x in PageInfo._fields])
+        yield page_number, page
+
+
+def _add_duplicates(pages, duplicate_map, drop=False):
+    """
+    Take (page_number, page) of processed pages in order, and yield all pages of the book
+    with DuplicatePage at the place of pages that are not processed, unless drop is set.
+    """
+    original_numbers = set(duplicate_map.values())
+    originals = {}
+    next_number = 0
+
+    def duplicates_until(end):
+        nonlocal next_number
+        while next_number < end and next_number in duplicate_map:
+            original = originals[duplicate_map[next_number]]
+            if not drop:
+                yield DuplicatePage('{:05d}{}'.format(next_number, posixpath.splitext(original.name)[1]), original)
+            next_number += 1
+
+    for page_number, page in pages:
+        yield from duplicates_until(page_number)
+        if page_number in original_numbers:
+            originals[page_number] = page
+        yield page
+        next_number = page_number + 1
+
+    yield from duplicates_until(float('inf'))
 
 
-def load_book(book_file):
+def load_book(book_file, staging=None):
     if os.path.isdir(book_file):
-        return DirComicReader(book_file)
+        return DirComicReader(book_file, staging)
 
     _, ext = os.path.splitext(book_file)
 
     if ext == '.pdf':
-        return PDFComicReader(book_file)
+        return PDFComicReader(book_file, staging)
     elif ext == '.azw3' or ext == '.mobi':
-        return AZW3ComicReader(book_file)
+        return AZW3ComicReader(book_file, staging)
     elif ext == '.epub' or ext == '.epub2' or ext == '.epub3':
-        return EPUBComicReader(book_file)
+        return EPUBComicReader(book_file, staging)
     elif ext == '.zip' or ext == '.cbz':
-        return ZipComicReader(book_file)
+        return ZipComicReader(book_file, staging)
 
     raise Exception('Unknown comic file {}'.format(ext))
@@ -3,11 +3,13 @@
 
 from multiprocessing import Pool
 from PIL import Image, ImageOps, ImageFilter
-from os import path
+import collections
 import itertools
 import math
 import numpy as np
+import os
 import functools
+import hashlib
 import io
 import mozjpeg_lossless_optimization
 
@@ -20,6 +22,21 @@ PALETTE_C = [value for r in EINK_COLOR for g in EINK_COLOR for b in EINK_COLOR f
 PAL_IMG_BW = Image.new('P', (1, 1))
 PAL_IMG_BW.putpalette(PALETTE_BW)
 
+# Output codec: (PIL format, file extension)
+OUTPUT_CODECS = {
+    'jpeg': ('JPEG', 'jpg'),
+    'webp': ('WEBP', 'webp'),
+    'avif': ('AVIF', 'avif'),
+    'jxl': ('JXL', 'jxl'),
+    'png': ('PNG', 'png'),
+}
+
+# Level 7 is within 1% of level 9 size on dithered pages, at less than a third of the time
+PNG_COMPRESS_LEVEL = 7
+
+# Stop quality search when the page is this close below the size budget
+TARGET_SIZE_TOLERANCE = 0.03
+
 
 class ComicProcessor:
     """
@@ -28,7 +45,23 @@ class ComicProcessor:
     """
 
     def __init__(self, dir=1, merge=True, merge_pct=0.15, merge_contrast=0.25, crop_border='default', gamma=1.8,
-                 split='both', split_overlap=True, resize=None, color=False):
+                 split='both', split_overlap=True, resize=None, color=False, codec='jpeg', lossless=False,
+                 target_size=None, target_page_size=None, quality_range=(10, 95), dedupe=True,
+                 share_duplicates=False):
+        """
+        target_size and target_page_size are size budget in bytes of all page images and of each page.
+        If set, the quality of each page is searched within quality_range to fit in the budget,
+        instead of the fixed quality. Chosen quality is in page_info.
+        If dedupe is set, output pages identical to an earlier page are not processed again,
+        they are listed in duplicate_map instead.
+        share_duplicates tells that the writer stores the image of duplicate pages once (EPUB, PDF)
+        or drops them, otherwise duplicate pages count toward target_size as well.
+        """
+        check_codec(codec)
+        if (target_size or target_page_size) and is_lossless(codec, lossless):
+            raise Exception('Target size needs a lossy codec, quality of {} output cannot be lowered'.format(
+                'lossless' if lossless else codec.upper()))
+
         self.options = {
             'dir': dir,
             'merge': merge,
@@ -40,34 +73,115 @@ class ComicProcessor:
             'split_overlap': split_overlap,
             'resize': resize,
             'color': color,
+            'codec': codec,
+            'lossless': lossless,
+            'target_size': target_size,
+            'target_page_size': target_page_size,
+            'quality_range': quality_range,
+            'page_budget': None,
+            'dedupe': dedupe,
+            'share_duplicates': share_duplicates,
         }
 
         self.page_map = []
         self.spread_map = {}
-
-    def process(self, files, output_dir, quality=60):
-        with Pool() as pool:
-            mapper = (lambda func, param: pool.starmap(func, param)) if MULTI_PROCESSING else (
+        self.page_info = []
+        # Output page number to the earlier page number it is identical to
+        self.duplicate_map = {}
+        # Number of input pages looking the same as another page, but not identical
+        self.similar_pages = 0
+
+    # Summary of chosen quality and total size of processed pages
+    def report(self):
+        qualities = [x['quality'] for x in self.page_info if x['quality'] is not None]
+        text = '{} pages, {} bytes'.format(len(self.page_info), sum(x['size'] for x in self.page_info))
+        if qualities:
+            text += ', quality {}-{} (average {:.1f})'.format(min(qualities), max(qualities),
+                                                              sum(qualities) / len(qualities))
+        if self.options['page_budget']:
+            text += ', page budget {} bytes'.format(self.options['page_budget'])
+        if self.duplicate_map:
+            sizes = {x['page']: x['size'] for x in self.page_info}
+            text += ', {} duplicate pages ({} bytes) not processed again'.format(
+                len(self.duplicate_map), sum(sizes.get(x, 0) for x in self.duplicate_map.values()))
+        if self.similar_pages:
+            text += ', {} similar pages'.format(self.similar_pages)
+        return text
+
+    def process_stream(self, files, quality=60, window=None):
+        """
+        Process pages and return iterator of (page_number, jpeg_bytes, info) in page order.
+        Pass #1 is done before returning, so page_map and spread_map are already available.
+        Pages of pass #2 are yielded as soon as they are ready. At most `window` pass #2
+        jobs are in flight, so finished pages waiting for an earlier one are bounded.
+        The iterator must be consumed to the end to release the worker pool.
+        """
+        pool = Pool() if MULTI_PROCESSING else None
+        try:
+            mapper = (lambda func, param: pool.starmap(func, param)) if pool is not None else (
                 lambda func, param: list(itertools.starmap(func, param)))
-
-            # Pass #1
-            pass_1_inputs = list(zip(files, files[1:] + [None]))
-            matrices = mapper(functools.partial(process_pass_1, self.options), pass_1_inputs)
-
-            # Pass Immediate
-            page_map, spread_map, pass_2_inputs = process_pass_immediate(self.options, files, matrices)
-            self.page_map = page_map
-            self.spread_map = spread_map
-
-            # Pass #2
-            list_of_images = mapper(functools.partial(process_pass_2, self.options, output_dir, quality), pass_2_inputs)
-
-            return [x for y in list_of_images for x in y]
+            pass_2_inputs = self._process_pass_1(mapper, files)
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+
+        return self._process_stream_pass_2(pool, pass_2_inputs, quality, window or 2 * os.cpu_count())
+
+    def _process_stream_pass_2(self, pool, pass_2_inputs, quality, window):
+        func = functools.partial(process_pass_2_encode, self.options, quality)
+        self.page_info = []
+
+        if pool is None:
+            for param in pass_2_inputs:
+                for page in func(*param):
+                    self.page_info.append(page[2])
+                    yield page
+            return
+
+        with pool:
+            # Jobs are submitted in order and collected in order, results finished early
+            # wait in their AsyncResult until the writer gets to them.
+            inputs = iter(pass_2_inputs)
+            pending = collections.deque(pool.apply_async(func, param) for param in itertools.islice(inputs, window))
+            while pending:
+                pages = pending.popleft().get()
+                param = next(inputs, None)
+                if param is not None:
+                    pending.append(pool.apply_async(func, param))
+                for page in pages:
+                    self.page_info.append(page[2])
+                    yield page
+
+    def _process_pass_1(self, mapper, files):
+        # Pass #1
+        pass_1_inputs = list(zip(files, files[1:] + [None]))
+        matrices = mapper(functools.partial(process_pass_1, self.options), pass_1_inputs)
+
+        # Pass Immediate
+        page_map, spread_map, pass_2_inputs, duplicate_map = process_pass_immediate(self.options, files, matrices)
+        self.page_map = page_map
+        self.spread_map = spread_map
+        self.duplicate_map = duplicate_map
+
+        # Perceptual hash is only reported, it could be a different page that looks alike
+        self.similar_pages = len(set((x['hash'], x['dhash']) for x in matrices)) - len(set(x['dhash'] for x in matrices))
+
+        # Number of output page is known now, so book budget can be divided to each page stored
+        budget = [self.options['target_page_size']] if self.options['target_page_size'] else []
+        if self.options['target_size']:
+            stored_pages = sum(len(x[-1]) for x in pass_2_inputs)
+            if not self.options['share_duplicates']:
+                stored_pages += len(duplicate_map)
+            budget.append(self.options['target_size'] // max(stored_pages, 1))
+        self.options['page_budget'] = min(budget) if budget else None
+
+        return pass_2_inputs
 
 
 def process_pass_1(options, f0, f1):
-    im0 = Image.open(f0)
-    im1 = Image.open(f1) if f1 is not None else None
+    im0 = open_image(f0)
+    im1 = open_image(f1) if f1 is not None else None
 
     size = (im0.width, im0.height)
     pct = 0
@@ -82,6 +196,10 @@ def process_pass_1(options, f0, f1):
     else:
         bounding = None
 
+    # Exact hash of decoded image, and perceptual hash to find pages that look the same
+    pixel_hash = hashlib.sha1('{} {}'.format(im0.mode, im0.size).encode('ascii') + im0.tobytes()).hexdigest()
+    dhash = image_dhash(im0)
+
     im0.close()
     if im1 is not None:
         im1.close()
@@ -89,7 +207,9 @@ def process_pass_1(options, f0, f1):
     return {
         'size': size,
         'merge': (pct, contrast),
-        'bounding': bounding
+        'bounding': bounding,
+        'hash': pixel_hash,
+        'dhash': dhash,
     }
 
 
@@ -97,6 +217,8 @@ def process_pass_immediate(options, files, matrices):
     page_map = []
     spread_map = {}
     pass_2_inputs = []
+    duplicate_map = {}
+    processed = {}
     page_number = 0
 
     merged = False
@@ -172,19 +294,26 @@ def process_pass_immediate(options, files, matrices):
             spread_map[page_number + 1] = -1
             spread_map[page_number + 2] = 1
 
-        page_number += pages
+        # Same image(s) with the same processing give the same output pages, only process it once
+        key = (matrices[i]['hash'], matrices[i + 1]['hash'] if merged else None)
+        if options['dedupe'] and key in processed:
+            for k in range(pages):
+                duplicate_map[page_number + k] = processed[key] + k
+        else:
+            processed[key] = page_number
+            pass_2_inputs.append(current_input)
 
-        pass_2_inputs.append(current_input)
+        page_number += pages
 
-    return page_map, spread_map, pass_2_inputs
+    return page_map, spread_map, pass_2_inputs, duplicate_map
 
 
-def process_pass_2(options, output_dir, quality, f0, f1, bounding, pages):
-    im0 = Image.open(f0)
+def process_pass_2_encode(options, quality, f0, f1, bounding, pages):
+    im0 = open_image(f0)
 
     # Merge image
     if f1 is not None and options['merge']:
-        im1 = Image.open(f1)
+        im1 = open_image(f1)
         im_new = spread_merge(im0, im1, direction=options['dir'])
         im0.close()
         im1.close()
@@ -211,20 +340,142 @@ def process_pass_2(options, output_dir, quality, f0, f1, bounding, pages):
             ims[i] = color_quantize_c(ims[i])
         else:
             ims[i] = color_gamma_correction_bw(ims[i], options['gamma'])
-            ims[i] = color_quantize_bw(ims[i])
+            if options['codec'] == 'png':
+                # Saved directly as 4-bit paletted PNG
+                ims[i] = color_quantize_bw_palette(ims[i])
+            else:
+                ims[i] = color_quantize_bw(ims[i])
 
     images_list = []
     for i in range(len(ims)):
-        filename = path.join(output_dir, '{:05d}.jpg'.format(pages[i]))
-        images_list.append(filename)
+        # Quantized greyscale page is still RGB, only JPEG is kept that way for compatibility
+        if options['codec'] not in ['jpeg', 'png'] and not options['color']:
+            ims[i] = ims[i].convert('L')
+
+        if options['page_budget'] and not is_lossless(options['codec'], options['lossless']):
+            output_bytes, page_quality = encode_image_to_size(ims[i], options['codec'], options['page_budget'],
+                                                              options['quality_range'])
+        else:
+            output_bytes = encode_image(ims[i], options['codec'], quality, options['lossless'])
+            page_quality = None if is_lossless(options['codec'], options['lossless']) else quality
+
+        # Page information for the writers, so they don't have to open the image again
+        images_list.append((pages[i], output_bytes, {
+            'page': pages[i],
+            'format': options['codec'],
+            'width': ims[i].width,
+            'height': ims[i].height,
+            'mode': ims[i].mode,
+            'size': len(output_bytes),
+            'hash': hashlib.sha1(output_bytes).hexdigest(),
+            'quality': page_quality,
+        }))
+
+    return images_list
+
+
+# Parse size with optional K/M/G suffix, e.g. 200K, 20M
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+# JPEG XL is only available from plugin
+def check_codec(codec):
+    if codec not in OUTPUT_CODECS:
+        raise Exception('Unknown output codec {}'.format(codec))
+
+    if codec == 'jxl':
+        try:
+            import pillow_jxl
+        except ImportError:
+            raise Exception('JPEG XL output requires pillow-jxl-plugin')
+
+    Image.init()
+    if OUTPUT_CODECS[codec][0] not in Image.SAVE:
+        raise Exception('Output codec {} is not supported by Pillow'.format(codec))
+
+
+# PNG is always lossless, quality only applies to lossy output
+def is_lossless(codec, lossless):
+    return codec == 'png' or lossless
+
+
+def encode_image(img, codec, quality, lossless=False, optimize=True):
+    if codec == 'jpeg':
         with io.BytesIO() as output:
-            ims[i].save(output, format="JPEG", optimize=1, quality=quality)
+            img.save(output, format="JPEG", optimize=1, quality=quality)
             input_jpeg_bytes = output.getvalue()
-            output_jpeg_bytes = mozjpeg_lossless_optimization.optimize(input_jpeg_bytes)
-            with open(filename, "wb") as output_jpeg_file:
-                output_jpeg_file.write(output_jpeg_bytes)
+        if not optimize:
+            return input_jpeg_bytes
+        return mozjpeg_lossless_optimization.optimize(input_jpeg_bytes)
 
-    return images_list
+    if codec == 'png':
+        with io.BytesIO() as output:
+            bits = 4 if img.mode == 'P' and len(img.getpalette()) <= 16 * 3 else 8
+            img.save(output, format='PNG', bits=bits, compress_level=PNG_COMPRESS_LEVEL)
+            return output.getvalue()
+
+    if codec == 'jxl':
+        import pillow_jxl
+
+    with io.BytesIO() as output:
+        img.save(output, format=OUTPUT_CODECS[codec][0], quality=100 if lossless else quality, lossless=lossless)
+        return output.getvalue()
+
+
+def encode_image_to_size(img, codec, size, quality_range):
+    """
+    Binary search the highest quality in quality_range of which the encoded image fit in size.
+    The image is only encoded again for each attempt, all processing is reused.
+    Return (encoded bytes, quality). If even the lowest quality does not fit, it is used anyway.
+    """
+    low, high = quality_range
+    best = None
+
+    # JPEG attempts skip the lossless optimization, it only make the chosen one smaller
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode_image(img, codec, quality, optimize=False)
+        if len(data) <= size:
+            best = (data, quality)
+            low = quality + 1
+            if len(data) >= size * (1 - TARGET_SIZE_TOLERANCE):
+                break
+        else:
+            high = quality - 1
+
+    if best is None:
+        best = (encode_image(img, codec, quality_range[0], optimize=False), quality_range[0])
+
+    data, quality = best
+    if codec == 'jpeg':
+        data = mozjpeg_lossless_optimization.optimize(data)
+    return data, quality
+
+
+# Open image from page handle (comicbook.Page) or file name
+def open_image(page):
+    if isinstance(page, str):
+        return Image.open(page)
+
+    with page.open() as fp:
+        img = Image.open(fp)
+        img.load()
+    return img
+
+
+# Difference hash, 64 bits of horizontal gradient of 9x8 thumbnail
+def image_dhash(img):
+    pixels = img.convert('L').resize((9, 8), Image.Resampling.BILINEAR).tobytes()
+    value = 0
+    for y in range(8):
+        for x in range(8):
+            value = (value << 1) | (pixels[y * 9 + x] > pixels[y * 9 + x + 1])
+    return value
 
 
 # Convert color to linear light according to sRGB
@@ -379,10 +630,17 @@ def color_gamma_correction_c(image, gamma):
 
 # Quantize color to 4-bit greyscale
 def color_quantize_bw(img):
+    img = color_quantize_bw_palette(img)
+    img = img.convert('RGB')
+
+    return img
+
+
+# Quantize to 16 level grey, as paletted image
+def color_quantize_bw_palette(img):
     img = img.convert('L')
     img = img.convert('RGB')
     img = img.quantize(colors=len(PALETTE_BW) / 3, palette=PAL_IMG_BW, dither=Image.Dither.FLOYDSTEINBERG)
-    img = img.convert('RGB')
 
     return img
 
@@ -18,7 +18,6 @@ from .compatibility_utils import hexlify
 
 add_cp65001_codec()
 
-from .unipath import pathof
 
 if PY2:
     range = xrange
@@ -183,7 +182,7 @@ class unpackException(Exception):
 
 
 # import the kindleunpack support libraries
-from .unpack_structure import fileNames
+from .unpack_structure import fileNames, FileSink, MemorySink
 from .mobi_sectioner import Sectionizer, describe
 from .mobi_header import MobiHeader, dump_contexth
 from .mobi_utils import toBase32
@@ -203,7 +202,7 @@ def processSRCS(i, files, rscnames, sect, data):
     # extract the source zip archive and save it.
     print("File contains kindlegen source archive, extracting as %s" % KINDLEGENSRC_FILENAME)
     srcname = os.path.join(files.outdir, KINDLEGENSRC_FILENAME)
-    with open(pathof(srcname), 'wb') as f:
+    with files.sink.open(srcname) as f:
         f.write(data[16:])
     rscnames.append(None)
     sect.setsectiondescription(i,"Zipped Source Files")
@@ -231,7 +230,7 @@ def processPAGE(i, files, rscnames, sect, data, mh, pagemapproc):
         outname = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.apnx')
     else:
         outname = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.apnx')
-    with open(pathof(outname), 'wb') as f:
+    with files.sink.open(outname) as f:
         f.write(apnx_data)
     return rscnames, pagemapproc
 
@@ -240,7 +239,7 @@ def processCMET(i, files, rscnames, sect, data):
     # extract the build log
     print("File contains kindlegen build log, extracting as %s" % KINDLEGENLOG_FILENAME)
     srcname = os.path.join(files.outdir, KINDLEGENLOG_FILENAME)
-    with open(pathof(srcname), 'wb') as f:
+    with files.sink.open(srcname) as f:
         f.write(data[10:])
     rscnames.append(None)
     sect.setsectiondescription(i,"Kindlegen log")
@@ -294,7 +293,7 @@ def processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr):
             obfuscate_data.append(fontname + ext)
         fontname += ext
         outfnt = os.path.join(files.imgdir, fontname)
-        with open(pathof(outfnt), 'wb') as f:
+        with files.sink.open(outfnt) as f:
             f.write(font_data)
         rscnames.append(fontname)
         sect.setsectiondescription(i,"Font {0:s}".format(fontname))
@@ -316,7 +315,7 @@ def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd):
         if DUMP:
             fname = "unknown%05d.dat" % i
             outname= os.path.join(files.outdir, fname)
-            with open(pathof(outname), 'wb') as f:
+            with files.sink.open(outname) as f:
                 f.write(data)
             sect.setsectiondescription(i,"Mysterious CRES data, first four bytes %s extracting as %s" % (describe(data[0:4]), fname))
         rsc_ptr += 1
@@ -331,7 +330,7 @@ def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd):
         imgdest = files.hdimgdir
     print("Extracting HD image: {0:s} from section {1:d}".format(imgname,i))
     outimg = os.path.join(imgdest, imgname)
-    with open(pathof(outimg), 'wb') as f:
+    with files.sink.open(outimg) as f:
         f.write(data)
     rscnames.append(None)
     sect.setsectiondescription(i,"Optional HD Image {0:s}".format(imgname))
@@ -357,7 +356,7 @@ def processCONT(i, files, rscnames, sect, data):
             dump_contexth(cpage, contexth)
             fname = "CONT_Header%05d.dat" % i
             outname= os.path.join(files.outdir, fname)
-            with open(pathof(outname), 'wb') as f:
+            with files.sink.open(outname) as f:
                 f.write(data)
     return rscnames
 
@@ -381,7 +380,7 @@ def processRESC(i, files, rscnames, sect, data, k8resc):
         rescname = "RESC%05d.dat" % i
         print("Extracting Resource: ", rescname)
         outrsc = os.path.join(files.outdir, rescname)
-        with open(pathof(outrsc), 'wb') as f:
+        with files.sink.open(outrsc) as f:
             f.write(data)
     if True:  # try:
         # parse the spine and metadata from RESC
@@ -405,7 +404,7 @@ def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thu
         if DUMP:
             fname = "unknown%05d.dat" % i
             outname= os.path.join(files.outdir, fname)
-            with open(pathof(outname), 'wb') as f:
+            with files.sink.open(outname) as f:
                 f.write(data)
             sect.setsectiondescription(i,"Mysterious Section, first four bytes %s extracting as %s" % (describe(data[0:4]), fname))
         return rscnames, rsc_ptr
@@ -417,7 +416,7 @@ def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset, thu
         imgname = "thumb%05d.%s" % (i, imgtype)
     print("Extracting image: {0:s} from section {1:d}".format(imgname,i))
     outimg = os.path.join(files.imgdir, imgname)
-    with open(pathof(outimg), 'wb') as f:
+    with files.sink.open(outimg) as f:
         f.write(data)
     rscnames.append(imgname)
     sect.setsectiondescription(i,"Image {0:s}".format(imgname))
@@ -432,7 +431,7 @@ def processPrintReplica(metadata, files, rscnames, mh):
     rawML = mh.getRawML()
     if DUMP or WRITE_RAW_DATA:
         outraw = os.path.join(files.outdir,files.getInputFileBasename() + '.rawpr')
-        with open(pathof(outraw),'wb') as f:
+        with files.sink.open(outraw) as f:
             f.write(rawML)
 
     fileinfo = []
@@ -451,7 +450,7 @@ def processPrintReplica(metadata, files, rscnames, mh):
                     entryName = os.path.join(files.outdir, files.getInputFileBasename() + ('.%03d.pdf' % (i+1)))
                 else:
                     entryName = os.path.join(files.outdir, files.getInputFileBasename() + ('.%03d.%03d.data' % ((i+1),j)))
-                with open(pathof(entryName), 'wb') as f:
+                with files.sink.open(entryName) as f:
                     f.write(rawML[sectionOffset:(sectionOffset+sectionLength)])
     except Exception as e:
         print('Error processing Print Replica: ' + str(e))
@@ -473,7 +472,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
     rawML = mh.getRawML()
     if DUMP or WRITE_RAW_DATA:
         outraw = os.path.join(files.k8dir,files.getInputFileBasename() + '.rawml')
-        with open(pathof(outraw),'wb') as f:
+        with files.sink.open(outraw) as f:
             f.write(rawML)
 
     # KF8 require other indexes which contain parsing information and the FDST info
@@ -514,7 +513,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
     if pagemapproc is not None:
         pagemapxml = pagemapproc.generateKF8PageMapXML(k8proc)
         outpm = os.path.join(files.k8oebps,'page-map.xml')
-        with open(pathof(outpm),'wb') as f:
+        with files.sink.open(outpm) as f:
             f.write(pagemapxml.encode('utf-8'))
         if DUMP:
             print(pagemapproc.getNames())
@@ -573,7 +572,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
         [skelnum, dir, filename, beg, end, aidtext] = k8proc.getPartInfo(i)
         fileinfo.append([str(skelnum), dir, filename])
         fname = os.path.join(files.k8oebps,dir,filename)
-        with open(pathof(fname),'wb') as f:
+        with files.sink.open(fname) as f:
             f.write(part)
     n = k8proc.getNumberOfFlows()
     for i in range(1, n):
@@ -582,7 +581,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
         if pformat == b'file':
             fileinfo.append([None, pdir, filename])
             fname = os.path.join(files.k8oebps,pdir,filename)
-            with open(pathof(fname),'wb') as f:
+            with files.sink.open(fname) as f:
                 f.write(flowpart)
 
     # create the opf
@@ -610,7 +609,7 @@ def processMobi7(mh, metadata, sect, files, rscnames):
     rawML = mh.getRawML()
     if DUMP or WRITE_RAW_DATA:
         outraw = os.path.join(files.mobi7dir,files.getInputFileBasename() + '.rawml')
-        with open(pathof(outraw),'wb') as f:
+        with files.sink.open(outraw) as f:
             f.write(rawML)
 
     # process the toc ncx
@@ -640,7 +639,7 @@ def processMobi7(mh, metadata, sect, files, rscnames):
     fname = 'book.html'
     fileinfo.append([None,'', fname])
     outhtml = os.path.join(files.mobi7dir, fname)
-    with open(pathof(outhtml), 'wb') as f:
+    with files.sink.open(outhtml) as f:
         f.write(srctext)
 
     # extract guidetext from srctext
@@ -717,7 +716,7 @@ def processUnknownSections(mh, sect, files, K8Boundary):
                 description = "Unknown INDX section"
                 if DUMP:
                     outname= os.path.join(files.outdir, fname)
-                    with open(pathof(outname), 'wb') as f:
+                    with files.sink.open(outname) as f:
                         f.write(data)
                     print("Extracting %s: %s from section %d" % (description, fname, i))
                     description = description + ", extracting as %s" % fname
@@ -726,7 +725,7 @@ def processUnknownSections(mh, sect, files, K8Boundary):
                 description = "Mysterious Section, first four bytes %s" % describe(data[0:4])
                 if DUMP:
                     outname= os.path.join(files.outdir, fname)
-                    with open(pathof(outname), 'wb') as f:
+                    with files.sink.open(outname) as f:
                         f.write(data)
                     print("Extracting %s: %s from section %d" % (description, fname, i))
                     description = description + ", extracting as %s" % fname
@@ -760,7 +759,7 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
 
         if DUMP:
             # write out raw mobi header data
-            with open(pathof(mhname), 'wb') as f:
+            with files.sink.open(mhname) as f:
                 f.write(mh.header)
 
         # process each mobi header
@@ -792,8 +791,11 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
             cover_offset = None
 
         for i in range(beg, end):
-            data = sect.loadSection(i)
-            type = data[0:4]
+            # images are written out from the file mapping without copying, other sections are parsed as bytes
+            data = sect.loadSectionView(i)
+            type = bytes(data[0:4])
+            if type in [b"FLIS", b"FCIS", b"FDST", b"DATP", b"SRCS", b"PAGE", b"CMET", b"FONT", b"CONT", b"kind", b"RESC"]:
+                data = bytes(data)
 
             # handle the basics first
             if type in [b"FLIS", b"FCIS", b"FDST", b"DATP"]:
@@ -803,7 +805,7 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
                         fname += "_K8"
                     fname += '.dat'
                     outname= os.path.join(files.outdir, fname)
-                    with open(pathof(outname), 'wb') as f:
+                    with files.sink.open(outname) as f:
                         f.write(data)
                     print("Dumping section {0:d} type {1:s} to file {2:s} ".format(i,unicode_str(type),outname))
                 sect.setsectiondescription(i,"Type {0:s}".format(unicode_str(type)))
@@ -858,7 +860,7 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
     return
 
 
-def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=False, dowriteraw=False, dosplitcombos=False):
+def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=False, dowriteraw=False, dosplitcombos=False, sink=None):
     global DUMP
     global WRITE_RAW_DATA
     global SPLIT_COMBO_MOBIS
@@ -874,65 +876,68 @@ def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=
     if apnxfile is not None:
         apnxfile = unicode_str(apnxfile)
 
-    files = fileNames(infile, outdir)
+    files = fileNames(infile, outdir, sink)
 
     # process the PalmDoc database header and verify it is a mobi
     sect = Sectionizer(infile)
-    if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
-        raise unpackException('Invalid file format')
-    if DUMP:
-        sect.dumppalmheader()
-    else:
-        print("Palm DB type: %s, %d sections." % (sect.ident.decode('utf-8'),sect.num_sections))
+    try:
+        if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
+            raise unpackException('Invalid file format')
+        if DUMP:
+            sect.dumppalmheader()
+        else:
+            print("Palm DB type: %s, %d sections." % (sect.ident.decode('utf-8'),sect.num_sections))
 
-    # scan sections to see if this is a compound mobi file (K8 format)
-    # and build a list of all mobi headers to process.
-    mhlst = []
-    mh = MobiHeader(sect,0)
-    # if this is a mobi8-only file hasK8 here will be true
-    mhlst.append(mh)
-    K8Boundary = -1
+        # scan sections to see if this is a compound mobi file (K8 format)
+        # and build a list of all mobi headers to process.
+        mhlst = []
+        mh = MobiHeader(sect,0)
+        # if this is a mobi8-only file hasK8 here will be true
+        mhlst.append(mh)
+        K8Boundary = -1
 
-    if mh.isK8():
-        print("Unpacking a KF8 book...")
-        hasK8 = True
-    else:
-        # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
-        # Find out which
-        hasK8 = False
-        for i in range(len(sect.sectionoffsets)-1):
-            before, after = sect.sectionoffsets[i:i+2]
-            if (after - before) == 8:
-                data = sect.loadSection(i)
-                if data == K8_BOUNDARY:
-                    sect.setsectiondescription(i,"Mobi/KF8 Boundary Section")
-                    mh = MobiHeader(sect,i+1)
-                    hasK8 = True
-                    mhlst.append(mh)
-                    K8Boundary = i
-                    break
-        if hasK8:
-            print("Unpacking a Combination M{0:d}/KF8 book...".format(mh.version))
-            if SPLIT_COMBO_MOBIS:
-                # if this is a combination mobi7-mobi8 file split them up
-                mobisplit = mobi_split(infile)
-                if mobisplit.combo:
-                    outmobi7 = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.mobi')
-                    outmobi8 = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.azw3')
-                    with open(pathof(outmobi7), 'wb') as f:
-                        f.write(mobisplit.getResult7())
-                    with open(pathof(outmobi8), 'wb') as f:
-                        f.write(mobisplit.getResult8())
+        if mh.isK8():
+            print("Unpacking a KF8 book...")
+            hasK8 = True
         else:
-            print("Unpacking a Mobipocket {0:d} book...".format(mh.version))
+            # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
+            # Find out which
+            hasK8 = False
+            for i in range(len(sect.sectionoffsets)-1):
+                before, after = sect.sectionoffsets[i:i+2]
+                if (after - before) == 8:
+                    data = sect.loadSection(i)
+                    if data == K8_BOUNDARY:
+                        sect.setsectiondescription(i,"Mobi/KF8 Boundary Section")
+                        mh = MobiHeader(sect,i+1)
+                        hasK8 = True
+                        mhlst.append(mh)
+                        K8Boundary = i
+                        break
+            if hasK8:
+                print("Unpacking a Combination M{0:d}/KF8 book...".format(mh.version))
+                if SPLIT_COMBO_MOBIS:
+                    # if this is a combination mobi7-mobi8 file split them up
+                    mobisplit = mobi_split(infile)
+                    if mobisplit.combo:
+                        outmobi7 = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.mobi')
+                        outmobi8 = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.azw3')
+                        with files.sink.open(outmobi7) as f:
+                            f.write(mobisplit.getResult7())
+                        with files.sink.open(outmobi8) as f:
+                            f.write(mobisplit.getResult8())
+            else:
+                print("Unpacking a Mobipocket {0:d} book...".format(mh.version))
 
-    if hasK8:
-        files.makeK8Struct()
+        if hasK8:
+            files.makeK8Struct()
 
-    process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, False, epubver, use_hd)
+        process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, False, epubver, use_hd)
 
-    if DUMP:
-        sect.dumpsectionsinfo()
+        if DUMP:
+            sect.dumpsectionsinfo()
+    finally:
+        sect.close()
     return
 
 
@@ -8,7 +8,6 @@ from .compatibility_utils import unicode_str
 
 from .unipath import pathof
 import os
-import imghdr
 
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
@@ -33,88 +32,128 @@ MAX_HEIGHT = 4096
 """ The max height for the svg cover page. """
 
 
-def get_image_type(imgname, imgdata=None):
-    imgtype = unicode_str(imghdr.what(pathof(imgname), imgdata))
-
-    # imghdr only checks for JFIF or Exif JPEG files. Apparently, there are some
-    # with only the magic JPEG bytes out there...
-    # ImageMagick handles those, so, do it too.
-    if imgtype is None:
-        if imgdata is None:
-            with open(pathof(imgname), 'rb') as f:
-                imgdata = f.read()
-        if imgdata[0:2] == b'\xFF\xD8':
-            # Get last non-null bytes
-            last = len(imgdata)
-            while (imgdata[last-1:last] == b'\x00'):
-                last-=1
-            # Be extra safe, check the trailing bytes, too.
-            if imgdata[last-2:last] == b'\xFF\xD9':
-                imgtype = "jpeg"
-    return imgtype
+# Magic bytes of the resources recognised by their first bytes, indexed by the first two bytes.
+# JPEG, WebP and SVG need more than one check and are handled in resource_type
+RESOURCE_SIGNATURES = {
+    b'\x89P': ((b'\x89PNG\r\n\x1a\n', 'png'),),
+    b'GI': ((b'GIF87a', 'gif'), (b'GIF89a', 'gif')),
+    b'II': ((b'II*\x00', 'tiff'),),
+    b'MM': ((b'MM\x00*', 'tiff'),),
+    b'BM': ((b'BM', 'bmp'),),
+    b'OT': ((b'OTTO', 'otf'),),
+    b'\x00\x01': ((b'\x00\x01\x00\x00', 'ttf'),),
+    b'tr': ((b'true', 'ttf'),),
+    b'wO': ((b'wOFF', 'woff'), (b'wOF2', 'woff2')),
+}
 
+FONT_TYPES = ('otf', 'ttf', 'woff', 'woff2')
 
-def get_image_size(imgname, imgdata=None):
-    '''Determine the image type of imgname (or imgdata) and return its size.
 
-    Originally,
-    Determine the image type of fhandle and return its size.
-    from draco'''
-    if imgdata is None:
-        fhandle = open(pathof(imgname), 'rb')
-        head = fhandle.read(24)
-    else:
-        head = imgdata[0:24]
-    if len(head) != 24:
-        return
+def _jpeg_trailer(imgdata):
+    # Some JPEG have only the magic bytes without JFIF or Exif marker,
+    # check for the end of image marker before the null padding too, as ImageMagick does
+    last = len(imgdata)
+    while last > 0 and imgdata[last-1] in (0, b'\x00'):
+        last -= 1
+    return bytes(imgdata[max(last-2, 0):last]) == b'\xFF\xD9'
+
+
+def _jpeg_size(imgdata):
+    # Jump from marker to marker until the start of frame
+    try:
+        pos = 2
+        while True:
+            while bytes(imgdata[pos:pos+1]) == b'\xff':
+                pos += 1
+            ftype = ord(bytes(imgdata[pos:pos+1]))
+            if 0xc0 <= ftype <= 0xcf and ftype not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack_from(b'>HH', imgdata, pos + 4)
+                return width, height
+            size, = struct.unpack_from(b'>H', imgdata, pos + 1)
+            pos += 1 + size
+    except Exception:  # IGNORE:W0703
+        return None, None
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        width, height = struct.unpack(b'<HH', head[26:30])
+        return width & 0x3fff, height & 0x3fff
+    if chunk == b'VP8L':
+        bits, = struct.unpack(b'<L', head[21:25])
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b'VP8X':
+        return (struct.unpack(b'<L', head[24:27] + b'\x00')[0] + 1,
+                struct.unpack(b'<L', head[27:30] + b'\x00')[0] + 1)
+    return None, None
+
+
+def resource_type(imgdata, head=None):
+    '''Return the type of image or font data from its signature, or None if not recognised.
+    Only the first bytes are read, and the last bytes of JPEG without JFIF or Exif marker.
+    imgdata can be bytes or memoryview.'''
+    if head is None:
+        head = bytes(imgdata[:32])
+
+    if head[6:10] in (b'JFIF', b'Exif') or head[:4] == b'\xff\xd8\xff\xdb' or (
+            head[:2] == b'\xff\xd8' and _jpeg_trailer(imgdata)):
+        return 'jpeg'
+
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+
+    for magic, imgtype in RESOURCE_SIGNATURES.get(head[:2], ()):
+        if head.startswith(magic):
+            return imgtype
 
-    imgtype = get_image_type(imgname, imgdata)
-    if imgtype == 'png':
-        check = struct.unpack(b'>i', head[4:8])[0]
-        if check != 0x0d0a1a0a:
-            return
-        width, height = struct.unpack(b'>ii', head[16:24])
+    text = bytes(imgdata[:1024]).lstrip()
+    if text[:1] == b'<' and b'<svg' in text:
+        return 'svg'
+
+    return None
+
+
+def sniff_resource(imgdata):
+    '''Return (type, width, height) of image or font data in one pass.
+    Width and height are None if not known.'''
+    head = bytes(imgdata[:32])
+    imgtype = resource_type(imgdata, head)
+    width, height = None, None
+    if imgtype == 'jpeg':
+        width, height = _jpeg_size(imgdata)
+    elif imgtype == 'webp':
+        width, height = _webp_size(head)
+    elif imgtype == 'png' and head[12:16] == b'IHDR':
+        width, height = struct.unpack(b'>LL', head[16:24])
     elif imgtype == 'gif':
         width, height = struct.unpack(b'<HH', head[6:10])
-    elif imgtype == 'jpeg' and imgdata is None:
-        try:
-            fhandle.seek(0)  # Read 0xff next
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                fhandle.seek(size, 1)
-                byte = fhandle.read(1)
-                while ord(byte) == 0xff:
-                    byte = fhandle.read(1)
-                ftype = ord(byte)
-                size = struct.unpack(b'>H', fhandle.read(2))[0] - 2
-            # We are at a SOFn block
-            fhandle.seek(1, 1)  # Skip `precision' byte.
-            height, width = struct.unpack(b'>HH', fhandle.read(4))
-        except Exception:  # IGNORE:W0703
-            return
-    elif imgtype == 'jpeg' and imgdata is not None:
-        try:
-            pos = 0
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                pos += size
-                byte = imgdata[pos:pos+1]
-                pos += 1
-                while ord(byte) == 0xff:
-                    byte = imgdata[pos:pos+1]
-                    pos += 1
-                ftype = ord(byte)
-                size = struct.unpack(b'>H', imgdata[pos:pos+2])[0] - 2
-                pos += 2
-            # We are at a SOFn block
-            pos += 1  # Skip `precision' byte.
-            height, width = struct.unpack(b'>HH', imgdata[pos:pos+4])
-            pos += 4
-        except Exception:  # IGNORE:W0703
-            return
-    else:
+    elif imgtype == 'bmp' and len(head) >= 26:
+        if struct.unpack(b'<L', head[14:18])[0] == 12:
+            width, height = struct.unpack(b'<HH', head[18:22])
+        else:
+            width, height = struct.unpack(b'<ll', head[18:26])
+            height = abs(height)
+    return imgtype, width, height
+
+
+def get_image_type(imgname, imgdata=None):
+    if imgdata is None:
+        with open(pathof(imgname), 'rb') as f:
+            imgdata = f.read()
+    imgtype = resource_type(imgdata)
+    if imgtype in FONT_TYPES:
+        return None
+    return imgtype
+
+
+def get_image_size(imgname, imgdata=None):
+    '''Determine the image type of imgname (or imgdata) and return its size.'''
+    if imgdata is None:
+        with open(pathof(imgname), 'rb') as f:
+            imgdata = f.read()
+    imgtype, width, height = sniff_resource(imgdata)
+    if imgtype in FONT_TYPES or width is None:
         return
     return width, height
 
@@ -153,7 +192,7 @@ class CoverProcessor(object):
             try:
                 if imgdata is None:
                     fname = os.path.join(files.imgdir, self.cover_image)
-                    [self.width, self.height] = get_image_size(fname)
+                    [self.width, self.height] = get_image_size(None, files.sink.read(fname))
                 else:
                     [self.width, self.height] = get_image_size(None, imgdata)
             except:
@@ -223,10 +262,10 @@ class CoverProcessor(object):
         data = self.buildXHTML()
 
         outfile = os.path.join(files.k8text, cover_page)
-        if os.path.exists(pathof(outfile)):
+        if files.sink.exists(outfile):
             print('Warning: {:s} already exists.'.format(cover_page))
-            os.remove(pathof(outfile))
-        with open(pathof(outfile), 'wb') as f:
+            files.sink.remove(outfile)
+        with files.sink.open(outfile) as f:
             f.write(data.encode('utf-8'))
         return
 
@@ -19,7 +19,7 @@ import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
-from .mobi_index import getVariableWidthValue, readTagSection, getTagMap
+from .mobi_index import getVariableWidthValue, readTagSection, getTagMap, getTagPlan, readIndexEntries
 from .mobi_utils import toHex
 
 DEBUG_DICT = False
@@ -65,6 +65,9 @@ class dictSupport(object):
         self.sect = sect
         self.metaOrthIndex = mh.metaOrthIndex
         self.metaInflIndex = mh.metaInflIndex
+        # decoded inflection groups and rules, shared by all entries that use them
+        self.inflectionGroups = {}
+        self.inflectionRules = {}
 
     def parseHeader(self, data):
         "read INDX header"
@@ -114,6 +117,8 @@ class dictSupport(object):
         return header, ordt1, ordt2
 
     def getPositionMap(self):
+        # map of text positions to the list of markup pieces to insert there, in order,
+        # the pieces are only joined once when they are merged into the text
         sect = self.sect
 
         positionMap = {}
@@ -165,23 +170,15 @@ class dictSupport(object):
                 print("Info: Index doesn't contain entry length tags")
 
             print("Read dictionary index data")
+            plan = getTagPlan(controlByteCount, tagTable)
             for i in range(metaOrthIndex + 1, metaOrthIndex + 1 + orthIndexCount):
                 data = sect.loadSection(i)
                 hdrinfo, ordt1, ordt2 = self.parseHeader(data)
                 idxtPos = hdrinfo['start']
                 entryCount = hdrinfo['count']
-                idxPositions = []
-                for j in range(entryCount):
-                    pos, = struct.unpack_from(b'>H', data, idxtPos + 4 + (2 * j))
-                    idxPositions.append(pos)
-                # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
-                idxPositions.append(idxtPos)
-                for j in range(entryCount):
-                    startPos = idxPositions[j]
-                    endPos = idxPositions[j+1]
-                    textLength = ord(data[startPos:startPos+1])
-                    text = data[startPos+1:startPos+1+textLength]
+                for text, tagMap in readIndexEntries(data, idxtPos, entryCount, plan):
                     if hordt2 is not None:
+                        textLength = len(text)
                         utext = u""
                         if idxhdr['otype'] == 0:
                             pattern = b'>H'
@@ -199,7 +196,6 @@ class dictSupport(object):
                             pos += inc
                         text = utext.encode('utf-8')
 
-                    tagMap = getTagMap(controlByteCount, tagTable, data, startPos+1+textLength, endPos)
                     if 0x01 in tagMap:
                         if decodeInflection and 0x2a in tagMap:
                             inflectionGroups = self.getInflectionGroups(text, inflectionControlByteCount, inflectionTagTable,
@@ -211,23 +207,27 @@ class dictSupport(object):
                         if hasEntryLength:
                             # The idx:entry attribute "scriptable" must be present to create entry length tags.
                             ml = b'<idx:entry scriptable="yes"><idx:orth value="' + text + b'">' + inflectionGroups + b'</idx:orth>'
-                            if entryStartPosition in positionMap:
-                                positionMap[entryStartPosition] = positionMap[entryStartPosition] + ml
+                            pieces = positionMap.get(entryStartPosition)
+                            if pieces is not None:
+                                pieces.append(ml)
                             else:
-                                positionMap[entryStartPosition] = ml
+                                positionMap[entryStartPosition] = [ml]
                             assert len(tagMap[0x02]) == 1
                             entryEndPosition = entryStartPosition + tagMap[0x02][0]
-                            if entryEndPosition in positionMap:
-                                positionMap[entryEndPosition] = b"</idx:entry>" + positionMap[entryEndPosition]
+                            pieces = positionMap.get(entryEndPosition)
+                            if pieces is not None:
+                                # entries ending here are closed before any entry starting here
+                                pieces.insert(0, b"</idx:entry>")
                             else:
-                                positionMap[entryEndPosition] = b"</idx:entry>"
+                                positionMap[entryEndPosition] = [b"</idx:entry>"]
 
                         else:
                             indexTags = b'<idx:entry>\n<idx:orth value="' + text + b'">\n' + inflectionGroups + b'</idx:entry>\n'
-                            if entryStartPosition in positionMap:
-                                positionMap[entryStartPosition] = positionMap[entryStartPosition] + indexTags
+                            pieces = positionMap.get(entryStartPosition)
+                            if pieces is not None:
+                                pieces.append(indexTags)
                             else:
-                                positionMap[entryStartPosition] = indexTags
+                                positionMap[entryStartPosition] = [indexTags]
         return positionMap
 
     def hasTag(self, tagTable, tag):
@@ -257,41 +257,69 @@ class dictSupport(object):
         '''
         result = b""
         for value in groupList:
-            offset, nextOffset, data = dinfl.offsets(value)
-
-            # First byte seems to be always 0x00 and must be skipped.
-            assert ord(data[offset:offset+1]) == 0x00
-            tagMap = getTagMap(controlByteCount, tagTable, data, offset + 1, nextOffset)
-
-            # Make sure that the required tags are available.
-            if 0x05 not in tagMap:
-                print("Error: Required tag 0x05 not found in tagMap")
-                return ""
-            if 0x1a not in tagMap:
-                print("Error: Required tag 0x1a not found in tagMap")
+            if value in self.inflectionGroups:
+                group = self.inflectionGroups[value]
+            else:
+                group = self.inflectionGroups[value] = self.getInflectionGroup(controlByteCount, tagTable, dinfl,
+                                                                               inflectionNames, value)
+            if group is None:
+                # Required tag is missing, the error was printed when the group was decoded.
                 return b''
 
             result += b'<idx:infl>'
 
-            for i in range(len(tagMap[0x05])):
-
-                # Get name of inflection rule.
-                value = tagMap[0x05][i]
-                consumed, textLength = getVariableWidthValue(inflectionNames, value)
-                inflectionName = inflectionNames[value+consumed:value+consumed+textLength]
-
-                # Get and apply inflection rule across possibly multiple inflection data sections
-                value = tagMap[0x1a][i]
-                rvalue, start, count, data = dinfl.lookup(value)
-                offset, = struct.unpack_from(b'>H', data, start + 4 + (2 * rvalue))
-                textLength = ord(data[offset:offset+1])
-                inflection = self.applyInflectionRule(mainEntry, data, offset+1, offset+1+textLength)
+            for inflectionName, rule in group:
+                inflection = self.applyInflectionRule(mainEntry, rule, 0, len(rule))
                 if inflection is not None:
                     result += b'  <idx:iform name="' + inflectionName + b'" value="' + inflection + b'"/>'
 
             result += b'</idx:infl>'
         return result
 
+    def getInflectionGroup(self, controlByteCount, tagTable, dinfl, inflectionNames, value):
+        '''
+        Decode an inflection group into its inflection rule names and rules.
+
+        @param controlByteCount: The number of control bytes.
+        @param tagTable: The tag table.
+        @param dinfl: The Inflection data object to properly select the right inflection data section to use
+        @param inflectionNames: The inflection rule name data.
+        @param value: The inflection group to decode.
+        @return: List of tuples of inflection rule name and rule, or None if required tags are not available.
+        '''
+        offset, nextOffset, data = dinfl.offsets(value)
+
+        # First byte seems to be always 0x00 and must be skipped.
+        assert ord(data[offset:offset+1]) == 0x00
+        tagMap = getTagMap(controlByteCount, tagTable, data, offset + 1, nextOffset)
+
+        # Make sure that the required tags are available.
+        if 0x05 not in tagMap:
+            print("Error: Required tag 0x05 not found in tagMap")
+            return None
+        if 0x1a not in tagMap:
+            print("Error: Required tag 0x1a not found in tagMap")
+            return None
+
+        group = []
+        for i in range(len(tagMap[0x05])):
+
+            # Get name of inflection rule.
+            value = tagMap[0x05][i]
+            consumed, textLength = getVariableWidthValue(inflectionNames, value)
+            inflectionName = inflectionNames[value+consumed:value+consumed+textLength]
+
+            # Get inflection rule across possibly multiple inflection data sections
+            value = tagMap[0x1a][i]
+            rule = self.inflectionRules.get(value)
+            if rule is None:
+                rvalue, start, count, data = dinfl.lookup(value)
+                offset, = struct.unpack_from(b'>H', data, start + 4 + (2 * rvalue))
+                textLength = ord(data[offset:offset+1])
+                rule = self.inflectionRules[value] = data[offset+1:offset+1+textLength]
+            group.append((inflectionName, rule))
+        return group
+
     def applyInflectionRule(self, mainEntry, inflectionRuleData, start, end):
         '''
         Apply inflection rule.
@@ -305,9 +333,7 @@ class dictSupport(object):
         mode = -1
         byteArray = array.array(array_format, mainEntry)
         position = len(byteArray)
-        for charOffset in range(start, end):
-            char = inflectionRuleData[charOffset:charOffset+1]
-            abyte = ord(char)
+        for abyte in bytearray(inflectionRuleData[start:end]):
             if abyte >= 0x0a and abyte <= 0x13:
                 # Move cursor backwards
                 offset = abyte - 0x0a
@@ -334,17 +360,17 @@ class dictSupport(object):
                         # Delete at word end
                         position -= 1
                         deleted = byteArray.pop(position)
-                        if bchr(deleted) != char:
+                        if deleted != abyte:
                             if DEBUG_DICT:
-                                print("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), char, bchr(deleted)))
+                                print("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), bchr(abyte), bchr(deleted)))
                             print("Error: Delete operation of inflection rule failed")
                             return None
                     elif mode == 0x04:
                         # Delete at word start
                         deleted = byteArray.pop(position)
-                        if bchr(deleted) != char:
+                        if deleted != abyte:
                             if DEBUG_DICT:
-                                print("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), char, bchr(deleted)))
+                                print("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), bchr(abyte), bchr(deleted)))
                             print("Error: Delete operation of inflection rule failed")
                             return None
                     else:
@@ -374,4 +400,6 @@ class dictSupport(object):
             else:
                 print("Error: Inflection rule mode %x is not implemented" % abyte)
                 return None
-        return utf8_str(byteArray.tostring())
+        if PY2:
+            return utf8_str(byteArray.tostring())
+        return utf8_str(byteArray.tobytes())
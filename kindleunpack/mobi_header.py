@@ -28,6 +28,30 @@ class unpackException(Exception):
     pass
 
 
+def getSizeOfTrailingDataEntry(data):
+    num = 0
+    for v in data[-4:]:
+        if bord(v) & 0x80:
+            num = 0
+        num = (num << 7) | (bord(v) & 0x7f)
+    return num
+
+
+def trimTrailingDataEntries(data, trailers, multibyte):
+    for _ in range(trailers):
+        num = getSizeOfTrailingDataEntry(data)
+        data = data[:-num]
+    if multibyte:
+        num = (ord(data[-1:]) & 3) + 1
+        data = data[:-num]
+    return data
+
+
+def unpackTextRecords(unpack, records, trailers, multibyte):
+    # decompressed in this process, a worker pool did not pay off (see bench/bench_text_records.py)
+    return [unpack(trimTrailingDataEntries(data, trailers, multibyte)) for data in records]
+
+
 def sortedHeaderKeys(mheader):
     hdrkeys = sorted(list(mheader.keys()), key=lambda akey: mheader[akey][0])
     return hdrkeys
@@ -813,21 +837,6 @@ class MobiHeader:
         return False
 
     def getRawML(self):
-        def getSizeOfTrailingDataEntry(data):
-            num = 0
-            for v in data[-4:]:
-                if bord(v) & 0x80:
-                    num = 0
-                num = (num << 7) | (bord(v) & 0x7f)
-            return num
-        def trimTrailingDataEntries(data):
-            for _ in range(trailers):
-                num = getSizeOfTrailingDataEntry(data)
-                data = data[:-num]
-            if multibyte:
-                num = (ord(data[-1:]) & 3) + 1
-                data = data[:-num]
-            return data
         multibyte = 0
         trailers = 0
         if self.sect.ident == b'BOOKMOBI':
@@ -842,18 +851,16 @@ class MobiHeader:
                     flags = flags >> 1
         # get raw mobi markup languge
         print("Unpacking raw markup language")
-        dataList = []
-        # offset = 0
+        records = []
         for i in range(1, self.records+1):
-            data = trimTrailingDataEntries(self.sect.loadSection(self.start + i))
-            dataList.append(self.unpack(data))
+            records.append(self.sect.loadSection(self.start + i))
             if self.isK8():
                 self.sect.setsectiondescription(self.start + i,"KF8 Text Section {0:d}".format(i))
             elif self.version == 0:
                 self.sect.setsectiondescription(self.start + i,"PalmDOC Text Section {0:d}".format(i))
             else:
                 self.sect.setsectiondescription(self.start + i,"Mobipocket Text Section {0:d}".format(i))
-        rawML = b''.join(dataList)
+        rawML = b''.join(unpackTextRecords(self.unpack, records, trailers, multibyte))
         self.rawSize = len(rawML)
         return rawML
 
@@ -39,25 +39,26 @@ class HTMLProcessor:
 
         for position in pos_links:
             if position in positionMap:
-                positionMap[position] = positionMap[position] + utf8_str('<a id="filepos%d" />' % position)
+                positionMap[position].append(utf8_str('<a id="filepos%d" />' % position))
             else:
-                positionMap[position] = utf8_str('<a id="filepos%d" />' % position)
+                positionMap[position] = [utf8_str('<a id="filepos%d" />' % position)]
 
         # apply dictionary metadata and anchors
         print("Insert data into html")
         pos = 0
         lastPos = len(rawtext)
-        dataList = []
+        # the text and the markup are appended straight to srctext in a single pass,
+        # without a list of all the pieces to join
+        srctext = bytearray()
         for end in sorted(positionMap.keys()):
             if end == 0 or end > lastPos:
                 continue  # something's up - can't put a tag in outside <html>...</html>
-            dataList.append(rawtext[pos:end])
-            dataList.append(positionMap[end])
+            srctext += rawtext[pos:end]
+            for markup in positionMap[end]:
+                srctext += markup
             pos = end
-        dataList.append(rawtext[pos:])
-        srctext = b"".join(dataList)
+        srctext += rawtext[pos:]
         rawtext = None
-        dataList = None
         self.srctext = srctext
         self.indx_data = indx_data
         return srctext
@@ -107,6 +108,175 @@ class HTMLProcessor:
         return srctext, self.used
 
 
+def linkPart(k8proc, part):
+    # update all links that are internal which are based on positions within the xhtml files,
+    # the aids linked to are returned instead of being added to k8proc.linked_aids
+
+    #   kindle:pos:fid:XXXX:off:YYYYYYYYYY  (used for internal link within xhtml)
+    #       XXXX is the offset in records into divtbl
+    #       YYYYYYYYYYYY is a base32 number you add to the divtbl insertpos to get final position
+
+    # pos:fid pattern
+    posfid_pattern = re.compile(br'''(<a.*?href=.*?>)''', re.IGNORECASE)
+    posfid_index_pattern = re.compile(br'''['"]kindle:pos:fid:([0-9|A-V]+):off:([0-9|A-V]+).*?["']''')
+
+    linked_aids = k8proc.linked_aids
+    k8proc.linked_aids = set()
+    try:
+        # internal links
+        srcpieces = posfid_pattern.split(part)
+        for j in range(1, len(srcpieces),2):
+            tag = srcpieces[j]
+            if tag.startswith(b'<'):
+                for m in posfid_index_pattern.finditer(tag):
+                    posfid = m.group(1)
+                    offset = m.group(2)
+                    filename, idtag = k8proc.getIDTagByPosFid(posfid, offset)
+                    if idtag == b'':
+                        replacement= b'"' + utf8_str(filename) + b'"'
+                    else:
+                        replacement = b'"' + utf8_str(filename) + b'#' + idtag + b'"'
+                    tag = posfid_index_pattern.sub(replacement, tag, 1)
+                srcpieces[j] = tag
+        part = b"".join(srcpieces)
+        return part, k8proc.linked_aids
+    finally:
+        k8proc.linked_aids = linked_aids
+
+
+def finishPart(state, part):
+    # all passes after the internal links are updated, return the part and the names of the files it uses
+    linked_aids, flows, flowinfo, rscnames = state
+    used = []
+
+    # we are free to cut and paste as we see fit
+    # we can safely remove all of the Kindlegen generated aid tags
+    # change aid ids that are in k8proc.linked_aids to xhtml ids
+    find_tag_with_aid_pattern = re.compile(br'''(<[^>]*\said\s*=[^>]*>)''', re.IGNORECASE)
+    within_tag_aid_position_pattern = re.compile(br'''\said\s*=['"]([^'"]*)['"]''')
+    srcpieces = find_tag_with_aid_pattern.split(part)
+    for j in range(len(srcpieces)):
+        tag = srcpieces[j]
+        if tag.startswith(b'<'):
+            for m in within_tag_aid_position_pattern.finditer(tag):
+                try:
+                    aid = m.group(1)
+                except IndexError:
+                    aid = None
+                replacement = b''
+                if aid in linked_aids:
+                    replacement = b' id="aid-' + aid + b'"'
+                tag = within_tag_aid_position_pattern.sub(replacement, tag, 1)
+            srcpieces[j] = tag
+    part = b"".join(srcpieces)
+
+    # we can safely replace all of the Kindlegen generated data-AmznPageBreak tags
+    # with page-break-after style patterns
+    find_tag_with_AmznPageBreak_pattern = re.compile(br'''(<[^>]*\sdata-AmznPageBreak=[^>]*>)''', re.IGNORECASE)
+    within_tag_AmznPageBreak_position_pattern = re.compile(br'''\sdata-AmznPageBreak=['"]([^'"]*)['"]''')
+    srcpieces = find_tag_with_AmznPageBreak_pattern.split(part)
+    for j in range(len(srcpieces)):
+        tag = srcpieces[j]
+        if tag.startswith(b'<'):
+            srcpieces[j] = within_tag_AmznPageBreak_position_pattern.sub(
+                lambda m:b' style="page-break-after:' + m.group(1) + b'"', tag)
+    part = b"".join(srcpieces)
+
+    # Handle the flow items in the XHTML text pieces
+    # kindle:flow:XXXX?mime=YYYY/ZZZ (used for style sheets, svg images, etc)
+    tag_pattern = re.compile(br'''(<[^>]*>)''')
+    flow_pattern = re.compile(br'''['"]kindle:flow:([0-9|A-V]+)\?mime=([^'"]+)['"]''', re.IGNORECASE)
+    # flow pattern
+    srcpieces = tag_pattern.split(part)
+    for j in range(1, len(srcpieces),2):
+        tag = srcpieces[j]
+        if tag.startswith(b'<'):
+            for m in flow_pattern.finditer(tag):
+                num = fromBase32(m.group(1))
+                if num > 0 and num < len(flowinfo):
+                    [typ, fmt, pdir, fnm] = flowinfo[num]
+                    flowpart = flows[num]
+                    if fmt == b'inline':
+                        tag = flowpart
+                    else:
+                        replacement = b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
+                        tag = flow_pattern.sub(replacement, tag, 1)
+                        used.append(fnm)
+                else:
+                    print("warning: ignoring non-existent flow link", tag, " value 0x%x" % num)
+            srcpieces[j] = tag
+    part = b''.join(srcpieces)
+
+    # Handle any embedded raster images links in style= attributes urls
+    style_pattern = re.compile(br'''(<[a-zA-Z0-9]+\s[^>]*style\s*=\s*[^>]*>)''', re.IGNORECASE)
+    img_index_pattern = re.compile(br'''[('"]kindle:embed:([0-9|A-V]+)[^'"]*['")]''', re.IGNORECASE)
+
+    # replace urls in style attributes
+    srcpieces = style_pattern.split(part)
+    for j in range(1, len(srcpieces),2):
+        tag = srcpieces[j]
+        if b'kindle:embed' in tag:
+            for m in img_index_pattern.finditer(tag):
+                imageNumber = fromBase32(m.group(1))
+                imageName = rscnames[imageNumber-1]
+                osep = m.group()[0:1]
+                csep = m.group()[-1:]
+                if imageName is not None:
+                    replacement = osep + b'../Images/'+ utf8_str(imageName) + csep
+                    used.append(imageName)
+                    tag = img_index_pattern.sub(replacement, tag, 1)
+                else:
+                    print("Error: Referenced image %s in style url was not recognized in %s" % (imageNumber, tag))
+            srcpieces[j] = tag
+    part = b"".join(srcpieces)
+
+    # Handle any embedded raster images links in the xhtml text
+    # kindle:embed:XXXX?mime=image/gif (png, jpeg, etc) (used for images)
+    img_pattern = re.compile(br'''(<[img\s|image\s][^>]*>)''', re.IGNORECASE)
+    img_index_pattern = re.compile(br'''['"]kindle:embed:([0-9|A-V]+)[^'"]*['"]''')
+
+    # links to raster image files
+    # image_pattern
+    srcpieces = img_pattern.split(part)
+    for j in range(1, len(srcpieces),2):
+        tag = srcpieces[j]
+        if tag.startswith(b'<im'):
+            for m in img_index_pattern.finditer(tag):
+                imageNumber = fromBase32(m.group(1))
+                imageName = rscnames[imageNumber-1]
+                if imageName is not None:
+                    replacement = b'"../Images/' + utf8_str(imageName) + b'"'
+                    used.append(imageName)
+                    tag = img_index_pattern.sub(replacement, tag, 1)
+                else:
+                    print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
+            srcpieces[j] = tag
+    part = b"".join(srcpieces)
+
+    # finally perform any general cleanups needed to make valid XHTML
+    # these include:
+    #   in svg tags replace "perserveaspectratio" attributes with "perserveAspectRatio"
+    #   in svg tags replace "viewbox" attributes with "viewBox"
+    #   in <li> remove value="XX" attributes since these are illegal
+    tag_pattern = re.compile(br'''(<[^>]*>)''')
+    li_value_pattern = re.compile(br'''\svalue\s*=\s*['"][^'"]*['"]''', re.IGNORECASE)
+
+    # tag pattern
+    srcpieces = tag_pattern.split(part)
+    for j in range(1, len(srcpieces),2):
+        tag = srcpieces[j]
+        if tag.startswith(b'<svg') or tag.startswith(b'<SVG'):
+            tag = tag.replace(b'preserveaspectratio',b'preserveAspectRatio')
+            tag = tag.replace(b'viewbox',b'viewBox')
+        elif tag.startswith(b'<li ') or tag.startswith(b'<LI '):
+            tagpieces = li_value_pattern.split(tag)
+            tag = b"".join(tagpieces)
+        srcpieces[j] = tag
+    part = b"".join(srcpieces)
+
+    return part, used
+
+
 class XHTMLK8Processor:
 
     def __init__(self, rscnames, k8proc):
@@ -119,77 +289,15 @@ class XHTMLK8Processor:
         # first need to update all links that are internal which
         # are based on positions within the xhtml files **BEFORE**
         # cutting and pasting any pieces into the xhtml text files
-
-        #   kindle:pos:fid:XXXX:off:YYYYYYYYYY  (used for internal link within xhtml)
-        #       XXXX is the offset in records into divtbl
-        #       YYYYYYYYYYYY is a base32 number you add to the divtbl insertpos to get final position
-
-        # pos:fid pattern
-        posfid_pattern = re.compile(br'''(<a.*?href=.*?>)''', re.IGNORECASE)
-        posfid_index_pattern = re.compile(br'''['"]kindle:pos:fid:([0-9|A-V]+):off:([0-9|A-V]+).*?["']''')
+        # each part is processed on its own, see linkPart and finishPart
 
         parts = []
         print("Building proper xhtml for each file")
-        for i in range(self.k8proc.getNumberOfParts()):
-            part = self.k8proc.getPart(i)
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.getPartInfo(i)
-
-            # internal links
-            srcpieces = posfid_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    for m in posfid_index_pattern.finditer(tag):
-                        posfid = m.group(1)
-                        offset = m.group(2)
-                        filename, idtag = self.k8proc.getIDTagByPosFid(posfid, offset)
-                        if idtag == b'':
-                            replacement= b'"' + utf8_str(filename) + b'"'
-                        else:
-                            replacement = b'"' + utf8_str(filename) + b'#' + idtag + b'"'
-                        tag = posfid_index_pattern.sub(replacement, tag, 1)
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
+        sources = [self.k8proc.getPart(i) for i in range(self.k8proc.getNumberOfParts())]
+        for source in sources:
+            part, linked_aids = linkPart(self.k8proc, source)
             parts.append(part)
-
-        # we are free to cut and paste as we see fit
-        # we can safely remove all of the Kindlegen generated aid tags
-        # change aid ids that are in k8proc.linked_aids to xhtml ids
-        find_tag_with_aid_pattern = re.compile(br'''(<[^>]*\said\s*=[^>]*>)''', re.IGNORECASE)
-        within_tag_aid_position_pattern = re.compile(br'''\said\s*=['"]([^'"]*)['"]''')
-        for i in range(len(parts)):
-            part = parts[i]
-            srcpieces = find_tag_with_aid_pattern.split(part)
-            for j in range(len(srcpieces)):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    for m in within_tag_aid_position_pattern.finditer(tag):
-                        try:
-                            aid = m.group(1)
-                        except IndexError:
-                            aid = None
-                        replacement = b''
-                        if aid in self.k8proc.linked_aids:
-                            replacement = b' id="aid-' + aid + b'"'
-                        tag = within_tag_aid_position_pattern.sub(replacement, tag, 1)
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
-            parts[i] = part
-
-        # we can safely replace all of the Kindlegen generated data-AmznPageBreak tags
-        # with page-break-after style patterns
-        find_tag_with_AmznPageBreak_pattern = re.compile(br'''(<[^>]*\sdata-AmznPageBreak=[^>]*>)''', re.IGNORECASE)
-        within_tag_AmznPageBreak_position_pattern = re.compile(br'''\sdata-AmznPageBreak=['"]([^'"]*)['"]''')
-        for i in range(len(parts)):
-            part = parts[i]
-            srcpieces = find_tag_with_AmznPageBreak_pattern.split(part)
-            for j in range(len(srcpieces)):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    srcpieces[j] = within_tag_AmznPageBreak_position_pattern.sub(
-                        lambda m:b' style="page-break-after:' + m.group(1) + b'"', tag)
-            part = b"".join(srcpieces)
-            parts[i] = part
+            self.k8proc.linked_aids.update(linked_aids)
 
         # we have to handle substitutions for the flows  pieces first as they may
         # be inlined into the xhtml text
@@ -315,123 +423,11 @@ class XHTMLK8Processor:
             # flowpart = b"".join(srcpieces)
 
         # now handle the main text xhtml parts
-
-        # Handle the flow items in the XHTML text pieces
-        # kindle:flow:XXXX?mime=YYYY/ZZZ (used for style sheets, svg images, etc)
-        tag_pattern = re.compile(br'''(<[^>]*>)''')
-        flow_pattern = re.compile(br'''['"]kindle:flow:([0-9|A-V]+)\?mime=([^'"]+)['"]''', re.IGNORECASE)
-        for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-            # flow pattern
-            srcpieces = tag_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<'):
-                    for m in flow_pattern.finditer(tag):
-                        num = fromBase32(m.group(1))
-                        if num > 0 and num < len(self.k8proc.flowinfo):
-                            [typ, fmt, pdir, fnm] = self.k8proc.getFlowInfo(num)
-                            flowpart = flows[num]
-                            if fmt == b'inline':
-                                tag = flowpart
-                            else:
-                                replacement = b'"../' + utf8_str(pdir) + b'/' + utf8_str(fnm) + b'"'
-                                tag = flow_pattern.sub(replacement, tag, 1)
-                                self.used[fnm] = 'used'
-                        else:
-                            print("warning: ignoring non-existent flow link", tag, " value 0x%x" % num)
-                    srcpieces[j] = tag
-            part = b''.join(srcpieces)
-
-            # store away modified version
-            parts[i] = part
-
-        # Handle any embedded raster images links in style= attributes urls
-        style_pattern = re.compile(br'''(<[a-zA-Z0-9]+\s[^>]*style\s*=\s*[^>]*>)''', re.IGNORECASE)
-        img_index_pattern = re.compile(br'''[('"]kindle:embed:([0-9|A-V]+)[^'"]*['")]''', re.IGNORECASE)
-
-        for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-
-            # replace urls in style attributes
-            srcpieces = style_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if b'kindle:embed' in tag:
-                    for m in img_index_pattern.finditer(tag):
-                        imageNumber = fromBase32(m.group(1))
-                        imageName = self.rscnames[imageNumber-1]
-                        osep = m.group()[0:1]
-                        csep = m.group()[-1:]
-                        if imageName is not None:
-                            replacement = osep + b'../Images/'+ utf8_str(imageName) + csep
-                            self.used[imageName] = 'used'
-                            tag = img_index_pattern.sub(replacement, tag, 1)
-                        else:
-                            print("Error: Referenced image %s in style url was not recognized in %s" % (imageNumber, tag))
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
-
-            # store away modified version
-            parts[i] = part
-
-        # Handle any embedded raster images links in the xhtml text
-        # kindle:embed:XXXX?mime=image/gif (png, jpeg, etc) (used for images)
-        img_pattern = re.compile(br'''(<[img\s|image\s][^>]*>)''', re.IGNORECASE)
-        img_index_pattern = re.compile(br'''['"]kindle:embed:([0-9|A-V]+)[^'"]*['"]''')
-
+        state = (self.k8proc.linked_aids, flows, self.k8proc.flowinfo, self.rscnames)
         for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-
-            # links to raster image files
-            # image_pattern
-            srcpieces = img_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<im'):
-                    for m in img_index_pattern.finditer(tag):
-                        imageNumber = fromBase32(m.group(1))
-                        imageName = self.rscnames[imageNumber-1]
-                        if imageName is not None:
-                            replacement = b'"../Images/' + utf8_str(imageName) + b'"'
-                            self.used[imageName] = 'used'
-                            tag = img_index_pattern.sub(replacement, tag, 1)
-                        else:
-                            print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
-                    srcpieces[j] = tag
-            part = b"".join(srcpieces)
-            # store away modified version
-            parts[i] = part
-
-        # finally perform any general cleanups needed to make valid XHTML
-        # these include:
-        #   in svg tags replace "perserveaspectratio" attributes with "perserveAspectRatio"
-        #   in svg tags replace "viewbox" attributes with "viewBox"
-        #   in <li> remove value="XX" attributes since these are illegal
-        tag_pattern = re.compile(br'''(<[^>]*>)''')
-        li_value_pattern = re.compile(br'''\svalue\s*=\s*['"][^'"]*['"]''', re.IGNORECASE)
-
-        for i in range(len(parts)):
-            part = parts[i]
-            [partnum, dir, filename, beg, end, aidtext] = self.k8proc.partinfo[i]
-
-            # tag pattern
-            srcpieces = tag_pattern.split(part)
-            for j in range(1, len(srcpieces),2):
-                tag = srcpieces[j]
-                if tag.startswith(b'<svg') or tag.startswith(b'<SVG'):
-                    tag = tag.replace(b'preserveaspectratio',b'preserveAspectRatio')
-                    tag = tag.replace(b'viewbox',b'viewBox')
-                elif tag.startswith(b'<li ') or tag.startswith(b'<LI '):
-                    tagpieces = li_value_pattern.split(tag)
-                    tag = b"".join(tagpieces)
-                srcpieces[j] = tag
-            part = b"".join(srcpieces)
-            # store away modified version
-            parts[i] = part
+            parts[i], used = finishPart(state, parts[i])
+            for name in used:
+                self.used[name] = 'used'
 
         self.k8proc.setFlows(flows)
         self.k8proc.setParts(parts)
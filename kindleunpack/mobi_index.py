@@ -7,6 +7,11 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 from .compatibility_utils import PY2, bchr, bstr, bord
 if PY2:
     range = xrange
+    # bytes are indexed as str in python 2, a bytearray is indexed as int on both
+    intview = bytearray
+else:
+    def intview(data):
+        return data
 
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
@@ -45,6 +50,7 @@ class MobiIndex:
                 print("ControlByteCount is", controlByteCount)
                 print("IndexCount is", IndexCount)
                 print("TagTable: %s" % tagTable)
+            plan = getTagPlan(controlByteCount, tagTable)
             for i in range(idx + 1, idx + 1 + IndexCount):
                 sect.setsectiondescription(i,"{0} Extra {1:d} INDX section".format(label,i-idx))
                 data = sect.loadSection(i)
@@ -53,22 +59,10 @@ class MobiIndex:
                 entryCount = hdrinfo['count']
                 if self.DEBUG:
                     print(idxtPos, entryCount)
-                # loop through to build up the IDXT position starts
-                idxPositions = []
-                for j in range(entryCount):
-                    pos, = struct.unpack_from(b'>H', data, idxtPos + 4 + (2 * j))
-                    idxPositions.append(pos)
-                # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
-                idxPositions.append(idxtPos)
                 # for each entry in the IDXT build up the tagMap and any associated text
-                for j in range(entryCount):
-                    startPos = idxPositions[j]
-                    endPos = idxPositions[j+1]
-                    textLength = ord(data[startPos:startPos+1])
-                    text = data[startPos+1:startPos+1+textLength]
+                for text, tagMap in readIndexEntries(data, idxtPos, entryCount, plan):
                     if hordt2 is not None:
                         text = b''.join(bchr(hordt2[bord(x)]) for x in text)
-                    tagMap = getTagMap(controlByteCount, tagTable, data, startPos+1+textLength, endPos)
                     outtbl.append([text, tagMap])
                     if self.DEBUG:
                         print(tagMap)
@@ -119,16 +113,13 @@ class MobiIndex:
         # read all blocks from CTOC
         ctoc_data = {}
         offset = 0
-        while offset<len(txtdata):
-            if PY2:
-                if txtdata[offset] == b'\0':
-                    break
-            else:
-                if txtdata[offset] == 0:
-                    break
+        data = intview(txtdata)
+        while offset<len(data):
+            if data[offset] == 0:
+                break
             idx_offs = offset
             # first n bytes: name len as vwi
-            pos, ilen = getVariableWidthValue(txtdata, offset)
+            pos, ilen = getVariableWidthValue(data, offset)
             offset += pos
             # <len> next bytes: name
             name = txtdata[offset:offset+ilen]
@@ -148,16 +139,15 @@ def getVariableWidthValue(data, offset):
     @param offset: The start offset into data.
     @return: Tuple of consumed bytes count and decoded value.
     '''
-    value = 0
-    consumed = 0
-    finished = False
-    while not finished:
-        v = data[offset + consumed: offset + consumed + 1]
-        consumed += 1
-        if ord(v) & 0x80:
-            finished = True
-        value = (value << 7) | (ord(v) & 0x7f)
-    return consumed, value
+    data = intview(data)
+    pos = offset
+    v = data[pos]
+    value = v & 0x7f
+    while not v & 0x80:
+        pos += 1
+        v = data[pos]
+        value = (value << 7) | (v & 0x7f)
+    return pos + 1 - offset, value
 
 
 def readTagSection(start, data):
@@ -171,13 +161,12 @@ def readTagSection(start, data):
     controlByteCount = 0
     tags = []
     if data[start:start+4] == b"TAGX":
-        firstEntryOffset, = struct.unpack_from(b'>L', data, start + 0x04)
-        controlByteCount, = struct.unpack_from(b'>L', data, start + 0x08)
+        firstEntryOffset, controlByteCount = struct.unpack_from(b'>LL', data, start + 0x04)
 
         # Skip the first 12 bytes already read above.
-        for i in range(12, firstEntryOffset, 4):
-            pos = start + i
-            tags.append((ord(data[pos:pos+1]), ord(data[pos+1:pos+2]), ord(data[pos+2:pos+3]), ord(data[pos+3:pos+4])))
+        count = max(0, (firstEntryOffset - 12 + 3) // 4)
+        values = struct.unpack_from(bstr('>%dB' % (count * 4)), data, start + 12)
+        tags = [values[i:i+4] for i in range(0, len(values), 4)]
     return controlByteCount, tags
 
 
@@ -189,88 +178,139 @@ def countSetBits(value, bits=8):
     @param bits: The number of bits of the input value (defaults to 8).
     @return: Number of set bits.
     '''
-    count = 0
-    for _ in range(bits):
-        if value & 0x01 == 0x01:
-            count += 1
-        value = value >> 1
-    return count
+    return bin(value & ((1 << bits) - 1)).count('1')
 
 
-def getTagMap(controlByteCount, tagTable, entryData, startPos, endPos):
+def getTagPlan(controlByteCount, tagTable):
     '''
-    Create a map of tags and values from the given byte section.
+    Precompute how the tags of a tag table are read from the control bytes of an entry.
 
     @param controlByteCount: The number of control bytes.
     @param tagTable: The tag table.
-    @param entryData: The data to process.
+    @return: Tuple of control byte count and tuple of (tag, values per entry, control byte index,
+             mask, shift, multi bit mask) tuples.
+    '''
+    plan = []
+    controlByteIndex = 0
+    for tag, valuesPerEntry, mask, endFlag in tagTable:
+        if endFlag == 0x01:
+            controlByteIndex += 1
+            continue
+        if mask == 0:
+            continue
+        shift = 0
+        while (mask >> shift) & 0x01 == 0:
+            shift += 1
+        plan.append((tag, valuesPerEntry, controlByteIndex, mask, shift, countSetBits(mask) > 1))
+    return controlByteCount, tuple(plan)
+
+
+def decodeTagMap(plan, entryData, startPos, endPos):
+    '''
+    Create a map of tags and values from the given byte section using a plan from getTagPlan.
+
+    @param plan: The decoding plan of the tag table.
+    @param entryData: The data to process, indexed as int (see intview).
     @param startPos: The starting position in entryData.
     @param endPos: The end position in entryData or None if it is unknown.
     @return: Hashmap of tag and list of values.
     '''
+    controlByteCount, tagPlan = plan
     tags = []
     tagHashMap = {}
-    controlByteIndex = 0
     dataStart = startPos + controlByteCount
 
-    for tag, valuesPerEntry, mask, endFlag in tagTable:
-        if endFlag == 0x01:
-            controlByteIndex += 1
-            continue
-        cbyte = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex+1])
-        if 0:
-            print("Control Byte Index %0x , Control Byte Value %0x" % (controlByteIndex, cbyte))
-
-        value = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex+1]) & mask
+    for tag, valuesPerEntry, controlByteIndex, mask, shift, multiBit in tagPlan:
+        value = entryData[startPos + controlByteIndex] & mask
         if value != 0:
-            if value == mask:
-                if countSetBits(mask) > 1:
-                    # If all bits of masked value are set and the mask has more than one bit, a variable width value
-                    # will follow after the control bytes which defines the length of bytes (NOT the value count!)
-                    # which will contain the corresponding variable width values.
-                    consumed, value = getVariableWidthValue(entryData, dataStart)
-                    dataStart += consumed
-                    tags.append((tag, None, value, valuesPerEntry))
-                else:
-                    tags.append((tag, 1, None, valuesPerEntry))
+            if value == mask and multiBit:
+                # If all bits of masked value are set and the mask has more than one bit, a variable width value
+                # will follow after the control bytes which defines the length of bytes (NOT the value count!)
+                # which will contain the corresponding variable width values.
+                v = value = entryData[dataStart]
+                dataStart += 1
+                while v < 0x80:
+                    v = entryData[dataStart]
+                    dataStart += 1
+                    value = (value << 7) + v
+                tags.append((tag, None, value - 0x80, valuesPerEntry))
             else:
-                # Shift bits to get the masked value.
-                while mask & 0x01 == 0:
-                    mask = mask >> 1
-                    value = value >> 1
-                tags.append((tag, value, None, valuesPerEntry))
+                tags.append((tag, value >> shift, None, valuesPerEntry))
     for tag, valueCount, valueBytes, valuesPerEntry in tags:
         values = []
         if valueCount is not None:
             # Read valueCount * valuesPerEntry variable width values.
-            for _ in range(valueCount):
-                for _ in range(valuesPerEntry):
-                    consumed, data = getVariableWidthValue(entryData, dataStart)
-                    dataStart += consumed
-                    values.append(data)
+            for _ in range(valueCount * valuesPerEntry):
+                v = data = entryData[dataStart]
+                dataStart += 1
+                while v < 0x80:
+                    v = entryData[dataStart]
+                    dataStart += 1
+                    data = (data << 7) + v
+                values.append(data - 0x80)
         else:
             # Convert valueBytes to variable width values.
-            totalConsumed = 0
-            while totalConsumed < valueBytes:
+            end = dataStart + valueBytes
+            pos = dataStart
+            while pos < end:
                 # Does this work for valuesPerEntry != 1?
-                consumed, data = getVariableWidthValue(entryData, dataStart)
-                dataStart += consumed
-                totalConsumed += consumed
-                values.append(data)
-            if totalConsumed != valueBytes:
-                print("Error: Should consume %s bytes, but consumed %s" % (valueBytes, totalConsumed))
+                v = data = entryData[pos]
+                pos += 1
+                while v < 0x80:
+                    v = entryData[pos]
+                    pos += 1
+                    data = (data << 7) + v
+                values.append(data - 0x80)
+            if pos != end:
+                print("Error: Should consume %s bytes, but consumed %s" % (valueBytes, pos - dataStart))
+            dataStart = pos
         tagHashMap[tag] = values
     # Test that all bytes have been processed if endPos is given.
     if endPos is not None and dataStart != endPos:
         # The last entry might have some zero padding bytes, so complain only if non zero bytes are left.
-        for char in entryData[dataStart:endPos]:
-            if bord(char) != 0:
-                print("Warning: There are unprocessed index bytes left: %s" % toHex(entryData[dataStart:endPos]))
-                if 0:
-                    print("controlByteCount: %s" % controlByteCount)
-                    print("tagTable: %s" % tagTable)
-                    print("data: %s" % toHex(entryData[startPos:endPos]))
-                    print("tagHashMap: %s" % tagHashMap)
-                break
+        if any(entryData[dataStart:endPos]):
+            print("Warning: There are unprocessed index bytes left: %s" % toHex(bytes(entryData[dataStart:endPos])))
 
     return tagHashMap
+
+
+_tagPlans = {}
+
+
+def getTagMap(controlByteCount, tagTable, entryData, startPos, endPos):
+    '''
+    Create a map of tags and values from the given byte section.
+
+    @param controlByteCount: The number of control bytes.
+    @param tagTable: The tag table.
+    @param entryData: The data to process.
+    @param startPos: The starting position in entryData.
+    @param endPos: The end position in entryData or None if it is unknown.
+    @return: Hashmap of tag and list of values.
+    '''
+    key = (controlByteCount, tuple(tagTable))
+    plan = _tagPlans.get(key)
+    if plan is None:
+        plan = _tagPlans[key] = getTagPlan(controlByteCount, tagTable)
+    return decodeTagMap(plan, intview(entryData), startPos, endPos)
+
+
+def readIndexEntries(data, idxtPos, entryCount, plan):
+    '''
+    Read the entries of an INDX section.
+
+    @param data: The INDX section.
+    @param idxtPos: The position of the IDXT table.
+    @param entryCount: The number of entries.
+    @param plan: The decoding plan of the tag table from getTagPlan.
+    @return: Iterator of tuples of entry text and tag map.
+    '''
+    idxPositions = list(struct.unpack_from(bstr('>%dH' % entryCount), data, idxtPos + 4))
+    # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
+    idxPositions.append(idxtPos)
+    entryData = intview(data)
+    for j in range(entryCount):
+        startPos = idxPositions[j]
+        textLength = entryData[startPos]
+        text = data[startPos+1:startPos+1+textLength]
+        yield text, decodeTagMap(plan, entryData, startPos+1+textLength, idxPositions[j+1])
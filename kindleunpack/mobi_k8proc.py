@@ -10,6 +10,7 @@ if PY2:
     range = xrange
 
 import os
+import bisect
 
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
@@ -52,6 +53,17 @@ def reverse_tag_iter(block):
         end = plt
 
 
+# find id and name attributes only inside of tags
+#    inside any < > pair find "id=" and "name=" attributes return it
+#    [^>]* means match any amount of chars except for  '>' char
+#    [^'"] match any amount of chars except for the quote character
+#    \s* means match any amount of whitespace
+_id_pattern = re.compile(br'''<[^>]*\sid\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
+_name_pattern = re.compile(br'''<[^>]*\sname\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
+_aid_pattern = re.compile(br'''<[^>]+\s(?:aid|AID)\s*=\s*['"]([^'"]+)['"]''')
+_end_tag_pattern = re.compile(br'''/>|</''')
+
+
 class K8Processor:
 
     def __init__(self, mh, sect, files, debug=False):
@@ -68,6 +80,9 @@ class K8Processor:
         self.flowinfo = []
         self.parts = None
         self.partinfo = []
+        self.fragends = None
+        self.partstarts = None
+        self.anchors = {}
         self.linked_aids = set()
         self.fdsttbl= [0,0xffffffff]
         self.DEBUG = debug
@@ -177,25 +192,29 @@ class K8Processor:
             print("\nRebuilding flow piece 0: the main body of the ebook")
         self.parts = []
         self.partinfo = []
+        self.anchors = {}
         fragptr = 0
         baseptr = 0
         cnt = 0
         filename = 'part%04d.xhtml' % cnt
+        # the skeleton is assembled in place in a bytearray, so each fragment insert only moves
+        # the tail of the skeleton after the insert position instead of copying the whole skeleton
+        textview = memoryview(text)
         for [skelnum, skelname, fragcnt, skelpos, skellen] in self.skeltbl:
             baseptr = skelpos + skellen
-            skeleton = text[skelpos: baseptr]
+            skeleton = bytearray(textview[skelpos: baseptr])
             aidtext = "0"
             for i in range(fragcnt):
                 [insertpos, idtext, filenum, seqnum, startpos, length] = self.fragtbl[fragptr]
                 aidtext = idtext[12:-2]
                 if i == 0:
                     filename = 'part%04d.xhtml' % filenum
-                slice = text[baseptr: baseptr + length]
+                slice = textview[baseptr: baseptr + length]
                 insertpos = insertpos - skelpos
-                head = skeleton[:insertpos]
-                tail = skeleton[insertpos:]
                 actual_inspos = insertpos
-                if (tail.find(b'>') < tail.find(b'<') or head.rfind(b'>') < head.rfind(b'<')):
+                # look for an incomplete tag in either the head or tail, without slicing them out
+                if (skeleton.find(b'>', insertpos) < skeleton.find(b'<', insertpos) or
+                        skeleton.rfind(b'>', 0, insertpos) < skeleton.rfind(b'<', 0, insertpos)):
                     # There is an incomplete tag in either the head or tail.
                     # This can happen for some badly formed KF8 files
                     print('The fragment table for %s has incorrect insert position. Calculating manually.' % skelname)
@@ -206,17 +225,18 @@ class K8Processor:
                     print("fixed corrupt fragment table insert position", insertpos+skelpos, actual_inspos+skelpos)
                     insertpos = actual_inspos
                     self.fragtbl[fragptr][0] = actual_inspos + skelpos
-                skeleton = skeleton[0:insertpos] + slice + skeleton[insertpos:]
+                skeleton[insertpos:insertpos] = slice
                 baseptr = baseptr + length
                 fragptr += 1
             cnt += 1
-            self.parts.append(skeleton)
+            self.parts.append(bytes(skeleton))
             self.partinfo.append([skelnum, 'Text', filename, skelpos, baseptr, aidtext])
+        self.buildPositionIndex()
 
-        assembled_text = b''.join(self.parts)
         if self.DEBUG:
+            assembled_text = b''.join(self.parts)
             outassembled = os.path.join(self.files.k8dir, 'assembled_text.dat')
-            with open(pathof(outassembled),'wb') as f:
+            with self.files.sink.open(outassembled) as f:
                 f.write(assembled_text)
 
         # The primary css style sheet is typically stored next followed by any
@@ -306,22 +326,60 @@ class K8Processor:
 
         return
 
+    # build the indexes to look up fragment and part by position with bisect
+    def buildPositionIndex(self):
+        # the first fragment that ends after pos is the one pos is in or before,
+        # a running maximum of the ends keeps this true even if the table is not sorted
+        self.fragends = []
+        fragend = None
+        for [insertpos, idtext, filenum, seqnum, startpos, length] in self.fragtbl:
+            end = insertpos + max(length, 0)
+            if fragend is None or end > fragend:
+                fragend = end
+            self.fragends.append(fragend)
+        # parts are normally in order and do not overlap, otherwise fall back to the linear search
+        self.partstarts = []
+        partend = None
+        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
+            if partend is not None and start < partend:
+                self.partstarts = None
+                break
+            self.partstarts.append(start)
+            partend = max(end, start)
+
+    # index into partinfo of the part that contains pos
+    def findPart(self, pos):
+        if self.fragends is None:
+            self.buildPositionIndex()
+        if self.partstarts is None:
+            for j in range(len(self.partinfo)):
+                if pos >= self.partinfo[j][3] and pos < self.partinfo[j][4]:
+                    return j
+            return None
+        j = bisect.bisect_right(self.partstarts, pos) - 1
+        if j >= 0 and pos < self.partinfo[j][4]:
+            return j
+        return None
+
     # get information fragment table entry by pos
     def getFragTblInfo(self, pos):
-        for j in range(len(self.fragtbl)):
+        if self.fragends is None:
+            self.buildPositionIndex()
+        j = bisect.bisect_right(self.fragends, pos)
+        if j < len(self.fragtbl):
             [insertpos, idtext, filenum, seqnum, startpos, length] = self.fragtbl[j]
-            if pos >= insertpos and pos < (insertpos + length):
+            if pos >= insertpos:
                 # why are these "in: and before: added here
                 return seqnum, b'in: ' + idtext
-            if pos < insertpos:
-                return seqnum, b'before: ' + idtext
+            return seqnum, b'before: ' + idtext
         return None, None
 
     # get information about the part (file) that exists at pos in original rawML
     def getFileInfo(self, pos):
-        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
-            if pos >= start and pos < end:
-                return filename, partnum, start, end
+        j = self.findPart(pos)
+        if j is not None:
+            [partnum, pdir, filename, start, end, aidtext] = self.partinfo[j]
+            return filename, partnum, start, end
         return None, None, None, None
 
     # accessor functions to properly protect the internal structure
@@ -374,6 +432,41 @@ class K8Processor:
         idtext = self.getIDTag(pos)
         return fname, idtext
 
+    # find the anchor of the first tag with id or name (or aid, if not page) attribute before npos in part pn,
+    # walking back the tags the same way as reverse_tag_iter. The anchor found from each tag end
+    # is remembered, so later searches in the part stop at the first tag already visited.
+    def findAnchor(self, pn, npos, page=False):
+        textblock = self.parts[pn]
+        index = self.anchors.setdefault((pn, page), {})
+        visited = []
+        anchor = (b'', False)
+        pgt = textblock.rfind(b'>', 0, npos)
+        while pgt != -1:
+            if pgt in index:
+                anchor = index[pgt]
+                break
+            visited.append(pgt)
+            plt = textblock.rfind(b'<', 0, pgt)
+            if plt == -1:
+                break
+            tag = textblock[plt:pgt+1]
+            # any ids in the body should default to top of file
+            if tag[0:6] == b'<body ':
+                break
+            if tag[0:6] != b'<meta ' and b'=' in tag:
+                m = _id_pattern.match(tag) or _name_pattern.match(tag)
+                if m is not None:
+                    anchor = (m.group(1), False)
+                    break
+                m = None if page else _aid_pattern.match(tag)
+                if m is not None:
+                    anchor = (m.group(1), True)
+                    break
+            pgt = textblock.rfind(b'>', 0, plt)
+        for pgt in visited:
+            index[pgt] = anchor
+        return anchor
+
     def getIDTag(self, pos):
         # find the first tag with a named anchor (name or id attribute) before pos
         fname, pn, skelpos, skelend = self.getFileInfo(pos)
@@ -386,35 +479,18 @@ class K8Processor:
         plt = textblock.find(b'<',npos)
         if plt == npos or pgt < plt:
             npos = pgt + 1
-        # find id and name attributes only inside of tags
-        # use a reverse tag search since that is faster
-        #    inside any < > pair find "id=" and "name=" attributes return it
-        #    [^>]* means match any amount of chars except for  '>' char
-        #    [^'"] match any amount of chars except for the quote character
-        #    \s* means match any amount of whitespace
-        textblock = textblock[0:npos]
-        id_pattern = re.compile(br'''<[^>]*\sid\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        name_pattern = re.compile(br'''<[^>]*\sname\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        aid_pattern = re.compile(br'''<[^>]+\s(?:aid|AID)\s*=\s*['"]([^'"]+)['"]''')
-        for tag in reverse_tag_iter(textblock):
-            # any ids in the body should default to top of file
-            if tag[0:6] == b'<body ':
-                return b''
-            if tag[0:6] != b'<meta ':
-                m = id_pattern.match(tag) or name_pattern.match(tag)
-                if m is not None:
-                    return m.group(1)
-                m = aid_pattern.match(tag)
-                if m is not None:
-                    self.linked_aids.add(m.group(1))
-                    return b'aid-' + m.group(1)
-        return b''
+        idtext, isaid = self.findAnchor(pn, npos)
+        if isaid:
+            self.linked_aids.add(idtext)
+            return b'aid-' + idtext
+        return idtext
 
     # do we need to do deep copying
     def setParts(self, parts):
         assert(len(parts) == len(self.parts))
         for i in range(len(parts)):
             self.parts[i] = parts[i]
+        self.anchors = {}
 
     # do we need to do deep copying
     def setFlows(self, flows):
@@ -424,9 +500,9 @@ class K8Processor:
 
     # get information about the part (file) that exists at pos in original rawML
     def getSkelInfo(self, pos):
-        for [partnum, pdir, filename, start, end, aidtext] in self.partinfo:
-            if pos >= start and pos < end:
-                return [partnum, pdir, filename, start, end, aidtext]
+        j = self.findPart(pos)
+        if j is not None:
+            return list(self.partinfo[j])
         return [None, None, None, None, None, None]
 
     # fileno is actually a reference into fragtbl (a fragment)
@@ -466,31 +542,10 @@ class K8Processor:
         if plt == npos or pgt < plt:
             # we are in a tag
             # so find first ending tag
-            pend1 = textblock.find(b'/>', npos)
-            pend2 = textblock.find(b'</', npos)
-            if pend1 != -1 and pend2 != -1:
-                pend = min(pend1, pend2)
-            else:
-                pend = max(pend1, pend2)
-            if pend != -1:
-                npos = pend
+            m = _end_tag_pattern.search(textblock, npos)
+            if m is not None:
+                npos = m.start()
             else:
                 npos = pgt + 1
-        # find id and name attributes only inside of tags
-        # use a reverse tag search since that is faster
-        #    inside any < > pair find "id=" and "name=" attributes return it
-        #    [^>]* means match any amount of chars except for  '>' char
-        #    [^'"] match any amount of chars except for the quote character
-        #    \s* means match any amount of whitespace
-        textblock = textblock[0:npos]
-        id_pattern = re.compile(br'''<[^>]*\sid\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        name_pattern = re.compile(br'''<[^>]*\sname\s*=\s*['"]([^'"]*)['"]''',re.IGNORECASE)
-        for tag in reverse_tag_iter(textblock):
-            # any ids in the body should default to top of file
-            if tag[0:6] == b'<body ':
-                return b''
-            if tag[0:6] != b'<meta ':
-                m = id_pattern.match(tag) or name_pattern.match(tag)
-                if m is not None:
-                    return m.group(1)
-        return b''
+        idtext, isaid = self.findAnchor(pn, npos, True)
+        return idtext
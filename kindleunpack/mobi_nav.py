@@ -6,7 +6,6 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 
 from .compatibility_utils import unicode_str
 import os
-from .unipath import pathof
 
 import re
 # note: re requites the pattern to be the exact same type as the data to be searched in python3
@@ -183,5 +182,5 @@ class NAVProcessor(object):
         # print("Write Navigation Document.")
         xhtml = self.buildNAV(ncx_data, guidetext, metadata.get('Title')[0], metadata.get('Language')[0])
         fname = os.path.join(self.files.k8text, self.navname)
-        with open(pathof(fname), 'wb') as f:
+        with self.files.sink.open(fname) as f:
             f.write(xhtml.encode('utf-8'))
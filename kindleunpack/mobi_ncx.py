@@ -5,7 +5,6 @@
 from __future__ import unicode_literals, division, absolute_import, print_function
 
 import os
-from .unipath import pathof
 from .compatibility_utils import unescapeit
 
 
@@ -184,7 +183,7 @@ class ncxExtract:
         # write the ncx file
         # ncxname = os.path.join(self.files.mobi7dir, self.files.getInputFileBasename() + '.ncx')
         ncxname = os.path.join(self.files.mobi7dir, 'toc.ncx')
-        with open(pathof(ncxname), 'wb') as f:
+        with self.files.sink.open(ncxname) as f:
             f.write(xml.encode('utf-8'))
 
     def buildK8NCX(self, indx_data, title, ident, lang):
@@ -271,5 +270,5 @@ class ncxExtract:
         xml = self.buildK8NCX(ncx_data, metadata['Title'][0], metadata['UniqueID'][0], metadata.get('Language')[0])
         bname = 'toc.ncx'
         ncxname = os.path.join(self.files.k8oebps,bname)
-        with open(pathof(ncxname), 'wb') as f:
+        with self.files.sink.open(ncxname) as f:
             f.write(xml.encode('utf-8'))
@@ -7,6 +7,7 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 from .compatibility_utils import PY2, hexlify, bstr, bord, bchar
 
 import datetime
+import mmap
 
 if PY2:
     range = xrange
@@ -45,9 +46,9 @@ def datetimefrompalmtime(palmtime):
 class Sectionizer:
 
     def __init__(self, filename):
-        self.data = b''
+        # the file is mapped instead of read, only the sections loaded are copied to memory
         with open(pathof(filename), 'rb') as f:
-            self.data = f.read()
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         self.palmheader = self.data[:78]
         self.palmname = self.data[:32]
         self.ident = self.palmheader[0x3C:0x3C+8]
@@ -58,8 +59,28 @@ class Sectionizer:
         self.sectionattributes = sectionsdata[1::2]
         self.sectiondescriptions = ["" for x in range(self.num_sections+1)]
         self.sectiondescriptions[-1] = "File Length Only"
+        # memoryviews handed out by loadSectionView, released before the mapping is closed
+        self.views = []
         return
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # an exported view keeps the mapping open, closing it would raise BufferError
+        for view in self.views:
+            view.release()
+        self.views = []
+        try:
+            self.data.close()
+        except BufferError:
+            # a slice of a view is still referenced, e.g. from a traceback,
+            # the mapping is closed when it is freed
+            pass
+
     def dumpsectionsinfo(self):
         print("Section     Offset  Length      UID Attribs Description")
         for i in range(self.num_sections):
@@ -118,3 +139,14 @@ class Sectionizer:
     def loadSection(self, section):
         before, after = self.sectionoffsets[section:section+2]
         return self.data[before:after]
+
+    def loadSectionView(self, section):
+        # memoryview of the section in the file mapping, for sections that are only
+        # compared or written out, e.g. images, so large sections are never copied,
+        # the view is valid until the Sectionizer is closed
+        if PY2:
+            return self.loadSection(section)
+        before, after = self.sectionoffsets[section:section+2]
+        view = memoryview(self.data)[before:after]
+        self.views.append(view)
+        return view
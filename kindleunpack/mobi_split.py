@@ -5,6 +5,7 @@
 from __future__ import unicode_literals, division, absolute_import, print_function
 
 import struct
+import mmap
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
@@ -293,9 +294,16 @@ def del_exth(rec0,exth_num):
 class mobi_split:
 
     def __init__(self, infile):
-        datain = b''
+        # the file is mapped, so a book that is not a combination file is never read as a whole,
+        # the results are copies so the mapping is closed once they are made
         with open(pathof(infile), 'rb') as f:
-            datain = f.read()
+            datain = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.split(datain)
+        finally:
+            datain.close()
+
+    def split(self, datain):
         datain_rec0 = readsection(datain,0)
         ver = getint(datain_rec0,mobi_version)
         self.combo = (ver!=8)
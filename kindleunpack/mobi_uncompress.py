@@ -9,6 +9,7 @@ from .compatibility_utils import PY2, bchr, lmap, bstr
 if PY2:
     range = xrange
 
+import re
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
@@ -23,41 +24,51 @@ class UncompressedReader:
         return data
 
 class PalmdocReader:
+    # Run of bytes that are copied to the output as they are
+    literals = re.compile(b'[\x00\x09-\x7f]+').match
 
     def unpack(self, i):
-        o, p = b'', 0
-        while p < len(i):
-            # for python 3 must use slice since i[p] returns int while slice returns character
-            c = ord(i[p:p+1])
-            p += 1
+        # bytearray is indexed as int and appended in place on both python 2 and 3,
+        # the output is never copied as a whole
+        i = bytearray(i)
+        o, p, end = bytearray(), 0, len(i)
+        literals = PalmdocReader.literals
+        while p < end:
+            c = i[p]
             if (c >= 1 and c <= 8):
-                o += i[p:p+c]
-                p += c
+                o += i[p+1:p+1+c]
+                p += 1 + c
             elif (c < 128):
-                o += bchr(c)
+                q = literals(i, p).end()
+                o += i[p:q]
+                p = q
             elif (c >= 192):
-                o += b' ' + bchr(c ^ 128)
+                o.append(0x20)
+                o.append(c ^ 128)
+                p += 1
             else:
-                if p < len(i):
-                    c = (c << 8) | ord(i[p:p+1])
+                p += 1
+                if p < end:
+                    c = (c << 8) | i[p]
                     p += 1
                     m = (c >> 3) & 0x07ff
                     n = (c & 7) + 3
                     if (m > n):
+                        # Not overlapping, copy at once
                         o += o[-m:n-m]
-                    else:
-                        for _ in range(n):
-                            # because of completely ass-backwards decision by python mainters for python 3
-                            # we must use slice for bytes as i[p] returns int while slice returns character
-                            if m == 1:
-                                o += o[-m:]
-                            else:
-                                o += o[-m:-m+1]
-        return o
+                    elif m <= len(o):
+                        # Overlapping copy repeats the last m bytes, m == 0 repeats the first byte
+                        # as the byte by byte copy did. Distance beyond the output copies nothing.
+                        chunk = o[-m:] if m > 0 else o[:1]
+                        o += (chunk * (n // len(chunk) + 1))[:n] if chunk else b''
+        return bytes(o)
 
 class HuffcdicReader:
     q = struct.Struct(b'>Q').unpack_from
 
+    # Codes up to this length are decoded with a single table lookup
+    LOOKUP_BITS = 12
+
     def loadHuff(self, huff):
         if huff[0:8] != b'HUFF\x00\x00\x00\x18':
             raise unpackException('invalid huff header')
@@ -80,6 +91,26 @@ class HuffcdicReader:
             self.maxcode += (((maxcode + 1) << (32 - codelen)) - 1, )
 
         self.dictionary = []
+        self.lookup = self.buildLookup()
+
+    def buildLookup(self):
+        # For every LOOKUP_BITS prefix, (code length, dictionary index) if the code is not longer
+        # than the prefix, as the code length and index only depend on the first code length bits.
+        # Otherwise (0, 0), and the code is decoded bit length by bit length.
+        bits = self.LOOKUP_BITS
+        lookup = []
+        for prefix in range(1 << bits):
+            code = prefix << (32 - bits)
+            codelen, term, maxcode = self.dict1[code >> 24]
+            if not term:
+                while codelen <= bits and code < self.mincode[codelen]:
+                    codelen += 1
+                maxcode = self.maxcode[codelen] if codelen <= bits else 0
+            if codelen > bits:
+                lookup.append((0, 0))
+            else:
+                lookup.append((codelen, (maxcode - code) >> (32 - codelen)))
+        return lookup
 
     def loadCdic(self, cdic):
         if cdic[0:8] != b'CDIC\x00\x00\x00\x10':
@@ -95,37 +126,60 @@ class HuffcdicReader:
 
     def unpack(self, data):
         q = HuffcdicReader.q
-
+        dict1, mincode, maxcodes = self.dict1, self.mincode, self.maxcode
+        lookup, shift = self.lookup, 32 - self.LOOKUP_BITS
+        dictionary = self.dictionary
+
+        # Phrase that is not expanded yet is decoded in place of the current data,
+        # which is pushed to the stack and continued after the phrase is done.
+        stack = []
+        r = None
         bitsleft = len(data) * 8
         data += b"\x00\x00\x00\x00\x00\x00\x00\x00"
         pos = 0
         x, = q(data, pos)
         n = 32
+        s = bytearray()
 
-        s = b''
         while True:
             if n <= 0:
                 pos += 4
                 x, = q(data, pos)
                 n += 32
-            code = (x >> n) & ((1 << 32) - 1)
+            code = (x >> n) & 0xffffffff
 
-            codelen, term, maxcode = self.dict1[code >> 24]
-            if not term:
-                while code < self.mincode[codelen]:
-                    codelen += 1
-                maxcode = self.maxcode[codelen]
+            codelen, index = lookup[code >> shift]
+            if not codelen:
+                codelen, term, maxcode = dict1[code >> 24]
+                if not term:
+                    while code < mincode[codelen]:
+                        codelen += 1
+                    maxcode = maxcodes[codelen]
+                index = (maxcode - code) >> (32 - codelen)
 
             n -= codelen
             bitsleft -= codelen
             if bitsleft < 0:
-                break
-
-            r = (maxcode - code) >> (32 - codelen)
-            slice, flag = self.dictionary[r]
-            if not flag:
-                self.dictionary[r] = None
-                slice = self.unpack(slice)
-                self.dictionary[r] = (slice, 1)
-            s += slice
-        return s
+                if not stack:
+                    return bytes(s)
+                # Phrase is done, save it expanded and continue the outer data
+                slice = bytes(s)
+                dictionary[r] = (slice, 1)
+                r, data, bitsleft, pos, x, n, s = stack.pop()
+                s += slice
+                continue
+
+            slice, flag = dictionary[index]
+            if flag:
+                s += slice
+                continue
+
+            dictionary[index] = None
+            stack.append((r, data, bitsleft, pos, x, n, s))
+            r = index
+            bitsleft = len(slice) * 8
+            data = slice + b"\x00\x00\x00\x00\x00\x00\x00\x00"
+            pos = 0
+            x, = q(data, pos)
+            n = 32
+            s = bytearray()
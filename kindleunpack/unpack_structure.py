@@ -18,6 +18,7 @@ import re
 # note: re requites the pattern to be the exact same type as the data to be searched in python3
 # but u"" is not allowed for the pattern itself only b""
 
+import io
 import zipfile
 import binascii
 from .mobi_utils import mangle_fonts
@@ -33,22 +34,114 @@ class ZipInfo(zipfile.ZipInfo):
         super(ZipInfo, self).__init__(*args, **kwargs)
         self.compress_type = compress_type
 
+class FileSink:
+    """ Output written to the file system. """
+
+    def exists(self, path):
+        return unipath.exists(path)
+
+    def isfile(self, path):
+        return unipath.isfile(path)
+
+    def isdir(self, path):
+        return unipath.isdir(path)
+
+    def mkdir(self, path):
+        unipath.mkdir(path)
+
+    def listdir(self, path):
+        return unipath.listdir(path)
+
+    def open(self, path):
+        """ Open path for writing in binary mode. """
+        return open(pathof(path), 'wb')
+
+    def read(self, path):
+        with open(pathof(path), 'rb') as f:
+            return f.read()
+
+    def remove(self, path):
+        os.remove(pathof(path))
+
+    def zipWrite(self, myzip, path, arcname):
+        myzip.write(pathof(path), pathof(arcname), zipfile.ZIP_DEFLATED)
+
+
+class _MemoryFile(io.BytesIO):
+
+    def __init__(self, sink, key):
+        super(_MemoryFile, self).__init__()
+        self.sink = sink
+        self.key = key
+
+    def close(self):
+        if not self.closed:
+            self.sink.files[self.key] = self.getvalue()
+        super(_MemoryFile, self).close()
+
+
+class MemorySink:
+    """ Output kept in memory. files maps path (with / separator) to data. """
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = set()
+
+    def _key(self, path):
+        return os.path.normpath(path).replace(os.sep, '/')
+
+    def exists(self, path):
+        return self.isfile(path) or self.isdir(path)
+
+    def isfile(self, path):
+        return self._key(path) in self.files
+
+    def isdir(self, path):
+        key = self._key(path)
+        return key in self.dirs or any(x.startswith(key + '/') for x in self.files)
+
+    def mkdir(self, path):
+        self.dirs.add(self._key(path))
+
+    def listdir(self, path):
+        prefix = self._key(path) + '/'
+        names = set()
+        for key in list(self.files) + list(self.dirs):
+            if key.startswith(prefix):
+                names.add(key[len(prefix):].split('/')[0])
+        return sorted(names)
+
+    def open(self, path):
+        """ Open path for writing in binary mode, data is stored when closed. """
+        return _MemoryFile(self, self._key(path))
+
+    def read(self, path):
+        return self.files[self._key(path)]
+
+    def remove(self, path):
+        del self.files[self._key(path)]
+
+    def zipWrite(self, myzip, path, arcname):
+        myzip.writestr(arcname.replace(os.sep, '/'), self.read(path), zipfile.ZIP_DEFLATED)
+
+
 class fileNames:
 
-    def __init__(self, infile, outdir):
+    def __init__(self, infile, outdir, sink=None):
         self.infile = infile
         self.outdir = outdir
-        if not unipath.exists(self.outdir):
-            unipath.mkdir(self.outdir)
+        self.sink = sink if sink is not None else FileSink()
+        if not self.sink.exists(self.outdir):
+            self.sink.mkdir(self.outdir)
         self.mobi7dir = os.path.join(self.outdir,'mobi7')
-        if not unipath.exists(self.mobi7dir):
-            unipath.mkdir(self.mobi7dir)
+        if not self.sink.exists(self.mobi7dir):
+            self.sink.mkdir(self.mobi7dir)
         self.imgdir = os.path.join(self.mobi7dir, 'Images')
-        if not unipath.exists(self.imgdir):
-            unipath.mkdir(self.imgdir)
+        if not self.sink.exists(self.imgdir):
+            self.sink.mkdir(self.imgdir)
         self.hdimgdir = os.path.join(self.outdir,'HDImages')
-        if not unipath.exists(self.hdimgdir):
-            unipath.mkdir(self.hdimgdir)
+        if not self.sink.exists(self.hdimgdir):
+            self.sink.mkdir(self.hdimgdir)
         self.outbase = os.path.join(self.outdir, os.path.splitext(os.path.split(infile)[1])[0])
 
     def getInputFileBasename(self):
@@ -56,40 +149,40 @@ class fileNames:
 
     def makeK8Struct(self):
         self.k8dir = os.path.join(self.outdir,'mobi8')
-        if not unipath.exists(self.k8dir):
-            unipath.mkdir(self.k8dir)
+        if not self.sink.exists(self.k8dir):
+            self.sink.mkdir(self.k8dir)
         self.k8metainf = os.path.join(self.k8dir,'META-INF')
-        if not unipath.exists(self.k8metainf):
-            unipath.mkdir(self.k8metainf)
+        if not self.sink.exists(self.k8metainf):
+            self.sink.mkdir(self.k8metainf)
         self.k8oebps = os.path.join(self.k8dir,'OEBPS')
-        if not unipath.exists(self.k8oebps):
-            unipath.mkdir(self.k8oebps)
+        if not self.sink.exists(self.k8oebps):
+            self.sink.mkdir(self.k8oebps)
         self.k8images = os.path.join(self.k8oebps,'Images')
-        if not unipath.exists(self.k8images):
-            unipath.mkdir(self.k8images)
+        if not self.sink.exists(self.k8images):
+            self.sink.mkdir(self.k8images)
         self.k8fonts = os.path.join(self.k8oebps,'Fonts')
-        if not unipath.exists(self.k8fonts):
-            unipath.mkdir(self.k8fonts)
+        if not self.sink.exists(self.k8fonts):
+            self.sink.mkdir(self.k8fonts)
         self.k8styles = os.path.join(self.k8oebps,'Styles')
-        if not unipath.exists(self.k8styles):
-            unipath.mkdir(self.k8styles)
+        if not self.sink.exists(self.k8styles):
+            self.sink.mkdir(self.k8styles)
         self.k8text = os.path.join(self.k8oebps,'Text')
-        if not unipath.exists(self.k8text):
-            unipath.mkdir(self.k8text)
+        if not self.sink.exists(self.k8text):
+            self.sink.mkdir(self.k8text)
 
     # recursive zip creation support routine
     def zipUpDir(self, myzip, tdir, localname):
         currentdir = tdir
         if localname != "":
             currentdir = os.path.join(currentdir,localname)
-        list = unipath.listdir(currentdir)
+        list = self.sink.listdir(currentdir)
         for file in list:
             afilename = file
             localfilePath = os.path.join(localname, afilename)
             realfilePath = os.path.join(currentdir,file)
-            if unipath.isfile(realfilePath):
-                myzip.write(pathof(realfilePath), pathof(localfilePath), zipfile.ZIP_DEFLATED)
-            elif unipath.isdir(realfilePath):
+            if self.sink.isfile(realfilePath):
+                self.sink.zipWrite(myzip, realfilePath, localfilePath)
+            elif self.sink.isdir(realfilePath):
                 self.zipUpDir(myzip, tdir, localfilePath)
 
     def makeEPUB(self, usedmap, obfuscate_data, uid):
@@ -104,7 +197,7 @@ class fileNames:
 
         # copy over all images and fonts that are actually used in the ebook
         # and remove all font files from mobi7 since not supported
-        imgnames = unipath.listdir(self.imgdir)
+        imgnames = self.sink.listdir(self.imgdir)
         for name in imgnames:
             if usedmap.get(name,'not used') == 'used':
                 filein = os.path.join(self.imgdir,name)
@@ -116,15 +209,14 @@ class fileNames:
                     fileout = os.path.join(self.k8fonts,name)
                 else:
                     fileout = os.path.join(self.k8images,name)
-                data = b''
-                with open(pathof(filein),'rb') as f:
-                    data = f.read()
+                data = self.sink.read(filein)
                 if obfuscate_data:
                     if name in obfuscate_data:
                         data = mangle_fonts(key, data)
-                open(pathof(fileout),'wb').write(data)
+                with self.sink.open(fileout) as f:
+                    f.write(data)
                 if name.endswith(".ttf") or name.endswith(".otf"):
-                    os.remove(pathof(filein))
+                    self.sink.remove(filein)
 
         # opf file name hard coded to "content.opf"
         container = '<?xml version="1.0" encoding="UTF-8"?>\n'
@@ -133,7 +225,7 @@ class fileNames:
         container += '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
         container += '    </rootfiles>\n</container>\n'
         fileout = os.path.join(self.k8metainf,'container.xml')
-        with open(pathof(fileout),'wb') as f:
+        with self.sink.open(fileout) as f:
             f.write(container.encode('utf-8'))
 
         if obfuscate_data:
@@ -148,16 +240,17 @@ xmlns:enc="http://www.w3.org/2001/04/xmlenc#" xmlns:deenc="http://ns.adobe.com/d
                 encryption += '  </enc:EncryptedData>\n'
             encryption += '</encryption>\n'
             fileout = os.path.join(self.k8metainf,'encryption.xml')
-            with open(pathof(fileout),'wb') as f:
+            with self.sink.open(fileout) as f:
                 f.write(encryption.encode('utf-8'))
 
         # ready to build epub
-        self.outzip = zipfile.ZipFile(pathof(bname), 'w')
+        epub = self.sink.open(bname)
+        self.outzip = zipfile.ZipFile(epub, 'w')
 
         # add the mimetype file uncompressed
         mimetype = b'application/epub+zip'
         fileout = os.path.join(self.k8dir,'mimetype')
-        with open(pathof(fileout),'wb') as f:
+        with self.sink.open(fileout) as f:
             f.write(mimetype)
         nzinfo = ZipInfo('mimetype', compress_type=zipfile.ZIP_STORED)
         nzinfo.external_attr = 0o600 << 16 # make this a normal file
@@ -165,3 +258,4 @@ xmlns:enc="http://www.w3.org/2001/04/xmlenc#" xmlns:deenc="http://ns.adobe.com/d
         self.zipUpDir(self.outzip,self.k8dir,'META-INF')
         self.zipUpDir(self.outzip,self.k8dir,'OEBPS')
         self.outzip.close()
+        epub.close()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import re
+import json
+import functools
+import posixpath
+import threading
+import zipfile
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from lxml import etree
+
+import comicbook
+
+"""
+Local HTTP server for cbz-meta.html editor.
+
+The CBZ file is never sent to the browser as a whole. Pages are served one
+by one from the archive, with thumbnails made on demand and metadata saved
+back into the archive in place.
+
+API:
+ GET  /api/book         Book name, page list and current ComicInfo.xml
+ GET  /api/page/N       Page image N, supports single range request
+ GET  /api/thumb/N      Downscaled page image N
+ POST /api/comicinfo    Replace ComicInfo.xml with request body (application/xml),
+                        only from the editor page served by this server
+"""
+
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_FILES = {
+    '/': ('cbz-meta.html', 'text/html; charset=utf-8'),
+    '/cbz-meta.html': ('cbz-meta.html', 'text/html; charset=utf-8'),
+    '/cbz-meta.js': ('cbz-meta.js', 'text/javascript; charset=utf-8'),
+    '/cbz-meta.css': ('cbz-meta.css', 'text/css; charset=utf-8'),
+}
+
+IMAGE_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+}
+
+THUMBNAIL_SIZE = 256
+
+range_pattern = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+# Thumbnail cache, keyed by file modification time so edited file is not served stale thumbnail
+@functools.lru_cache(maxsize=1024)
+def _thumbnail(book_file, mtime, member, size):
+    from PIL import Image
+
+    with comicbook.ZipPage(book_file, member).open() as fp, Image.open(fp) as im:
+        # JPEG can be decoded at lower resolution directly
+        im.draft('RGB', (size, size))
+        im.thumbnail((size, size))
+        if im.mode not in ['RGB', 'L']:
+            im = im.convert('RGB')
+
+        output = io.BytesIO()
+        im.save(output, format='JPEG', quality=80)
+        return output.getvalue()
+
+
+class MetaServer(ThreadingHTTPServer):
+    """
+    Server of one CBZ file. The book is read once and shared by the requests,
+    it is read again only after ComicInfo.xml has been updated.
+    """
+
+    def __init__(self, server_address, book_file):
+        super().__init__(server_address, MetaRequestHandler)
+        self.book_file = book_file
+        self._book = None
+        self._book_lock = threading.Lock()
+
+    def book(self):
+        with self._book_lock:
+            if self._book is None:
+                self._book = comicbook.ZipComicReader(self.book_file)
+            return self._book
+
+    def update_comicinfo(self, xml):
+        with self._book_lock:
+            comicbook.update_comicinfo(self.book_file, xml)
+            # The kept zip handle is replaced when the rewritten file is read
+            self._book = None
+
+    def server_close(self):
+        super().server_close()
+        with self._book_lock:
+            if self._book is not None:
+                self._book.close()
+                self._book = None
+
+
+class MetaRequestHandler(BaseHTTPRequestHandler):
+
+    @property
+    def book_file(self):
+        return self.server.book_file
+
+    def _pages(self):
+        return self.server.book().images
+
+    def _send(self, status, content_type, data, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _send_json(self, value):
+        self._send(HTTPStatus.OK, 'application/json', json.dumps(value).encode('utf-8'))
+
+    def _send_error(self, status):
+        self._send(status, 'text/plain', status.phrase.encode('utf-8'))
+
+    def _get_page(self, parts):
+        pages = self._pages()
+        if len(parts) != 1 or not parts[0].isdigit() or int(parts[0]) >= len(pages):
+            return None
+        return pages[int(parts[0])]
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+
+        if path in STATIC_FILES:
+            name, content_type = STATIC_FILES[path]
+            with open(os.path.join(STATIC_DIR, name), 'rb') as fp:
+                self._send(HTTPStatus.OK, content_type, fp.read())
+            return
+
+        parts = path.strip('/').split('/')
+        if parts[0] != 'api' or len(parts) < 2:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        if parts[1] == 'book':
+            self._send_book()
+        elif parts[1] == 'page':
+            self._send_page(self._get_page(parts[2:]))
+        elif parts[1] == 'thumb':
+            self._send_thumbnail(self._get_page(parts[2:]))
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if path != '/api/comicinfo':
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        # The editor page is served from here, so only accept requests sent from it
+        if not self._same_origin():
+            self._send_error(HTTPStatus.FORBIDDEN)
+            return
+        if self.headers.get_content_type() != 'application/xml':
+            self._send_error(HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        xml = self.rfile.read(length)
+        try:
+            root = comicbook.parse_xml(io.BytesIO(xml)).getroot()
+        except etree.XMLSyntaxError:
+            root = None
+        if root is None or root.tag != 'ComicInfo':
+            self._send_error(HTTPStatus.BAD_REQUEST)
+            return
+
+        self.server.update_comicinfo(xml)
+        self._send_json({'ok': True})
+
+    # Host must be the server's own address, against DNS rebinding, and Origin (if sent) must match it.
+    # Server listening on all interfaces can be reached by any name, so only Origin is checked.
+    def _same_origin(self):
+        host = self.headers.get('Host', '')
+        address, port = self.server.server_address[:2]
+        if address not in ['', '0.0.0.0', '::']:
+            names = [address, 'localhost'] if address == '127.0.0.1' else [address]
+            if host not in ['{}:{}'.format(x, port) for x in names]:
+                return False
+
+        origin = self.headers.get('Origin')
+        return origin is None or origin == 'http://{}'.format(host)
+
+    def _send_book(self):
+        zfp = comicbook._open_zip(self.book_file)
+        comicinfo = None
+        for name in zfp.namelist():
+            if posixpath.basename(name) == 'ComicInfo.xml':
+                comicinfo = zfp.read(name).decode('utf-8')
+
+        self._send_json({
+            'name': os.path.basename(self.book_file),
+            'pages': [{'name': x.member, 'size': x.size()} for x in self._pages()],
+            'comicinfo': comicinfo,
+        })
+
+    def _send_page(self, page):
+        if page is None:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        content_type = IMAGE_TYPES.get(posixpath.splitext(page.name)[1][1:].lower(), 'application/octet-stream')
+        size = page.size()
+        headers = {'Accept-Ranges': 'bytes', 'Cache-Control': 'no-cache'}
+
+        match = range_pattern.match(self.headers.get('Range', ''))
+        if match is None or (match.group(1) == '' and match.group(2) == ''):
+            self._send(HTTPStatus.OK, content_type, page.read(), headers)
+            return
+
+        # Single range only, start-end, start- or -suffix
+        if match.group(1) == '':
+            start = max(size - int(match.group(2)), 0)
+            end = size - 1
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+
+        if start >= size or start > end:
+            self._send(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, 'text/plain', b'',
+                       {'Content-Range': 'bytes */{}'.format(size)})
+            return
+
+        # Stored member is read from its offset directly, deflated one is decompressed up to start
+        with page.open() as fp:
+            fp.seek(start)
+            data = fp.read(end - start + 1)
+
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        self._send(HTTPStatus.PARTIAL_CONTENT, content_type, data, headers)
+
+    def _send_thumbnail(self, page):
+        if page is None:
+            self._send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        data = _thumbnail(self.book_file, os.stat(self.book_file).st_mtime_ns, page.member, THUMBNAIL_SIZE)
+        self._send(HTTPStatus.OK, 'image/jpeg', data, {'Cache-Control': 'no-cache'})
+
+
+def make_server(book_file, host='127.0.0.1', port=8000):
+    if not zipfile.is_zipfile(book_file):
+        raise Exception('{} is not a CBZ/ZIP file'.format(book_file))
+
+    return MetaServer((host, port), os.path.abspath(book_file))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import io
+import struct
+import zlib
+
+"""
+Minimal PDF writer for comic book, one image per page.
+
+JPEG page is embedded as-is with DCTDecode filter, so writing PDF is mostly
+copying image data. Simple PNG (greyscale, RGB or paletted, no transparency)
+is embedded with its compressed data as-is too, using FlateDecode with PNG
+predictor. Other image format is decoded and stored with FlateDecode.
+Objects are written to the file as soon as each page is added, only the
+offsets are kept in memory. Duplicate page uses the image object of its
+original page.
+"""
+
+DEFAULT_DPI = 300
+
+COLOR_SPACES = {
+    'L': 'DeviceGray',
+    'RGB': 'DeviceRGB',
+    'CMYK': 'DeviceCMYK',
+}
+
+
+def pdf_number(value):
+    if isinstance(value, int):
+        return str(value)
+    return ('%.4f' % value).rstrip('0').rstrip('.')
+
+
+def pdf_text(text):
+    # Text string in UTF-16BE with byte order mark, written as hex string
+    return '<FEFF{}>'.format(text.encode('utf-16-be').hex().upper())
+
+
+def pdf_ref(num):
+    return '{} 0 R'.format(num)
+
+
+def parse_png(data):
+    """
+    Read PNG that can be embedded in PDF without decoding.
+    Return (width, height, bit depth, colors, palette, compressed data) or None.
+    """
+    if data[0:8] != b'\x89PNG\r\n\x1a\n':
+        return None
+
+    pos = 8
+    header = None
+    palette = None
+    idat = []
+    while pos + 8 <= len(data):
+        length, chunk = struct.unpack('>L4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+        if chunk == b'IHDR':
+            header = struct.unpack('>LLBBBBB', body)
+        elif chunk == b'PLTE':
+            palette = body
+        elif chunk == b'IDAT':
+            idat.append(body)
+        elif chunk == b'tRNS':
+            return None
+        elif chunk == b'IEND':
+            break
+
+    if header is None:
+        return None
+
+    width, height, depth, color_type, _, _, interlace = header
+    colors = {0: 1, 2: 3, 3: 1}.get(color_type)
+    if colors is None or interlace != 0 or depth > 8 or (color_type == 3 and palette is None):
+        return None
+
+    return width, height, depth, colors, palette if color_type == 3 else None, b''.join(idat)
+
+
+class PDFWriter:
+    """
+    Usage:
+        with PDFWriter(file) as pdf:
+            pdf.add_page(page)
+            pdf.add_outline('Chapter 1', 0)
+            ...
+    """
+
+    def __init__(self, file, dpi=DEFAULT_DPI, direction=1, title=None, author=None):
+        self.fp = open(file, 'wb')
+        self.dpi = dpi
+        self.direction = direction
+        self.title = title
+        self.author = author
+
+        self.offsets = {}
+        self.pages = []
+        self.outlines = []
+        # Image object number of each page written
+        self.images = {}
+
+        # Object 1 and 2 are reserved for catalog and page tree, written at the end
+        self.next_object = 3
+
+        self.fp.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fp.close()
+
+    def _new_object(self):
+        num = self.next_object
+        self.next_object += 1
+        return num
+
+    def _write_object(self, num, body, stream=None):
+        self.offsets[num] = self.fp.tell()
+        self.fp.write('{} 0 obj\n'.format(num).encode('ascii'))
+        self.fp.write(body.encode('ascii'))
+        if stream is not None:
+            self.fp.write(b'\nstream\n')
+            self.fp.write(stream)
+            self.fp.write(b'\nendstream')
+        self.fp.write(b'\nendobj\n')
+
+    def _write_image(self, page):
+        info = page.info
+        data = page.read()
+
+        png = parse_png(data) if info.format == 'png' else None
+
+        if info.format == 'jpeg' and info.mode in COLOR_SPACES:
+            color_space = COLOR_SPACES[info.mode]
+            extra = ''
+            # Adobe CMYK JPEG is stored inverted
+            if info.mode == 'CMYK':
+                extra = ' /Decode [1 0 1 0 1 0 1 0]'
+            body = '<< /Type /XObject /Subtype /Image /Width {} /Height {} /ColorSpace /{} /BitsPerComponent 8 ' \
+                   '/Filter /DCTDecode{} /Length {} >>'.format(info.width, info.height, color_space, extra, len(data))
+        elif png is not None:
+            width, height, depth, colors, palette, data = png
+            if palette is not None:
+                color_space = '[/Indexed /DeviceRGB {} <{}>]'.format(len(palette) // 3 - 1, palette.hex().upper())
+            else:
+                color_space = '/DeviceGray' if colors == 1 else '/DeviceRGB'
+            body = '<< /Type /XObject /Subtype /Image /Width {0} /Height {1} /ColorSpace {2} /BitsPerComponent {3} ' \
+                   '/Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors {4} /BitsPerComponent {3} ' \
+                   '/Columns {0} >> /Length {5} >>'.format(width, height, color_space, depth, colors, len(data))
+        else:
+            from PIL import Image
+
+            with Image.open(io.BytesIO(data)) as im:
+                if im.mode in ['RGBA', 'LA', 'PA'] or 'transparency' in im.info:
+                    im = im.convert('RGBA')
+                    background = Image.new('RGBA', im.size, (255, 255, 255, 255))
+                    im = Image.alpha_composite(background, im)
+                im = im.convert('L' if im.mode in ['1', 'L', 'LA', 'I', 'F'] else 'RGB')
+                color_space = COLOR_SPACES[im.mode]
+                data = zlib.compress(im.tobytes())
+                body = '<< /Type /XObject /Subtype /Image /Width {} /Height {} /ColorSpace /{} /BitsPerComponent 8 ' \
+                       '/Filter /FlateDecode /Length {} >>'.format(im.width, im.height, color_space, len(data))
+
+        num = self._new_object()
+        self._write_object(num, body, data)
+        return num
+
+    def add_page(self, page):
+        """Add page (comicbook.Page) as a new PDF page, sized from image size at the set DPI"""
+        width = page.info.width * 72 / self.dpi
+        height = page.info.height * 72 / self.dpi
+
+        original = page.duplicate_of or page
+        image = self.images.get(original)
+        if image is None:
+            image = self._write_image(original)
+            self.images[original] = image
+
+        content = 'q {} 0 0 {} 0 0 cm /Im0 Do Q'.format(pdf_number(width), pdf_number(height)).encode('ascii')
+        content_num = self._new_object()
+        self._write_object(content_num, '<< /Length {} >>'.format(len(content)), content)
+
+        page_num = self._new_object()
+        self._write_object(page_num, '<< /Type /Page /Parent {} /MediaBox [0 0 {} {}] '
+                                     '/Resources << /XObject << /Im0 {} >> >> /Contents {} >>'.format(
+            pdf_ref(2), pdf_number(width), pdf_number(height), pdf_ref(image), pdf_ref(content_num)))
+        self.pages.append(page_num)
+
+    def add_outline(self, title, page):
+        """Add bookmark to page (0-based index), in order"""
+        self.outlines.append((title, page))
+
+    def _write_outlines(self):
+        outlines = [(title, page) for title, page in self.outlines if page < len(self.pages)]
+        if not outlines:
+            return None
+
+        root = self._new_object()
+        items = [self._new_object() for _ in outlines]
+        for idx, (title, page) in enumerate(outlines):
+            body = '<< /Title {} /Parent {} /Dest [{} /Fit]'.format(pdf_text(title), pdf_ref(root),
+                                                                    pdf_ref(self.pages[page]))
+            if idx > 0:
+                body += ' /Prev {}'.format(pdf_ref(items[idx - 1]))
+            if idx < len(items) - 1:
+                body += ' /Next {}'.format(pdf_ref(items[idx + 1]))
+            body += ' >>'
+            self._write_object(items[idx], body)
+
+        self._write_object(root, '<< /Type /Outlines /First {} /Last {} /Count {} >>'.format(
+            pdf_ref(items[0]), pdf_ref(items[-1]), len(items)))
+        return root
+
+    def _write_info(self):
+        body = '<< /Producer {}'.format(pdf_text('comic-ebook-tools'))
+        if self.title:
+            body += ' /Title {}'.format(pdf_text(self.title))
+        if self.author:
+            body += ' /Author {}'.format(pdf_text(self.author))
+        body += ' >>'
+
+        num = self._new_object()
+        self._write_object(num, body)
+        return num
+
+    def close(self):
+        outlines = self._write_outlines()
+        info = self._write_info()
+
+        # Page tree
+        self._write_object(2, '<< /Type /Pages /Kids [{}] /Count {} >>'.format(
+            ' '.join(pdf_ref(x) for x in self.pages), len(self.pages)))
+
+        # Catalog, with two-page layout and reading direction
+        catalog = '<< /Type /Catalog /Pages {} /PageLayout /TwoPageRight'.format(pdf_ref(2))
+        catalog += ' /ViewerPreferences << /HideToolbar true /HideMenubar false /FitWindow true /Direction /{} >>'.format(
+            'R2L' if self.direction == -1 else 'L2R')
+        if self.pages:
+            catalog += ' /OpenAction [{} /Fit]'.format(pdf_ref(self.pages[0]))
+        if outlines is not None:
+            catalog += ' /Outlines {} /PageMode /UseOutlines'.format(pdf_ref(outlines))
+        catalog += ' >>'
+        self._write_object(1, catalog)
+
+        # Cross-reference table
+        xref = self.fp.tell()
+        self.fp.write('xref\n0 {}\n'.format(self.next_object).encode('ascii'))
+        self.fp.write(b'0000000000 65535 f \n')
+        for num in range(1, self.next_object):
+            self.fp.write('{:010d} 00000 n \n'.format(self.offsets[num]).encode('ascii'))
+
+        self.fp.write('trailer\n<< /Size {} /Root {} /Info {} >>\nstartxref\n{}\n%%EOF\n'.format(
+            self.next_object, pdf_ref(1), pdf_ref(info), xref).encode('ascii'))
+        self.fp.close()
+
+
+def linearize_pdf(file):
+    """
+    Rewrite PDF as linearized ("fast web view"), with first page objects and hint tables
+    at the beginning of the file, so viewer can show the first page before reading the whole file.
+    """
+    import pikepdf
+
+    with pikepdf.Pdf.open(file, allow_overwriting_input=True) as pdf:
+        pdf.save(linearize=True)
+
+
+def check_linearization(file, stream=None):
+    """Check that the PDF is linearized and its hint tables are valid. Problems are written to stream."""
+    import pikepdf
+
+    with pikepdf.Pdf.open(file) as pdf:
+        return pdf.is_linearized and pdf.check_linearization(stream if stream is not None else io.StringIO())
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import functools
 import calibredb
 import comicbook
 import comicprocessor
@@ -12,7 +13,10 @@ from one format to another format in calibre library.
 Usage:
  script-calibre-comic.py [--library=LIBRARY_PATH] [--format=FORMAT] [--rtl]
                          [--no-process] [--width=WIDTH] [--height=HEIGHT] 
-                         [--quality=60] [ids [ids [...]]]
+                         [--quality=60] [--linearize] [--codec=CODEC] [--lossless]
+                         [--target-size=SIZE] [--target-page-size=SIZE] [--drop-duplicates]
+                         [--staging=memory[:SIZE]|DIR]
+                         [ids [ids [...]]]
 
 --library=URL      Specified library path to calibre content server to pass to
                    calibredb tool.
@@ -27,6 +31,24 @@ Usage:
                    Only if image processing is enabled.
 --quality=QUALITY  JPEG quality to save. Default 60. [1-100]
                    Only if image processing is enabled.
+--linearize        Write linearized ("fast web view") PDF. Only for PDF output.
+--codec=CODEC      Image codec: jpeg (default), webp, avif, jxl or png.
+                   PNG is saved as 4-bit paletted image for greyscale output.
+                   JPEG XL requires pillow-jxl-plugin. PDF output always
+                   embeds JPEG and simple PNG as-is and other codecs decoded.
+--lossless         Lossless WebP/AVIF/JPEG XL. Quality is ignored.
+                   PNG is always lossless.
+--target-size=SIZE Size budget of all images, e.g. 50M. Quality of each page
+                   is searched to fit, instead of the fixed quality.
+--target-page-size=SIZE
+                   Size budget of each page image, e.g. 300K.
+                   Target sizes need a lossy codec, not png or --lossless.
+--drop-duplicates  Remove pages identical to an earlier page. Otherwise EPUB
+                   and PDF store the image once and CBZ has a copy.
+--staging=memory[:SIZE]
+                   Keep intermediate pages and unpacked AZW3 in memory, up to SIZE (default 1G)
+                   before spilling to the temporary folder.
+--staging=DIR      Keep intermediate files in DIR, e.g. /dev/shm.
                    
 ids                Calibre's book id to convert.
                    This script will prefer format in the order of 
@@ -42,7 +64,14 @@ def main(ids):
     color = False
     quality = 60
     image_processing = True
-    output_format = 'EPUB'
+    output_format = 'epub'
+    linearize = False
+    codec = 'jpeg'
+    lossless = False
+    target_size = None
+    target_page_size = None
+    drop_duplicates = False
+    staging = {}
 
     # Parse parameter
     ids = ids[1:]
@@ -73,6 +102,22 @@ def main(ids):
             color = True
         elif k == 'no-process':
             image_processing = False
+        elif k == 'linearize':
+            linearize = True
+        elif k == 'codec':
+            codec = v
+        elif k == 'lossless':
+            lossless = True
+        elif k == 'target-size':
+            target_size = comicprocessor.parse_size(v)
+        elif k == 'target-page-size':
+            target_page_size = comicprocessor.parse_size(v)
+        elif k == 'drop-duplicates':
+            drop_duplicates = True
+        elif k == 'staging' and v is not None and v.split(':')[0] == 'memory':
+            staging = {'memory_limit': comicprocessor.parse_size(v[7:]) if ':' in v else comicbook.MEMORY_STAGING_LIMIT}
+        elif k == 'staging' and v is not None:
+            staging = {'dir': v}
         elif k == 'quality':
             quality = int(v)
             if quality < 1 or quality > 100:
@@ -90,6 +135,11 @@ def main(ids):
 
         ids = ids[1:]
 
+    # Quality of PNG and lossless output cannot be lowered to fit a size budget
+    if (target_size or target_page_size) and comicprocessor.is_lossless(codec, lossless):
+        print('--target-size and --target-page-size cannot be used with PNG or --lossless output')
+        return
+
     db = calibredb.CalibreDB(library=library)
     formats = ['AZW3', 'CBZ', 'PDF', 'EPUB']
 
@@ -119,7 +169,7 @@ def main(ids):
         output_file = '{}.{}'.format(id_, output_format)
 
         print('Reading book information...')
-        book = comicbook.load_book(input_file)
+        book = comicbook.load_book(input_file, comicbook.Staging(**staging))
 
         # Only specify direction for CBZ
         if selected_format == 'CBZ':
@@ -127,20 +177,41 @@ def main(ids):
 
         print('Pages: {}'.format(len(book.images)))
 
+        writers = {
+            'epub': comicbook.write_as_epub,
+            'cbz': comicbook.write_as_zip,
+            'pdf': functools.partial(comicbook.write_as_pdf, linearize=linearize),
+        }
+
         if image_processing:
-            print('Processing...')
-            processor = comicprocessor.ComicProcessor(dir=book.direction, resize=(width, height), color=color)
-            output = comicbook.process_comic(book, processor, quality)
+            processor = comicprocessor.ComicProcessor(dir=book.direction, resize=(width, height), color=color,
+                                                      codec=codec, lossless=lossless, target_size=target_size,
+                                                      target_page_size=target_page_size,
+                                                      share_duplicates=output_format != 'cbz' or drop_duplicates)
+
+        if image_processing and output_format != 'pdf':
+            # Pages are saved as soon as they are processed
+            print('Processing and saving as {}...'.format(output_format.upper()))
+            comicbook.process_comic_to(book, processor, writers[output_format], output_file, quality,
+                                       drop_duplicates=drop_duplicates)
+            print(processor.report())
         else:
-            output = book
-
-        print('Saving as {}...'.format(output_format.upper()))
-        if output_format == 'epub':
-            comicbook.write_as_epub(output, output_file)
-        elif output_format == 'cbz':
-            comicbook.write_as_zip(output, output_file)
-        elif output_format == 'pdf':
-            comicbook.write_as_pdf(output, output_file)
+            if image_processing:
+                print('Processing...')
+                output = comicbook.process_comic(book, processor, quality, drop_duplicates=drop_duplicates,
+                                                  staging=comicbook.Staging(**staging))
+                print(processor.report())
+            else:
+                output = book
+
+            print('Saving as {}...'.format(output_format.upper()))
+            writers[output_format](output, output_file)
+            if output is not book:
+                print(output.staging.report())
+                output.close()
+
+        print(book.staging.report())
+        book.close()
 
         print('Adding to calibre...')
         print(db.add_book_format(id_, output_file))
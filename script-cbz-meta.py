@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import metaserver
+
+"""
+This script is to start the local server for cbz-meta.html editor
+
+Usage:
+ script-cbz-meta.py [--host=HOST] [--port=PORT] book
+ Supported book: cbz, zip
+"""
+
+
+def main(args):
+    HOST = '127.0.0.1'
+    PORT = 8000
+
+    USAGE = """Usage:
+ script-cbz-meta.py [--host=HOST] [--port=PORT] book
+ Supported book: cbz, zip"""
+
+    # Parse parameter
+    args = args[1:]
+    while True:
+        if len(args) == 0:
+            print(USAGE)
+            return
+
+        if args[0][:2] != '--':
+            break
+
+        values = args[0][2:].split('=', 1)
+        k = values[0]
+        v = values[1] if len(values) == 2 else None
+
+        if k == 'host':
+            HOST = v
+        elif k == 'port':
+            PORT = int(v)
+        else:
+            print(USAGE)
+            return
+
+        args = args[1:]
+
+    if len(args) != 1:
+        print(USAGE)
+        return
+
+    server = metaserver.make_server(args[0], HOST, PORT)
+    print('Editing {}'.format(args[0]))
+    print('Open http://{}:{}/ in the browser. Press Ctrl+C to stop.'.format(HOST, PORT))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv)
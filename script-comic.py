@@ -8,7 +8,10 @@ import comicprocessor
 This script is to convert comic from one format to another
 
 Usage:
- script-comic.py [--width=WIDTH] [--height=HEIGHT] [--rtl] input output
+ script-comic.py [--width=WIDTH] [--height=HEIGHT] [--rtl] [--linearize]
+                 [--codec=jpeg|webp|avif|jxl|png] [--lossless]
+                 [--target-size=SIZE] [--target-page-size=SIZE] [--drop-duplicates]
+                 [--staging=memory[:SIZE]|DIR] input output
  Supported input: folder, zip, cbz, pdf, epub, azw3
  Supported output: cbz, zip, pdf, epub
 """
@@ -18,9 +21,19 @@ def main(args):
     WIDTH = 1404
     HEIGHT = 1872
     RTL = False
+    LINEARIZE = False
+    CODEC = 'jpeg'
+    LOSSLESS = False
+    TARGET_SIZE = None
+    TARGET_PAGE_SIZE = None
+    DROP_DUPLICATES = False
+    STAGING = {}
 
     USAGE = """Usage:
- script-comic.py [--width=WIDTH] [--height=HEIGHT] [--rtl] input output
+ script-comic.py [--width=WIDTH] [--height=HEIGHT] [--rtl] [--linearize]
+                 [--codec=jpeg|webp|avif|jxl|png] [--lossless]
+                 [--target-size=SIZE] [--target-page-size=SIZE] [--drop-duplicates]
+                 [--staging=memory[:SIZE]|DIR] input output
  Supported input: folder, zip, cbz, pdf, epub, azw3
  Supported output: cbz, zip, pdf, epub"""
 
@@ -46,12 +59,33 @@ def main(args):
             RTL = True
         elif k == 'ltr':
             RTL = False
+        elif k == 'linearize':
+            LINEARIZE = True
+        elif k == 'codec':
+            CODEC = v
+        elif k == 'lossless':
+            LOSSLESS = True
+        elif k == 'target-size':
+            TARGET_SIZE = comicprocessor.parse_size(v)
+        elif k == 'target-page-size':
+            TARGET_PAGE_SIZE = comicprocessor.parse_size(v)
+        elif k == 'drop-duplicates':
+            DROP_DUPLICATES = True
+        elif k == 'staging' and v is not None and v.split(':')[0] == 'memory':
+            STAGING = {'memory_limit': comicprocessor.parse_size(v[7:]) if ':' in v else comicbook.MEMORY_STAGING_LIMIT}
+        elif k == 'staging' and v is not None:
+            STAGING = {'dir': v}
         else:
             print(USAGE)
             return
 
         args = args[1:]
 
+    # Quality of PNG and lossless output cannot be lowered to fit a size budget
+    if (TARGET_SIZE or TARGET_PAGE_SIZE) and comicprocessor.is_lossless(CODEC, LOSSLESS):
+        print('--target-size and --target-page-size cannot be used with PNG or --lossless output')
+        return
+
     if len(args) < 2:
         print(USAGE)
         return
@@ -76,26 +110,28 @@ def main(args):
         return
 
     print('Input file: {}'.format(input_file))
-    book = comicbook.load_book(input_file)
+    book = comicbook.load_book(input_file, comicbook.Staging(**STAGING))
 
     # Only specify direction for CBZ/ZIP/DIR
     if file_ext == '.cbz' or file_ext == '.zip' or file_ext == '':
         book.direction = -1 if RTL else 1
 
     if output_ext != '.pdf':
-        print('Processing...')
-        processor = comicprocessor.ComicProcessor(dir=book.direction, resize=(WIDTH, HEIGHT))
-        output = comicbook.process_comic(book, processor)
+        # Pages are saved as soon as they are processed
+        print('Processing and saving...')
+        processor = comicprocessor.ComicProcessor(dir=book.direction, resize=(WIDTH, HEIGHT), codec=CODEC,
+                                                  lossless=LOSSLESS, target_size=TARGET_SIZE,
+                                                  target_page_size=TARGET_PAGE_SIZE,
+                                                  share_duplicates=output_ext == '.epub' or DROP_DUPLICATES)
+        writer = comicbook.write_as_epub if output_ext == '.epub' else comicbook.write_as_zip
+        comicbook.process_comic_to(book, processor, writer, output_file, drop_duplicates=DROP_DUPLICATES)
+        print(processor.report())
     else:
-        output = book
+        print('Saving...')
+        comicbook.write_as_pdf(book, output_file, linearize=LINEARIZE)
 
-    print('Saving...')
-    if output_ext == '.epub':
-        comicbook.write_as_epub(output, output_file)
-    elif output_ext == '.pdf':
-        comicbook.write_as_pdf(output, output_file)
-    else:
-        comicbook.write_as_zip(output, output_file)
+    print(book.staging.report())
+    book.close()
 
     print('Done!')
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import comicbook
+
+"""
+This script is to view or update metadata and table of contents of CBZ/EPUB file in place,
+without rewriting the images
+
+Usage:
+ script-metadata.py [--title=TITLE] [--series=SERIES] [--volume=VOLUME]
+                    [--publisher=PUBLISHER] [--language=LANGUAGE] [--summary=SUMMARY]
+                    [--author=AUTHOR [--author=AUTHOR ...]]
+                    [--bookmark=PAGE:TITLE [--bookmark=PAGE:TITLE ...]] [--clear-toc]
+                    [--rtl] [--ltr] book
+ Supported book: cbz, zip, epub
+ Without any option, the current metadata is printed.
+"""
+
+
+def print_metadata(book):
+    metadata = book.metadata
+    print('Title:     {}'.format(metadata.title))
+    print('Series:    {}'.format(metadata.series))
+    print('Volume:    {}'.format(metadata.volume))
+    print('Publisher: {}'.format(metadata.publisher))
+    print('Language:  {}'.format(metadata.language))
+    print('Summary:   {}'.format(metadata.summary))
+    for people in metadata.credits:
+        print('Credit:    {} ({})'.format(people['person'], people['role']))
+    print('Direction: {}'.format('RTL' if book.direction == -1 else 'LTR'))
+    print('Pages:     {}'.format(len(book.images)))
+    for page, title in metadata.toc:
+        print('Bookmark:  {}:{}'.format(page, title))
+
+
+def main(args):
+    USAGE = """Usage:
+ script-metadata.py [--title=TITLE] [--series=SERIES] [--volume=VOLUME]
+                    [--publisher=PUBLISHER] [--language=LANGUAGE] [--summary=SUMMARY]
+                    [--author=AUTHOR [--author=AUTHOR ...]]
+                    [--bookmark=PAGE:TITLE [--bookmark=PAGE:TITLE ...]] [--clear-toc]
+                    [--rtl] [--ltr] book
+ Supported book: cbz, zip, epub
+ Without any option, the current metadata is printed."""
+
+    values = {}
+    authors = []
+    bookmarks = []
+    clear_toc = False
+    direction = None
+
+    # Parse parameter
+    args = args[1:]
+    while True:
+        if len(args) == 0:
+            print(USAGE)
+            return
+
+        if args[0][:2] != '--':
+            break
+
+        kv = args[0][2:].split('=', 1)
+        k = kv[0]
+        v = kv[1] if len(kv) == 2 else None
+
+        if k in ['title', 'series', 'publisher', 'language', 'summary'] and v is not None:
+            values[k] = v
+        elif k == 'volume' and v is not None:
+            values[k] = int(v)
+        elif k == 'author' and v is not None:
+            authors.append(v)
+        elif k == 'bookmark' and v is not None and ':' in v:
+            page, title = v.split(':', 1)
+            bookmarks.append([int(page), title])
+        elif k == 'clear-toc':
+            clear_toc = True
+        elif k == 'rtl':
+            direction = -1
+        elif k == 'ltr':
+            direction = 1
+        else:
+            print(USAGE)
+            return
+
+        args = args[1:]
+
+    if len(args) != 1:
+        print(USAGE)
+        return
+
+    book_file = args[0]
+    book = comicbook.load_book(book_file)
+
+    book.close()
+
+    if not values and not authors and not bookmarks and not clear_toc and direction is None:
+        print_metadata(book)
+        return
+
+    metadata = book.metadata
+    for k, v in values.items():
+        setattr(metadata, k, v)
+    if authors:
+        metadata.credits = [{'person': x, 'role': 'artist'} for x in authors]
+    if clear_toc or bookmarks:
+        metadata.toc = sorted(bookmarks)
+
+    comicbook.update_metadata(book_file, metadata, direction)
+    print('Done!')
+
+
+if __name__ == '__main__':
+    import sys
+
+    main(sys.argv)
@@ -0,0 +1,23 @@
+import unittest
+
+from comicprocessor import ComicProcessor
+
+
+class TargetSizeTest(unittest.TestCase):
+
+    def test_lossless_rejected(self):
+        # Quality of PNG and lossless output cannot be lowered to fit the budget
+        for codec, lossless in [('png', False), ('webp', True)]:
+            with self.assertRaises(Exception):
+                ComicProcessor(codec=codec, lossless=lossless, target_size=50 * 1024 * 1024)
+            with self.assertRaises(Exception):
+                ComicProcessor(codec=codec, lossless=lossless, target_page_size=300 * 1024)
+            ComicProcessor(codec=codec, lossless=lossless)
+
+    def test_lossy_accepted(self):
+        processor = ComicProcessor(codec='webp', target_page_size=300 * 1024)
+        self.assertEqual(processor.options['target_page_size'], 300 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
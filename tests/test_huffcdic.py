@@ -0,0 +1,229 @@
+import heapq
+import random
+import struct
+import unittest
+
+from kindleunpack.mobi_uncompress import HuffcdicReader
+
+
+# Code lengths of a Huffman code for the given symbol weights
+def huffman_lengths(weights):
+    heap = [(w, idx, [idx]) for idx, w in enumerate(weights)]
+    heapq.heapify(heap)
+    lengths = [0] * len(weights)
+    counter = len(weights)
+    while len(heap) > 1:
+        w1, _, s1 = heapq.heappop(heap)
+        w2, _, s2 = heapq.heappop(heap)
+        for symbol in s1 + s2:
+            lengths[symbol] += 1
+        heapq.heappush(heap, (w1 + w2, counter, s1 + s2))
+        counter += 1
+    return lengths
+
+
+class HuffcdicCode:
+    """
+    MOBI style canonical code: longer codes are numerically smaller, the dictionary index
+    of a code of length L is maxcode[L] - code, so the symbols of each length are consecutive.
+    """
+
+    def __init__(self, lengths):
+        self.lengths = lengths
+        self.max_length = max(lengths)
+        self.codes = [None] * len(lengths)
+        self.mincode = {}
+        self.maxcode = {}
+
+        by_length = {}
+        for symbol, length in enumerate(lengths):
+            by_length.setdefault(length, []).append(symbol)
+        for symbols in by_length.values():
+            assert symbols == list(range(symbols[0], symbols[-1] + 1)), 'symbols must be ordered by code length'
+
+        code = 0
+        for length in range(self.max_length, 0, -1):
+            symbols = by_length.get(length, [])
+            if symbols:
+                # Highest code is the first symbol of the length
+                self.mincode[length] = code
+                for symbol, value in zip(reversed(symbols), range(code, code + len(symbols))):
+                    self.codes[symbol] = value
+                code += len(symbols)
+                self.maxcode[length] = symbols[0] + code - 1
+            code = (code + 1) >> 1
+
+    def huff_record(self):
+        dict1 = []
+        for prefix in range(256):
+            for length in range(1, 9):
+                if length in self.mincode and self.mincode[length] <= prefix >> (8 - length):
+                    dict1.append(length | 0x80 | (self.maxcode[length] << 8))
+                    break
+            else:
+                dict1.append(9)
+        dict2 = []
+        for length in range(1, 33):
+            if length in self.mincode:
+                dict2 += [self.mincode[length], self.maxcode[length]]
+            else:
+                # No code is this long, every code is less than the minimum
+                dict2 += [min(1 << length, 0xffffffff), 0]
+        return (b'HUFF\x00\x00\x00\x18' + struct.pack('>LL', 24, 24 + 1024) + b'\0' * 8 +
+                struct.pack('>256L', *dict1) + struct.pack('>64L', *dict2))
+
+    def encode(self, symbols):
+        value, bits = 0, 0
+        for symbol in symbols:
+            value = (value << self.lengths[symbol]) | self.codes[symbol]
+            bits += self.lengths[symbol]
+        padding = -bits % 8
+        return (value << padding).to_bytes((bits + padding) // 8, 'big')
+
+
+# CDIC records of the phrases, each phrase is (data, expanded flag)
+def cdic_records(phrases, bits=10):
+    records = []
+    for start in range(0, len(phrases), 1 << bits):
+        offsets = []
+        body = bytearray()
+        chunk = phrases[start:start + (1 << bits)]
+        for data, expanded in chunk:
+            offsets.append(2 * len(chunk) + len(body))
+            body += struct.pack('>H', len(data) | (0x8000 if expanded else 0)) + data
+        records.append(b'CDIC\x00\x00\x00\x10' + struct.pack('>LL', len(phrases), bits) +
+                       struct.pack('>{}H'.format(len(chunk)), *offsets) + bytes(body))
+    return records
+
+
+# Zipf like phrase frequencies, most to least frequent
+def random_weights(rnd, count):
+    return sorted((1000000 // (rank + 1) + rnd.randint(0, 50) for rank in range(count)), reverse=True)
+
+
+def random_word(rnd):
+    return bytes(rnd.choice(b'etaoinshrdlu cmfwypvbgkjqxz.,\n\xe3\x81\x82') for _ in range(rnd.randint(1, 12)))
+
+
+def random_book(rnd, phrase_count=3000, record_count=20, symbols_per_record=800):
+    """
+    Random HUFF/CDIC book: literal phrases, and phrases made of other phrases that are
+    decoded on first use. Returns the HUFF record, CDIC records, text records and their expected text.
+    """
+    weights = random_weights(rnd, phrase_count)
+    lengths = sorted(huffman_lengths(weights))
+    code = HuffcdicCode(lengths)
+
+    # Phrases only refer to phrases made before them, but are stored in code length order
+    order = list(range(phrase_count))
+    rnd.shuffle(order)
+    phrases = [None] * phrase_count
+    texts = [None] * phrase_count
+    for made, idx in enumerate(order):
+        if made < 50 or rnd.random() < 0.6:
+            texts[idx] = random_word(rnd)
+            phrases[idx] = (texts[idx], True)
+        else:
+            parts = [order[rnd.randrange(made)] for _ in range(rnd.randint(1, 5))]
+            texts[idx] = b''.join(texts[x] for x in parts)
+            phrases[idx] = (code.encode(parts), False)
+
+    records = []
+    expected = []
+    for _ in range(record_count):
+        symbols = rnd.choices(range(phrase_count), weights, k=symbols_per_record)
+        records.append(code.encode(symbols))
+        expected.append(b''.join(texts[x] for x in symbols))
+    return code.huff_record(), cdic_records(phrases), records, expected
+
+
+# HuffcdicReader before the lookup table, expanding phrases recursively
+class ReferenceHuffcdicReader(HuffcdicReader):
+
+    def unpack(self, data):
+        q = HuffcdicReader.q
+
+        bitsleft = len(data) * 8
+        data += b"\x00\x00\x00\x00\x00\x00\x00\x00"
+        pos = 0
+        x, = q(data, pos)
+        n = 32
+
+        s = b''
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = q(data, pos)
+                n += 32
+            code = (x >> n) & ((1 << 32) - 1)
+
+            codelen, term, maxcode = self.dict1[code >> 24]
+            if not term:
+                while code < self.mincode[codelen]:
+                    codelen += 1
+                maxcode = self.maxcode[codelen]
+
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+
+            r = (maxcode - code) >> (32 - codelen)
+            slice, flag = self.dictionary[r]
+            if not flag:
+                self.dictionary[r] = None
+                slice = self.unpack(slice)
+                self.dictionary[r] = (slice, 1)
+            s += slice
+        return s
+
+
+def load_reader(cls, huff, cdics):
+    reader = cls()
+    reader.loadHuff(huff)
+    for cdic in cdics:
+        reader.loadCdic(cdic)
+    return reader
+
+
+class HuffcdicTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        rnd = random.Random(40)
+        for _ in range(8):
+            huff, cdics, records, expected = random_book(rnd, rnd.choice([300, 3000, 20000]))
+            reference = load_reader(ReferenceHuffcdicReader, huff, cdics)
+            reader = load_reader(HuffcdicReader, huff, cdics)
+            for data, text in zip(records, expected):
+                self.assertEqual(reference.unpack(data), text)
+                self.assertEqual(reader.unpack(data), text)
+            self.assertEqual(reader.dictionary, reference.dictionary)
+
+    def test_corrupt_records(self):
+        rnd = random.Random(400)
+        huff, cdics, _, _ = random_book(rnd, 3000, 0)
+        reference = load_reader(ReferenceHuffcdicReader, huff, cdics)
+        reader = load_reader(HuffcdicReader, huff, cdics)
+        for _ in range(2000):
+            data = bytes(rnd.randrange(256) for _ in range(rnd.randint(0, 64)))
+            results = []
+            for decoder in [reference, reader]:
+                try:
+                    results.append(decoder.unpack(data))
+                except Exception as e:
+                    results.append(type(e))
+            self.assertEqual(results[1], results[0])
+
+    def test_code_lengths(self):
+        # Codes both shorter and longer than the lookup table are used
+        lengths = set()
+        rnd = random.Random(40)
+        for count in [300, 3000, 20000]:
+            weights = random_weights(rnd, count)
+            lengths.update(huffman_lengths(weights))
+        self.assertLess(min(lengths), 8)
+        self.assertGreater(max(lengths), HuffcdicReader.LOOKUP_BITS)
+
+
+if __name__ == '__main__':
+    unittest.main()
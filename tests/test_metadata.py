@@ -0,0 +1,59 @@
+import io
+import os
+import tempfile
+import unittest
+
+import comicbook
+
+
+def make_book():
+    from PIL import Image
+
+    book = comicbook.ComicBook()
+    pages = []
+    for idx in range(3):
+        output = io.BytesIO()
+        Image.new('L', (60, 80), idx * 100).save(output, 'JPEG')
+        pages.append(comicbook.MemoryPage('{:03d}.jpg'.format(idx), output.getvalue()))
+    book.images = comicbook.PageSource(pages)
+    book.metadata.title = 'Title'
+    book.metadata.series = 'Series'
+    book.metadata.volume = 3
+    book.metadata.credits = [{'person': 'Author', 'role': 'writer'}]
+    return book
+
+
+class EPUBMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmp.name, 'book.epub')
+        comicbook.write_as_epub(make_book(), self.file)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self):
+        with comicbook.EPUBComicReader(self.file) as book:
+            return book.metadata
+
+    def test_read_back(self):
+        metadata = self.read()
+        self.assertEqual((metadata.title, metadata.series, metadata.volume), ('Title', 'Series', 3))
+
+    def test_update(self):
+        metadata = self.read()
+        metadata.volume = 5
+        metadata.series = 'Other'
+        comicbook.update_metadata(self.file, metadata)
+        comicbook.update_metadata(self.file, metadata)
+
+        metadata = self.read()
+        self.assertEqual((metadata.title, metadata.series, metadata.volume), ('Title', 'Other', 5))
+        with comicbook.EPUBComicReader(self.file) as book:
+            opf = book._zip.read(book._opf_file)
+        self.assertEqual(opf.count(b'calibre:series_index'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+import zipfile
+from unittest import mock
+
+import comicbook
+import metaserver
+
+COMICINFO = b'<?xml version="1.0"?><ComicInfo><Title>{}</Title></ComicInfo>'
+
+
+class MetaServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmp.name, 'book.cbz')
+        with zipfile.ZipFile(self.file, 'w') as zfp:
+            for idx in range(3):
+                zfp.writestr('p{:03d}.jpg'.format(idx), bytes([idx]) * 1000)
+            zfp.writestr('ComicInfo.xml', COMICINFO.replace(b'{}', b'Before'))
+
+        self.server = metaserver.make_server(self.file, port=0)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path) as response:
+            return response.read()
+
+    def post_comicinfo(self, xml):
+        request = urllib.request.Request(self.url + '/api/comicinfo', data=xml, method='POST',
+                                         headers={'Content-Type': 'application/xml', 'Origin': self.url})
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+
+    def test_book_read_once(self):
+        with mock.patch.object(metaserver.comicbook, 'ZipComicReader', wraps=comicbook.ZipComicReader) as reader:
+            book = json.loads(self.get('/api/book'))
+            self.assertEqual([x['name'] for x in book['pages']], ['p000.jpg', 'p001.jpg', 'p002.jpg'])
+            for idx in range(3):
+                self.assertEqual(self.get('/api/page/{}'.format(idx)), bytes([idx]) * 1000)
+            self.assertEqual(reader.call_count, 1)
+
+    def test_read_again_after_update(self):
+        with mock.patch.object(metaserver.comicbook, 'ZipComicReader', wraps=comicbook.ZipComicReader) as reader:
+            self.assertIn('Before', json.loads(self.get('/api/book'))['comicinfo'])
+            self.post_comicinfo(COMICINFO.replace(b'{}', b'After'))
+            self.assertIn('After', json.loads(self.get('/api/book'))['comicinfo'])
+            self.assertEqual(self.get('/api/page/2'), bytes([2]) * 1000)
+            self.assertEqual(reader.call_count, 2)
+
+            # Rejected update keeps the book
+            with self.assertRaises(urllib.error.HTTPError):
+                self.post_comicinfo(b'<NotComicInfo/>')
+            self.get('/api/page/0')
+            self.assertEqual(reader.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import contextlib
+import io
+import random
+import unittest
+
+from kindleunpack.mobi_dict import dictSupport
+from tests.test_mobi_index import Sections, build_index, build_orth_index, reference_index_data, vwi
+
+# Inflection groups: rule names and rules
+INFL_TAGX = [(0x05, 1, 0x03, 0), (0x1a, 1, 0x0c, 0), (0, 0, 0, 1)]
+
+RULE_NAMES = [b'plural', b'past', b'negative', b'comparative', b'possessive']
+
+
+def random_rule(rnd):
+    text = bytes(rnd.choice(b'abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(1, 3)))
+    kind = rnd.randrange(3)
+    # Characters inserted at the word end are stored in reverse order
+    if kind == 0:
+        # Insert at word end
+        return b'\x02' + text, lambda word: word + text[::-1]
+    elif kind == 1:
+        # Insert at word start
+        return b'\x01' + text, lambda word: text + word
+    # Move back one character from the end, then insert
+    return b'\x0b\x02' + text, lambda word: word[:-1] + text[::-1] + word[-1:]
+
+
+class Dictionary:
+    """
+    Dictionary with an orth index of count headwords and group_count inflection groups of
+    rule_count rules. Groups in broken_groups miss their rules tag.
+    """
+
+    def __init__(self, count, group_count, rule_count, broken_groups=(), seed=1):
+        rnd = random.Random(seed)
+        self.orth = build_orth_index(count, seed, group_count)
+
+        names = b''
+        name_offsets = []
+        for name in RULE_NAMES:
+            name_offsets.append(len(names))
+            names += vwi(len(name)) + name
+
+        self.rules = [random_rule(rnd) for _ in range(rule_count)]
+        self.groups = []
+        entries = []
+        for idx in range(group_count):
+            group = [(rnd.randrange(len(RULE_NAMES)), rnd.randrange(rule_count)) for _ in range(rnd.randint(1, 2))]
+            self.groups.append(group)
+            values = b''.join(vwi(name_offsets[x]) for x, _ in group)
+            if idx in broken_groups:
+                control = len(group)
+            else:
+                control = len(group) | len(group) << 2
+                values += b''.join(vwi(group_count + x) for _, x in group)
+            # Group entries start with a zero byte, rules with their length
+            entries.append((b'', bytes([control]), values))
+        for rule, _ in self.rules:
+            entries.append((rule, b'', b''))
+        self.broken_groups = set(broken_groups)
+
+        self.infl = build_index(INFL_TAGX, entries, per_record=2000)
+        self.sections = self.orth + self.infl + [names]
+
+    # Header object for dictSupport
+    def header(self):
+        return type('MobiHeader', (), {'header': b'', 'metaOrthIndex': 0, 'metaInflIndex': len(self.orth)})
+
+    def position_map(self):
+        return dictSupport(self.header(), Sections(self.sections)).getPositionMap()
+
+    # Position map decoded from the orth index in the simplest way
+    def expected_position_map(self):
+        positions = {}
+        for text, tags in reference_index_data(self.orth):
+            groups = tags.get(0x2a, [])
+            if any(x in self.broken_groups for x in groups):
+                markup = b''
+            else:
+                markup = b''
+                for group in groups:
+                    markup += b'<idx:infl>'
+                    for name, rule in self.groups[group]:
+                        markup += b'  <idx:iform name="' + RULE_NAMES[name] + b'" value="' + \
+                                  self.rules[rule][1](text) + b'"/>'
+                    markup += b'</idx:infl>'
+            start = tags[0x01][0]
+            end = start + tags[0x02][0]
+            positions.setdefault(start, []).append(
+                b'<idx:entry scriptable="yes"><idx:orth value="' + text + b'">' + markup + b'</idx:orth>')
+            positions.setdefault(end, []).insert(0, b'</idx:entry>')
+        return positions
+
+
+class PositionMapTest(unittest.TestCase):
+
+    def test_inflections(self):
+        dictionary = Dictionary(3000, 500, 80)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            positions = dictionary.position_map()
+        self.assertNotIn('Error', output.getvalue())
+        self.assertEqual(positions, dictionary.expected_position_map())
+
+    def test_broken_groups(self):
+        # The error of a broken group is printed once, however many entries use it
+        dictionary = Dictionary(3000, 50, 20, broken_groups=[3, 7])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            positions = dictionary.position_map()
+        self.assertEqual(output.getvalue().count('Error: Required tag 0x1a not found in tagMap'), 2)
+        self.assertEqual(positions, dictionary.expected_position_map())
+
+
+if __name__ == '__main__':
+    unittest.main()
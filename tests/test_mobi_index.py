@@ -0,0 +1,267 @@
+import contextlib
+import io
+import random
+import struct
+import unittest
+
+from kindleunpack import mobi_index
+from kindleunpack.mobi_index import MobiIndex, getTagPlan, decodeTagMap, getTagMap, getVariableWidthValue, \
+    readTagSection
+from kindleunpack.mobi_utils import toHex
+
+
+# Forward encoded variable width value, the last byte has the high bit set
+def vwi(value):
+    out = [value & 0x7f | 0x80]
+    value >>= 7
+    while value:
+        out.insert(0, value & 0x7f)
+        value >>= 7
+    return bytes(out)
+
+
+# INDX sections of an index: main section with TAGX, then sections of at most per_record entries.
+# tagx is list of (tag, values per entry, mask, end flag), entries are (text, control bytes, value bytes).
+def build_index(tagx, entries, per_record=400):
+    sections = []
+    for k in range(0, max(1, len(entries)), per_record):
+        chunk = entries[k:k + per_record]
+        body = bytearray()
+        offsets = []
+        for text, control, values in chunk:
+            offsets.append(0xC0 + len(body))
+            body += bytes([len(text)]) + text + control + values
+        idxt = b'IDXT' + b''.join(struct.pack('>H', x) for x in offsets)
+        idxt += b'\0' * (-len(idxt) % 4)
+        header = bytearray(0xC0)
+        header[0:4] = b'INDX'
+        struct.pack_into('>13L', header, 4, 0xC0, 0, 1, 0, 0xC0 + len(body), len(chunk), 0xfde9, 0xffffffff,
+                         0, 0, 0, 0, 0)
+        sections.append(bytes(header) + bytes(body) + idxt)
+    control_byte_count = sum(1 for x in tagx if x[3] == 1)
+    header = bytearray(0xC0)
+    header[0:4] = b'INDX'
+    struct.pack_into('>13L', header, 4, 0xC0, 0, 0, 0, 0, len(sections), 0xfde9, 0xffffffff, len(entries),
+                     0, 0, 0, 0)
+    tagx_data = b'TAGX' + struct.pack('>LL', 12 + 4 * len(tagx), control_byte_count) + b''.join(bytes(x) for x in tagx)
+    return [bytes(header) + tagx_data] + sections
+
+
+# Dictionary like orth index: start position, entry length and inflection groups of each headword
+ORTH_TAGX = [(0x01, 1, 0x01, 0), (0x02, 1, 0x02, 0), (0x2a, 1, 0x0c, 0), (0x16, 1, 0x30, 0), (0, 0, 0, 1)]
+
+
+def build_orth_index(count, seed=1, group_count=5001):
+    rnd = random.Random(seed)
+    entries = []
+    position = 0
+    for k in range(count):
+        position += rnd.randint(40, 400)
+        control = 0x03
+        prefix = b''
+        values = vwi(position) + vwi(rnd.randint(50, 3000))
+        groups = rnd.choice([0, 1, 2, 3, 5])
+        if groups == 3:
+            # All mask bits set: byte count of the values follows the control byte
+            control |= 0x0c
+            data = b''.join(vwi(rnd.randrange(group_count)) for _ in range(4))
+            prefix = vwi(len(data))
+            values += data
+        elif groups:
+            control |= min(groups, 2) << 2
+            values += b''.join(vwi(rnd.randrange(group_count)) for _ in range(min(groups, 2)))
+        if rnd.random() < 0.3:
+            control |= 0x10
+            values += vwi(rnd.randint(0, 99))
+        entries.append(('w{:07d}'.format(k).encode(), bytes([control]), prefix + values))
+    return build_index(ORTH_TAGX, entries)
+
+
+class Sections:
+
+    def __init__(self, sections):
+        self.sections = sections
+
+    def loadSection(self, i):
+        return self.sections[i]
+
+    def setsectiondescription(self, i, description):
+        pass
+
+
+# getTagMap before the tag plans, reading one byte slice at a time
+def reference_get_tag_map(controlByteCount, tagTable, entryData, startPos, endPos):
+    def vwi_value(data, offset):
+        value = 0
+        consumed = 0
+        finished = False
+        while not finished:
+            v = data[offset + consumed: offset + consumed + 1]
+            consumed += 1
+            if ord(v) & 0x80:
+                finished = True
+            value = (value << 7) | (ord(v) & 0x7f)
+        return consumed, value
+
+    tags = []
+    tagHashMap = {}
+    controlByteIndex = 0
+    dataStart = startPos + controlByteCount
+    for tag, valuesPerEntry, mask, endFlag in tagTable:
+        if endFlag == 0x01:
+            controlByteIndex += 1
+            continue
+        value = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex + 1]) & mask
+        if value != 0:
+            if value == mask:
+                if bin(mask).count('1') > 1:
+                    consumed, value = vwi_value(entryData, dataStart)
+                    dataStart += consumed
+                    tags.append((tag, None, value, valuesPerEntry))
+                else:
+                    tags.append((tag, 1, None, valuesPerEntry))
+            else:
+                while mask & 0x01 == 0:
+                    mask = mask >> 1
+                    value = value >> 1
+                tags.append((tag, value, None, valuesPerEntry))
+    for tag, valueCount, valueBytes, valuesPerEntry in tags:
+        values = []
+        if valueCount is not None:
+            for _ in range(valueCount):
+                for _ in range(valuesPerEntry):
+                    consumed, data = vwi_value(entryData, dataStart)
+                    dataStart += consumed
+                    values.append(data)
+        else:
+            totalConsumed = 0
+            while totalConsumed < valueBytes:
+                consumed, data = vwi_value(entryData, dataStart)
+                dataStart += consumed
+                totalConsumed += consumed
+                values.append(data)
+            if totalConsumed != valueBytes:
+                print("Error: Should consume %s bytes, but consumed %s" % (valueBytes, totalConsumed))
+        tagHashMap[tag] = values
+    if endPos is not None and dataStart != endPos:
+        for char in entryData[dataStart:endPos]:
+            if char != 0:
+                print("Warning: There are unprocessed index bytes left: %s" % toHex(entryData[dataStart:endPos]))
+                break
+    return tagHashMap
+
+
+# Entries of an index without CTOC, decoded one entry at a time as getIndexData did before the tag plans
+def reference_index_data(sections):
+    entries = []
+    control_byte_count, table = readTagSection(0xC0, sections[0])
+    for data in sections[1:]:
+        start, count = struct.unpack_from('>LL', data, 0x14)
+        positions = list(struct.unpack_from('>{}H'.format(count), data, start + 4)) + [start]
+        for j in range(count):
+            text_length = ord(data[positions[j]:positions[j] + 1])
+            text = data[positions[j] + 1:positions[j] + 1 + text_length]
+            entries.append([text, reference_get_tag_map(control_byte_count, table, data,
+                                                        positions[j] + 1 + text_length, positions[j + 1])])
+    return entries
+
+
+# Result, or ERROR when the entry is truncated, and the printed output.
+# Reading past the end raised TypeError on the old decoder and raises IndexError on the new one.
+ERROR = 'error'
+
+
+def run(func, *args):
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            result = func(*args)
+    except (IndexError, TypeError):
+        result = ERROR
+    return result, output.getvalue()
+
+
+def random_tag_table(rnd, masks):
+    control_byte_count = rnd.randint(1, 2)
+    table = []
+    for _ in range(control_byte_count):
+        for _ in range(rnd.randint(0, 4)):
+            table.append((rnd.randint(1, 80), rnd.randint(1, 3), rnd.choice(masks), 0))
+        table.append((0, 0, 0, 1))
+    return control_byte_count, table
+
+
+def random_entry(rnd):
+    return bytes(rnd.choice([0, 0x81, 0x7f, 0xff, 3, rnd.randrange(256)]) for _ in range(rnd.randint(0, 40)))
+
+
+class TagMapTest(unittest.TestCase):
+    MASKS = [1, 2, 3, 4, 0x0c, 0x30, 0xc0, 0x80, 0x40, 0x0f]
+
+    def test_matches_reference(self):
+        # Random, mostly corrupt entries: same values, warnings and errors as before
+        rnd = random.Random(49)
+        for _ in range(30000):
+            control_byte_count, table = random_tag_table(rnd, self.MASKS)
+            data = random_entry(rnd)
+            start = rnd.randint(0, 5)
+            end = rnd.choice([None, len(data), rnd.randint(0, len(data) + 2)])
+            expected = run(reference_get_tag_map, control_byte_count, table, data, start, end)
+            self.assertEqual(run(getTagMap, control_byte_count, table, data, start, end), expected)
+            plan = getTagPlan(control_byte_count, table)
+            self.assertEqual(run(decodeTagMap, plan, data, start, end), expected)
+
+    def test_zero_mask(self):
+        # A tag with zero mask is never set. The old decoder still read its control byte and
+        # failed if the entry was too short there; the new one decodes as if the tag was not listed.
+        rnd = random.Random(4900)
+        for _ in range(10000):
+            control_byte_count, table = random_tag_table(rnd, self.MASKS + [0, 0])
+            data = random_entry(rnd)
+            start = rnd.randint(0, 5)
+            end = rnd.choice([None, len(data)])
+            result = run(getTagMap, control_byte_count, table, data, start, end)
+            expected = run(reference_get_tag_map, control_byte_count, table, data, start, end)
+            if expected[0] is ERROR:
+                table = [x for x in table if x[2] != 0 or x[3] == 1]
+                expected = run(reference_get_tag_map, control_byte_count, table, data, start, end)
+            self.assertEqual(result, expected)
+
+    def test_variable_width_value(self):
+        rnd = random.Random(490)
+        for _ in range(5000):
+            values = [rnd.randrange(1 << rnd.randint(1, 35)) for _ in range(rnd.randint(1, 5))]
+            data = b'\x00' * 3 + b''.join(vwi(x) for x in values)
+            offset = 3
+            for value in values:
+                consumed, decoded = getVariableWidthValue(data, offset)
+                self.assertEqual((consumed, decoded), (len(vwi(value)), value))
+                offset += consumed
+
+    def test_tag_section(self):
+        tagx = [(1, 1, 0x01, 0), (2, 1, 0x02, 0), (0, 0, 0, 1), (6, 2, 0x03, 0), (0, 0, 0, 1)]
+        data = b'xx' + b'TAGX' + struct.pack('>LL', 12 + 4 * len(tagx), 2) + b''.join(bytes(x) for x in tagx)
+        self.assertEqual(readTagSection(2, data), (2, [tuple(x) for x in tagx]))
+        self.assertEqual(readTagSection(0, data), (0, []))
+
+    def test_ctoc(self):
+        strings = [b'Chapter 1', b'', b'x' * 200, 'Dai {}'.format(chr(0x3042)).encode('utf-8')]
+        data = bytearray()
+        expected = {}
+        for text in strings:
+            expected[len(data)] = text
+            data += vwi(len(text)) + text
+        data += b'\0\0\0'
+        self.assertEqual(MobiIndex(None).readCTOC(bytes(data)), expected)
+
+
+class IndexDataTest(unittest.TestCase):
+
+    def test_matches_reference(self):
+        sections = build_orth_index(3000)
+        result, output = run(MobiIndex(Sections(sections)).getIndexData, 0, 'test')
+        self.assertEqual(output, '')
+        self.assertEqual(result, (reference_index_data(sections), {}))
+
+if __name__ == '__main__':
+    unittest.main()
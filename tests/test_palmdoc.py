@@ -0,0 +1,103 @@
+import random
+import unittest
+
+from kindleunpack.mobi_uncompress import PalmdocReader
+
+
+# Greedy PalmDOC compressor, only used as the reference to round trip the decoder
+def palmdoc_compress(data):
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        best_len, best_dist = 0, 0
+        lo = max(0, i - 2047)
+        if i > 0:
+            for length in range(min(10, n - i), 2, -1):
+                j = data.rfind(data[i:i + length], lo, i + length - 1)
+                if j != -1 and j < i and i - j <= 2047:
+                    best_len, best_dist = length, i - j
+                    break
+        if best_len >= 3:
+            value = 0x8000 | (best_dist << 3) | (best_len - 3)
+            out += bytes([value >> 8, value & 0xff])
+            i += best_len
+        elif data[i] == 0x20 and i + 1 < n and 0x40 <= data[i + 1] < 0x80:
+            out.append(data[i + 1] ^ 0x80)
+            i += 2
+        elif data[i] == 0 or 0x09 <= data[i] < 0x80:
+            out.append(data[i])
+            i += 1
+        else:
+            j = i
+            while j < n and j - i < 8 and not (data[j] == 0 or 0x09 <= data[j] < 0x80):
+                j += 1
+            out.append(j - i)
+            out += data[i:j]
+            i = j
+    return bytes(out)
+
+
+# The byte by byte decoder before PalmdocReader used a bytearray
+def palmdoc_reference_unpack(i):
+    o, p = b'', 0
+    while p < len(i):
+        c = i[p]
+        p += 1
+        if 1 <= c <= 8:
+            o += i[p:p + c]
+            p += c
+        elif c < 128:
+            o += bytes([c])
+        elif c >= 192:
+            o += b' ' + bytes([c ^ 128])
+        elif p < len(i):
+            c = (c << 8) | i[p]
+            p += 1
+            m = (c >> 3) & 0x07ff
+            n = (c & 7) + 3
+            if m > n:
+                o += o[-m:n - m]
+            else:
+                for _ in range(n):
+                    o += o[-m:] if m == 1 else o[-m:-m + 1]
+    return o
+
+
+def random_text(rnd, size):
+    kind = rnd.randrange(3)
+    if kind == 0:
+        alphabet = bytes(rnd.sample(range(256), rnd.randint(1, 40)))
+        return bytes(rnd.choice(alphabet) for _ in range(size))
+    if kind == 1:
+        words = [b'<div>', b'</div>', b'hello', b' world', b' ', b'\n', b'<img recindex="00001"/>', b'\xe3\x81\x82']
+        text = b''
+        while len(text) < size:
+            text += rnd.choice(words)
+        return text[:size]
+    # Runs of one byte give overlapping back references
+    text = b''
+    while len(text) < size:
+        text += bytes([rnd.randrange(256)]) * rnd.randint(1, 40)
+    return text[:size]
+
+
+class PalmdocTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        rnd = random.Random(39)
+        reader = PalmdocReader()
+        for _ in range(300):
+            data = random_text(rnd, rnd.randint(0, 4096))
+            self.assertEqual(reader.unpack(palmdoc_compress(data)), data)
+
+    def test_matches_reference_on_random_streams(self):
+        # Also corrupt streams: distance 0, distance beyond the output, truncated pairs
+        rnd = random.Random(3900)
+        reader = PalmdocReader()
+        for _ in range(20000):
+            stream = bytes(rnd.randrange(256) for _ in range(rnd.randint(0, 60)))
+            self.assertEqual(reader.unpack(stream), palmdoc_reference_unpack(stream), stream)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import contextlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from kindleunpack.kindleunpack import unpackBook, unpackException
+from kindleunpack.mobi_sectioner import Sectionizer
+from kindleunpack.mobi_split import mobi_split
+
+
+# Palm database with the given sections
+def palm_database(ident, sections):
+    header = b'book'.ljust(32, b'\0') + b'\0' * 28 + ident + b'\0' * 8 + struct.pack('>H', len(sections))
+    offset = len(header) + 8 * len(sections) + 2
+    table = b''
+    for idx, section in enumerate(sections):
+        table += struct.pack('>LL', offset, idx)
+        offset += len(section)
+    return header + table + b'\0\0' + b''.join(sections)
+
+
+# Record 0 of a KF8 only book: the PalmDOC header, then the MOBI header of version 8
+def kf8_record0():
+    return b'\0' * 16 + b'MOBI' + struct.pack('>LLLL', 232, 2, 65001, 0) + struct.pack('>L', 8) + b'\0' * 200
+
+
+def is_mapped(file):
+    with open('/proc/self/maps') as f:
+        return any(line.rstrip().endswith(os.path.realpath(file)) for line in f)
+
+
+class SectionizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'book.azw3')
+        self.sections = [kf8_record0(), b'\xff\xd8\xff\xe0' + b'x' * 1000, b'abc']
+        with open(self.file, 'wb') as f:
+            f.write(palm_database(b'BOOKMOBI', self.sections))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_close_with_views(self):
+        sect = Sectionizer(self.file)
+        views = [sect.loadSectionView(i) for i in range(len(self.sections))]
+        self.assertEqual([bytes(x) for x in views], self.sections)
+        # views still referenced do not stop the mapping from closing
+        sect.close()
+        self.assertTrue(sect.data.closed)
+        with self.assertRaises(ValueError):
+            bytes(views[1])
+
+    def test_context_manager(self):
+        with Sectionizer(self.file) as sect:
+            self.assertEqual(sect.loadSection(2), b'abc')
+            self.assertEqual(bytes(sect.loadSectionView(1)[:4]), b'\xff\xd8\xff\xe0')
+        self.assertTrue(sect.data.closed)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/maps'), 'needs /proc/self/maps')
+    def test_unpack_unmaps_file(self):
+        with open(self.file, 'wb') as f:
+            f.write(palm_database(b'NOTABOOK', self.sections))
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(unpackException):
+                unpackBook(self.file, self.dir)
+        self.assertFalse(is_mapped(self.file))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/maps'), 'needs /proc/self/maps')
+    def test_split_unmaps_file(self):
+        self.assertFalse(mobi_split(self.file).combo)
+        self.assertFalse(is_mapped(self.file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import io
+import multiprocessing
+import os
+import random
+import tempfile
+import unittest
+import zipfile
+
+import comicbook
+
+# Set for the forked workers
+book = None
+expected = None
+
+
+def read_page(idx):
+    try:
+        return book.images[idx].read() == expected[idx]
+    except Exception as e:
+        return repr(e)
+
+
+class ZipPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmp.name, 'book.cbz')
+        rnd = random.Random(27)
+        with zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED) as zfp:
+            for idx in range(41):
+                zfp.writestr('p{:03d}.jpg'.format(idx), bytes(rnd.randrange(256) for _ in range(30000)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'needs fork')
+    def test_forked_workers(self):
+        # The parent has the zip file open already when the workers are forked
+        global book, expected
+        book = comicbook.ZipComicReader(self.file)
+        expected = [x.read() for x in book.images]
+        try:
+            with multiprocessing.get_context('fork').Pool(4) as pool:
+                results = pool.map(read_page, list(range(len(expected))) * 10, chunksize=1)
+        finally:
+            book.close()
+        self.assertEqual([x for x in results if x is not True], [])
+
+    def test_close(self):
+        with comicbook.ZipComicReader(self.file) as reader:
+            zfp = comicbook._open_zip(self.file)
+            self.assertEqual(len(reader.images[0].read()), 30000)
+        self.assertIsNone(zfp.fp)
+        self.assertNotIn(self.file, comicbook._zip_files)
+
+        # Pages can still be read after the book is closed
+        self.assertEqual(len(reader.images[1].read()), 30000)
+        comicbook._close_zip(self.file)
+
+    def test_rewritten_file(self):
+        with comicbook.ZipComicReader(self.file) as reader:
+            reader.images[0].read()
+            comicbook.update_comicinfo(self.file, b'<ComicInfo><Title>New</Title></ComicInfo>')
+            self.assertEqual(comicbook.ZipComicReader(self.file).metadata.title, 'New')
+
+
+if __name__ == '__main__':
+    unittest.main()